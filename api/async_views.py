@@ -0,0 +1,215 @@
+import json
+
+from asgiref.sync import sync_to_async
+from django.db import models
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import exceptions, status
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from api.conditional import make_validators, set_validators
+from pharmacy_app import catalog_cache
+from pharmacy_app.models import Product, Category, Sale, SaleProduct
+from pharmacy_app.serializers import (
+    ProductSerializer, CategorySerializer, SaleExtendedSerializer, StockCheckSerializer
+)
+from pharmacy_app.stock import acheck_availability
+
+
+def _authenticate(request):
+    """Runs the DRF authentication classes (JWT, session with its CSRF check) on a plain request"""
+
+    drf_request = Request(request, authenticators=[auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES])
+
+    # Sets request.user too, so the current user is seen by signals
+    return drf_request.user
+
+
+class AsyncAPIView(View):
+    """
+    Base of the async read endpoints, for serving many slow clients per worker under ASGI.
+
+    Authentication is synchronous and runs in a worker thread, everything else
+    awaits the async ORM. Handlers return (data, status), rendered as JSON the
+    way the synchronous views render it. Conditional GETs are answered like in
+    the synchronous views, with the same ETags and the same cached bodies.
+    """
+
+    renderer = JSONRenderer()
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # Session authentication enforces CSRF itself, like the DRF views
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def get_validators(self, request, *args, **kwargs):
+        return None
+
+    def render(self, data, status_code):
+        return HttpResponse(self.renderer.render(data), status=status_code, content_type='application/json')
+
+    async def dispatch(self, request, *args, **kwargs):
+
+        handler = getattr(self, request.method.lower(), None)
+
+        if request.method.lower() not in self.http_method_names or handler is None:
+            return self.render({"detail": f'Method "{request.method}" not allowed.'}, status.HTTP_405_METHOD_NOT_ALLOWED)
+
+        try:
+            user = await sync_to_async(_authenticate)(request)
+        except exceptions.APIException as exc:
+            return self.render({"detail": exc.detail}, exc.status_code)
+
+        if not user.is_authenticated:
+            return self.render({"detail": exceptions.NotAuthenticated.default_detail}, status.HTTP_401_UNAUTHORIZED)
+
+        validators = self.validator_source = None
+
+        if request.method in ('GET', 'HEAD'):
+            validators = await self.get_validators(request, *args, **kwargs)
+
+        if validators is not None:
+            self.validator_source = validators[0]
+            validators = make_validators(self.renderer.media_type, *validators)
+            response = get_conditional_response(request, etag=validators[0], last_modified=validators[1])
+
+            if response is not None:
+                set_validators(response, validators)
+                return response
+
+        data, status_code = await handler(request, *args, **kwargs)
+        response = self.render(data, status_code)
+
+        if validators is not None:
+            set_validators(response, validators)
+
+        return response
+
+
+class AsyncProductDetailView(AsyncAPIView):
+    """Retrieves a product"""
+
+    async def get_validators(self, request, product_id):
+
+        row = await Product.objects.filter(id=product_id).values_list(
+            'version', 'updated_at', 'category__version', 'category__updated_at'
+        ).afirst()
+
+        if row is None:
+            return None
+
+        version, updated_at, category_version, category_updated_at = row
+
+        return (
+            f"product:{product_id}:{version}:{updated_at}:{category_version}:{category_updated_at}",
+            max(filter(None, (updated_at, category_updated_at)))
+        )
+
+    async def get_product_payload(self, product_id):
+        product = await Product.objects.select_related('category', 'recorder').filter(id=product_id).afirst()
+        return ProductSerializer(product, many=False).data if product else None
+
+    async def get(self, request, product_id):
+
+        payload = await catalog_cache.aget_versioned(
+            catalog_cache.product_key(product_id), self.validator_source, lambda: self.get_product_payload(product_id)
+        )
+
+        if payload is None:
+            return {"error": "Product does not exist"}, status.HTTP_404_NOT_FOUND
+
+        return payload, status.HTTP_200_OK
+
+
+class AsyncCategoryDetailView(AsyncAPIView):
+    """Retrieves a category"""
+
+    async def get_validators(self, request, category_id):
+
+        row = await Category.objects.filter(id=category_id).values_list('version', 'updated_at').afirst()
+
+        if row is None:
+            return None
+
+        return f"category:{category_id}:{row[0]}:{row[1]}", row[1]
+
+    async def get_category_payload(self, category_id):
+        category = await Category.objects.filter(id=category_id).afirst()
+        return CategorySerializer(category, many=False).data if category else None
+
+    async def get(self, request, category_id):
+
+        payload = await catalog_cache.aget_versioned(
+            catalog_cache.category_key(category_id), self.validator_source, lambda: self.get_category_payload(category_id)
+        )
+
+        if payload is None:
+            return {"error": "Category does not exist"}, status.HTTP_404_NOT_FOUND
+
+        return payload, status.HTTP_200_OK
+
+
+class AsyncSaleDetailView(AsyncAPIView):
+    """Retrieves a sale with its items"""
+
+    async def get_validators(self, request, sale_id):
+
+        row = await Sale.objects.filter(sale_id=sale_id).values_list('version', 'updated_at').annotate(
+            products_updated_at=models.Max('sale_products__product__updated_at'),
+            categories_updated_at=models.Max('sale_products__product__category__updated_at'),
+        ).order_by('sale_id').afirst()
+
+        if row is None:
+            return None
+
+        version, *moments = row
+
+        return f"sale:{sale_id}:{version}:{moments}", max(filter(None, moments))
+
+    async def get(self, request, sale_id):
+
+        sale = await Sale.objects.select_related('recorder').prefetch_related(
+            models.Prefetch(
+                'sale_products',
+                queryset=SaleProduct.objects.select_related('product__category', 'product__recorder')
+            )
+        ).filter(pk=sale_id).afirst()
+
+        if not sale:
+            return {"error": "Sale does not exist"}, status.HTTP_404_NOT_FOUND
+
+        return SaleExtendedSerializer(sale, many=False).data, status.HTTP_200_OK
+
+
+class AsyncStockCheckView(AsyncAPIView):
+    """Pre-validates a whole basket against the stock in one round trip"""
+
+    async def post(self, request):
+
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError as error:
+            return {"detail": f"JSON parse error - {error}"}, status.HTTP_400_BAD_REQUEST
+
+        serializer = StockCheckSerializer(data=data)
+
+        if not serializer.is_valid():
+            return serializer.errors, status.HTTP_400_BAD_REQUEST
+
+        lines = await acheck_availability(
+            (item['product'], item['retailPrice'], item['quantity'])
+            for item in serializer.validated_data['items']
+        )
+
+        for line in lines:
+            for key in ('retailPrice', 'requested', 'available'):
+                line[key] = str(line[key])
+
+        return {
+            "available": all(line['sufficient'] for line in lines),
+            "items": lines,
+        }, status.HTTP_200_OK
@@ -0,0 +1,117 @@
+import hashlib
+
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+
+
+def make_validators(media_type, source, last_modified):
+    """Returns the (strong ETag, Last-Modified timestamp) of a representation of `source`"""
+
+    # The browsable API and JSON renderings of the same data are different representations
+    digest = hashlib.md5(f"{media_type}|{source}".encode()).hexdigest()
+
+    return quote_etag(digest), int(last_modified.timestamp()) if last_modified else None
+
+
+def set_validators(response, validators):
+    """Adds the validators to a 200 or 304 response"""
+
+    if response.status_code not in (200, 304):
+        return
+
+    etag, last_modified = validators
+    response['ETag'] = etag
+
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+
+    # Private data, clients may keep it but have to revalidate it every time
+    patch_cache_control(response, private=True, no_cache=True)
+
+
+class _NotModified(Exception):
+    """Carries the 304 (or 412) response out of `initial()` past the handler"""
+
+    def __init__(self, response):
+        super().__init__()
+        self.response = response
+
+
+class ConditionalGetMixin:
+    """
+    Answers If-None-Match / If-Modified-Since with 304 before the view runs.
+
+    Views implement `get_validators()`, returning the ETag source and the last
+    modification time of what the response would contain, read with one cheap
+    query, or None to skip validation (the handler then answers, e.g. 404).
+    The check runs after authentication and permissions, so a 304 never leaks
+    anything a 200 wouldn't, and a matching request is answered without
+    serializing the body. Cached bodies are looked up with
+    `validator_source` as their version, see catalog_cache.get_versioned().
+    """
+
+    def get_validators(self, request, *args, **kwargs):
+        return None
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+
+        self.validators = self.validator_source = None
+
+        if request.method not in ('GET', 'HEAD'):
+            return
+
+        validators = self.get_validators(request, *args, **kwargs)
+
+        if validators is None:
+            return
+
+        self.validator_source = validators[0]
+        self.validators = make_validators(request.accepted_media_type, *validators)
+
+        response = get_conditional_response(request, etag=self.validators[0], last_modified=self.validators[1])
+
+        if response is not None:
+            raise _NotModified(response)
+
+    def handle_exception(self, exc):
+
+        if isinstance(exc, _NotModified):
+            return exc.response
+
+        return super().handle_exception(exc)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+
+        validators = getattr(self, 'validators', None)
+
+        if validators:
+            set_validators(response, validators)
+
+        return response
+
+
+class ConditionalListMixin(ConditionalGetMixin):
+    """
+    Conditional GET for paginated generic list views of versioned models.
+
+    The validators are the keys, versions and modification times of the rows
+    on the requested page and whether it has neighbours, read with one narrow
+    keyset query over the same index the page itself uses.
+    """
+
+    def get_validators(self, request, *args, **kwargs):
+
+        queryset = self.filter_queryset(self.get_queryset()).only('version', 'updated_at')
+        rows = self.paginate_queryset(queryset)
+
+        if rows is None:
+            return None
+
+        # The next / previous links depend on rows outside the page
+        links = (getattr(self.paginator, 'has_next', None), getattr(self.paginator, 'has_previous', None))
+        source = "|".join([request.get_full_path(), str(links)] + [f"{row.pk}:{row.version}:{row.updated_at}" for row in rows])
+        last_modified = max((row.updated_at for row in rows), default=None)
+
+        return source, last_modified
@@ -0,0 +1,193 @@
+import decimal
+import functools
+
+from django.core.exceptions import ImproperlyConfigured
+from rest_framework import fields, relations
+from rest_framework.renderers import BrowsableAPIRenderer
+from rest_framework.response import Response
+from rest_framework.settings import api_settings, ISO_8601
+
+from pharmacy_app.timing import TimedJSONRenderer, measure
+
+try:
+    import orjson
+except ImportError:  # Optional, the renderer falls back to the standard library encoder
+    orjson = None
+
+
+class FastJSONRenderer(TimedJSONRenderer):
+    """
+    JSONRenderer encoding with orjson when it's installed.
+
+    The output is byte for byte the one of JSONRenderer: compact separators,
+    non-ASCII characters as they are and U+2028 / U+2029 escaped. Anything
+    orjson can't encode the same way (indented output, NaN, unknown types)
+    goes through JSONRenderer.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+
+        if orjson is None or data is None or self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        with measure('serialize'):
+            try:
+                content = orjson.dumps(data)
+            except TypeError:
+                return super().render(data, accepted_media_type, renderer_context)
+
+        # orjson writes NaN and Infinity as null where JSONRenderer (strict) refuses them
+        if b'null' in content and _has_non_finite(data):
+            return super().render(data, accepted_media_type, renderer_context)
+
+        return content.replace('\u2028'.encode(), b'\\u2028').replace('\u2029'.encode(), b'\\u2029')
+
+
+def _has_non_finite(data):
+
+    if isinstance(data, float):
+        return data != data or data in (float('inf'), float('-inf'))
+    if isinstance(data, dict):
+        return any(_has_non_finite(value) for value in data.values())
+    if isinstance(data, (list, tuple)):
+        return any(_has_non_finite(value) for value in data)
+
+    return False
+
+
+def _decimal_mapper(field):
+    """DecimalField.to_representation() with the quantization worked out once"""
+
+    if not getattr(field, 'coerce_to_string', api_settings.COERCE_DECIMAL_TO_STRING) or field.localize or field.normalize_output:
+        return field.to_representation
+
+    if field.decimal_places is None:
+        return lambda value: '{:f}'.format(value)
+
+    exponent = decimal.Decimal('.1') ** field.decimal_places
+    context = decimal.getcontext().copy()
+    if field.max_digits is not None:
+        context.prec = field.max_digits
+    rounding = field.rounding
+
+    return lambda value: '{:f}'.format(value.quantize(exponent, rounding=rounding, context=context))
+
+
+def _datetime_binder(field):
+    """DateTimeField.to_representation() for aware datetimes, bound to the time zone of the request"""
+
+    output_format = getattr(field, 'format', api_settings.DATETIME_FORMAT)
+    if output_format is None or output_format.lower() != ISO_8601:
+        return lambda: field.to_representation
+
+    def bind():
+        field_timezone = field.timezone if hasattr(field, 'timezone') else field.default_timezone()
+        if field_timezone is None:
+            return field.to_representation
+
+        def to_representation(value):
+            if value.tzinfo is None:
+                return field.to_representation(value)
+            try:
+                value = value.astimezone(field_timezone).isoformat()
+            except OverflowError:
+                return field.to_representation(value)
+            return value[:-6] + 'Z' if value.endswith('+00:00') else value
+
+        return to_representation
+
+    return bind
+
+
+@functools.cache
+def compile_serializer(serializer_class):
+    """
+    Works out how to render rows of `serializer_class` straight from values_list().
+
+    Returns the columns to select, after the primary key the cursor
+    pagination reads as `pk`, and a function turning the selected rows into
+    what `serializer_class(rows, many=True).data` would be. Only flat
+    serializers of model fields and primary key relations are supported.
+    """
+
+    serializer = serializer_class()
+    model = serializer.Meta.model
+    # Mappers are bound at each render, once per field, as the time zone depends on the request
+    names, columns, binders = [], [], []
+
+    for name, field in serializer.fields.items():
+        if field.write_only:
+            continue
+
+        if isinstance(field, relations.PrimaryKeyRelatedField) and field.pk_field is None:
+            column, binder = model._meta.get_field(field.source).attname, None
+        elif isinstance(field, (relations.RelatedField, relations.ManyRelatedField, fields.SerializerMethodField, fields.ReadOnlyField, fields.FileField)) \
+                or field.source == '*' or '.' in field.source:
+            raise ImproperlyConfigured(f"{serializer_class.__name__}.{name} can't be rendered from values")
+        elif isinstance(field, fields.DecimalField):
+            column, binder = field.source, functools.partial(_decimal_mapper, field)
+        elif isinstance(field, fields.DateTimeField):
+            column, binder = field.source, _datetime_binder(field)
+        elif isinstance(field, (fields.CharField, fields.ChoiceField, fields.IntegerField, fields.BooleanField)):
+            # The database already returns the represented type
+            column, binder = field.source, None
+        else:
+            column, binder = field.source, functools.partial(getattr, field, 'to_representation')
+
+        names.append(name)
+        columns.append(column)
+        binders.append(binder)
+
+    bound = [(position, name, binder) for position, (name, binder) in enumerate(zip(names, binders), 1) if binder]
+    plain = [(position, name) for position, (name, binder) in enumerate(zip(names, binders), 1) if not binder]
+
+    def render(rows):
+        results = []
+        converted = [(position, name, binder()) for position, name, binder in bound]
+
+        with measure('serialize'):
+            for row in rows:
+                item = dict.fromkeys(names)
+
+                for position, name in plain:
+                    item[name] = row[position]
+
+                for position, name, mapper in converted:
+                    value = row[position]
+                    if value is not None:
+                        item[name] = mapper(value)
+
+                results.append(item)
+
+        return results
+
+    return ('pk', *columns), render
+
+
+class FastListMixin:
+    """
+    Renders the list of a generic view without building model instances or serializers.
+
+    Rows come from values_list() and are turned into the serializer's
+    representation by the mappers of compile_serializer(), then encoded by
+    FastJSONRenderer. The responses are the same bytes as the serializer
+    path, `fast_list = False` switches a view back to it.
+    """
+
+    fast_list = True
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer]
+
+    def list(self, request, *args, **kwargs):
+
+        if not self.fast_list:
+            return super().list(request, *args, **kwargs)
+
+        columns, render = compile_serializer(self.get_serializer_class())
+        queryset = self.filter_queryset(self.get_queryset()).values_list(*columns, named=True)
+
+        page = self.paginate_queryset(queryset)
+
+        if page is not None:
+            return self.get_paginated_response(render(page))
+
+        return Response(render(queryset))
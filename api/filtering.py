@@ -0,0 +1,41 @@
+from rest_framework import serializers
+
+from pharmacy_app.utils.dates import parse_moment, is_datetime
+
+
+class ListFilterMixin:
+    """
+    Query-parameter filtering for generic list views.
+
+    ?date_from= / ?date_to= (dates are inclusive) filter on `date_field`, the
+    parameters of `FILTERS` match their field exactly. Every supported
+    combination has a composite index starting with the equality field and
+    ending with the date, see the Meta.indexes of the models. Bad values
+    answer 400.
+    """
+
+    date_field = 'created_at'
+    FILTERS = {}
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        params = self.request.query_params
+
+        try:
+            if params.get('date_from'):
+                queryset = queryset.filter(**{f'{self.date_field}__gte': parse_moment(params['date_from'])})
+
+            if params.get('date_to'):
+                lookup = 'lte' if is_datetime(params['date_to']) else 'lt'
+                queryset = queryset.filter(**{f'{self.date_field}__{lookup}': parse_moment(params['date_to'], end=True)})
+        except ValueError as error:
+            raise serializers.ValidationError({"error": f"Invalid date {error}"})
+
+        try:
+            for param, field in self.FILTERS.items():
+                if params.get(param):
+                    queryset = queryset.filter(**{field: params[param]})
+        except ValueError as error:
+            raise serializers.ValidationError({"error": str(error)})
+
+        return queryset
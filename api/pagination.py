@@ -0,0 +1,17 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Cursor pagination over the primary key.
+
+    Each page is a `WHERE pk < last seen pk ORDER BY pk DESC LIMIT n` query on
+    the primary key index, so deep pages cost the same as the first one and no
+    COUNT(*) is ever issued. Views ordered by another indexed, unique column
+    override `ordering`.
+    """
+
+    ordering = '-pk'
+    page_size_query_param = 'page_size'
+    max_page_size = getattr(settings, 'API_MAX_PAGE_SIZE', 1000)
@@ -1,17 +1,21 @@
 from django.urls import path
-from . import views
+from . import async_views, views
 
 urlpatterns = [
     path('api/staffs/', views.ListCreateStaffs.as_view()),
     path('api/staffs/<int:staff_id>/', views.StaffDetailView.as_view()),
 
     path('api/products/', views.ListCreateProducts.as_view()),
+    path('api/products/search/', views.ProductSearchView.as_view()),
+    path('api/products/by-barcode/<str:code>/', views.ProductByBarcodeView.as_view()),
     path('api/products/<int:product_id>/', views.ProductDetailView.as_view()),
 
     path('api/categories/', views.ListCreateCategories.as_view()),
     path('api/categories/<int:category_id>/', views.CategoryDetailView.as_view()),
 
     path('api/sales/', views.ListCreateSales.as_view()),
+    path('api/sales/bulk/', views.BulkCreateSales.as_view()),
+    path('api/sales/by-code/<str:code>/', views.SaleByCodeView.as_view()),
     path('api/sales/<int:sale_id>/', views.SaleDetailView.as_view()),
 
     path('api/sales/<int:sale_id>/products/', views.SaleProductView.as_view()),
@@ -27,5 +31,25 @@ urlpatterns = [
     path('api/price-history/recorder/<int:recorder_id>/product/<int:product_id>/', views.ProductPriceHistoryByProductByRecorder.as_view()),
 
     path('api/product-batches/', views.ListCreateProductBatches.as_view()),
+    path('api/product-barcodes/', views.ListCreateProductBarcodes.as_view()),
+
+    path('api/stock/check/', views.StockCheckView.as_view()),
+
+    path('api/export/sales/', views.ExportSales.as_view()),
+    path('api/export/sale-products/', views.ExportSaleProducts.as_view()),
+    path('api/export/product-batches/', views.ExportProductBatches.as_view()),
+    path('api/export/archived-product-batches/', views.ExportArchivedProductBatches.as_view()),
+
+    path('api/reports/totals/', views.SalesTotalsReport.as_view()),
+    path('api/reports/timeseries/', views.SalesTimeSeriesReport.as_view()),
+    path('api/reports/margins/', views.MarginReport.as_view()),
+
+    path('api/admin/db-pool/', views.DatabasePoolStats.as_view()),
+
+    # Async read endpoints, for serving under ASGI
+    path('api/async/products/<int:product_id>/', async_views.AsyncProductDetailView.as_view()),
+    path('api/async/categories/<int:category_id>/', async_views.AsyncCategoryDetailView.as_view()),
+    path('api/async/sales/<int:sale_id>/', async_views.AsyncSaleDetailView.as_view()),
+    path('api/async/stock/check/', async_views.AsyncStockCheckView.as_view()),
 
 ]
\ No newline at end of file
@@ -1,19 +1,34 @@
-from django.db import models
-from django.utils.timezone import override
-from rest_framework import generics, status
+import json
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import DatabaseError, connections, models, transaction
+from django.http import HttpResponse, StreamingHttpResponse
+from rest_framework import exceptions, generics, serializers, status
 from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
 from rest_framework.views import APIView
 
 from pharmacy_app.models import (
-        Staff, Product, Category, Sale, SaleProduct, ProductPriceHistory, ProductBatch
+        Staff, Product, ProductBarcode, Category, Sale, SaleProduct, ProductPriceHistory, ProductBatch, SalesRollup, \
+        BatchAllocation, ArchivedProductBatch
     )
 from pharmacy_app.serializers import (
     StaffSerializer, ProductSerializer, CategorySerializer, ProductBatchSerializer, \
     SaleSerializer, SaleProductSerializer, ProductPriceHistorySerializer, ProductListSerializer, \
-    SaleExtendedSerializer, SaleCreateSerializer
+    SaleExtendedSerializer, SaleCreateSerializer, StockCheckSerializer, ProductBarcodeSerializer
 )
+from api.conditional import ConditionalGetMixin, ConditionalListMixin
+from api.fast import FastListMixin
+from api.filtering import ListFilterMixin
+from pharmacy_app import catalog_cache, search
 from pharmacy_app.permissions import IsOwnerOrAdmin, IsWarehouseOrAdmin
+from pharmacy_app.routers import read_from_replica
+from pharmacy_app.stock import check_availability, get_sellable
+from pharmacy_app.utils.dates import parse_moment, is_datetime
+from pharmacy_app.utils.export import EXPORT_FORMATS
+from pharmacy_app.utils.ndjson import iter_ndjson, chunked
 
 
 class ListCreateStaffs(generics.ListCreateAPIView):
@@ -77,15 +92,80 @@ class StaffDetailView(APIView):
         return Response({"success":"Staff removed"}, status=status.HTTP_204_NO_CONTENT)
 
 
-class ListCreateProducts(generics.ListCreateAPIView):
+class ListCreateProducts(ConditionalListMixin, FastListMixin, generics.ListCreateAPIView):
     """Handles listing all products"""
 
     permission_classes = [IsAuthenticated, IsWarehouseOrAdmin]
     queryset = Product.objects.all()
     serializer_class = ProductListSerializer
 
+    # Serve list pages from the catalog cache
+    def list(self, request, *args, **kwargs):
+
+        key = catalog_cache.list_key('products', request.build_absolute_uri())
+        payload = catalog_cache.get_versioned(
+            key, self.validator_source, lambda: super(ListCreateProducts, self).list(request, *args, **kwargs).data
+        )
+
+        return Response(payload, status=status.HTTP_200_OK)
+
+
+class ProductSearchView(APIView):
+    """Typeahead lookup of products by partial title or category (?q=, ?limit=)"""
+
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+
+        try:
+            limit = min(max(int(request.query_params.get('limit', 10)), 1), 50)
+        except ValueError:
+            return Response({"error": "limit must be a number"}, status.HTTP_400_BAD_REQUEST)
+
+        matches = search.search_products(request.query_params.get('q', ''), limit)
+
+        return Response({
+            "results": [
+                {
+                    "id": product_id,
+                    "title": title,
+                    "category": {"id": category_id, "title": category_title} if category_id is not None else None,
+                }
+                for product_id, title, category_id, category_title in matches
+            ]
+        }, status=status.HTTP_200_OK)
+
 
-class ProductDetailView(APIView):
+class ProductByBarcodeView(APIView):
+    """Resolves a scanned barcode to its product with the prices and stock it can be sold at"""
+
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, code):
+
+        cache = catalog_cache.get_cache()
+        payload = None
+
+        # Hot path: barcode -> product id -> sellable payload, both from the cache
+        product_id = cache.get(catalog_cache.barcode_key(code))
+        if product_id is not None:
+            payload = catalog_cache.get_or_build(
+                catalog_cache.sellable_key(product_id), lambda: get_sellable(id=product_id)
+            )
+
+        if payload is None:
+            payload = get_sellable(barcodes__code=code)
+
+            if payload is None:
+                return Response({"error": "Barcode does not exist"}, status.HTTP_404_NOT_FOUND)
+
+            cache.set(catalog_cache.barcode_key(code), payload['id'], getattr(settings, 'CATALOG_CACHE_TIMEOUT', 300))
+            catalog_cache.put(catalog_cache.sellable_key(payload['id']), payload)
+
+        return Response({**payload, "barcode": code}, status=status.HTTP_200_OK)
+
+
+class ProductDetailView(ConditionalGetMixin, APIView):
     """Handles retrieving, updating, deleting the products"""
 
     permission_classes = [IsAuthenticated, IsWarehouseOrAdmin]
@@ -98,17 +178,35 @@ class ProductDetailView(APIView):
         except Product.DoesNotExist:
             return None
 
+    def get_validators(self, request, product_id):
+
+        # The payload nests the category, its changes have to show up too
+        row = Product.objects.filter(id=product_id).values_list(
+            'version', 'updated_at', 'category__version', 'category__updated_at'
+        ).first()
+
+        if row is None:
+            return None
+
+        version, updated_at, category_version, category_updated_at = row
+
+        return f"product:{product_id}:{version}:{updated_at}:{category_version}:{category_updated_at}", max(filter(None, (updated_at, category_updated_at)))
+
+    def get_product_payload(self, product_id):
+        product = self.get_product_object(product_id)
+        return ProductSerializer(product, many=False).data if product else None
+
     # Retrieve a product
     def get(self, request, product_id):
 
-        product = self.get_product_object(product_id)
+        payload = catalog_cache.get_versioned(
+            catalog_cache.product_key(product_id), self.validator_source, lambda: self.get_product_payload(product_id)
+        )
 
-        if not product:
+        if payload is None:
             return Response({"error": "Product does not exist"}, status.HTTP_404_NOT_FOUND)
 
-        serializer = ProductSerializer(product, many=False)
-
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        return Response(payload, status=status.HTTP_200_OK)
 
     # Update a product
     def put(self, request, product_id):
@@ -139,14 +237,24 @@ class ProductDetailView(APIView):
         return Response({"success: Product deleted"}, status=status.HTTP_204_NO_CONTENT)
 
 
-class ListCreateCategories(generics.ListCreateAPIView):
+class ListCreateCategories(ConditionalListMixin, generics.ListCreateAPIView):
     """Handles listing all categories"""
 
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
     permission_classes = [IsAuthenticated, IsWarehouseOrAdmin]
 
-class CategoryDetailView(APIView):
+    # Serve list pages from the catalog cache
+    def list(self, request, *args, **kwargs):
+
+        key = catalog_cache.list_key('categories', request.build_absolute_uri())
+        payload = catalog_cache.get_versioned(
+            key, self.validator_source, lambda: super(ListCreateCategories, self).list(request, *args, **kwargs).data
+        )
+
+        return Response(payload, status=status.HTTP_200_OK)
+
+class CategoryDetailView(ConditionalGetMixin, APIView):
     """Handles retrieving, updating, deleting the category"""
 
     permission_classes = [IsAuthenticated, IsWarehouseOrAdmin]
@@ -157,17 +265,30 @@ class CategoryDetailView(APIView):
         except Category.DoesNotExist:
             return None
 
+    def get_validators(self, request, category_id):
+
+        row = Category.objects.filter(id=category_id).values_list('version', 'updated_at').first()
+
+        if row is None:
+            return None
+
+        return f"category:{category_id}:{row[0]}:{row[1]}", row[1]
+
+    def get_category_payload(self, category_id):
+        category = self.get_category_object(category_id)
+        return CategorySerializer(category, many=False).data if category else None
+
     # Retrieve a category
     def get(self, request, category_id):
 
-        category = self.get_category_object(category_id)
+        payload = catalog_cache.get_versioned(
+            catalog_cache.category_key(category_id), self.validator_source, lambda: self.get_category_payload(category_id)
+        )
 
-        if not category:
+        if payload is None:
             return Response({"error": "Category does not exist"}, status.HTTP_404_NOT_FOUND)
 
-        serializer = CategorySerializer(category, many=False)
-
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        return Response(payload, status=status.HTTP_200_OK)
 
     # Update a category
     def put(self, request, category_id):
@@ -197,13 +318,19 @@ class CategoryDetailView(APIView):
         return Response({"success: Category deleted"}, status=status.HTTP_204_NO_CONTENT)
 
 
-class ListCreateSales(generics.ListCreateAPIView):
-    """Handles listing all sales"""
+class ListCreateSales(ConditionalListMixin, ListFilterMixin, FastListMixin, generics.ListCreateAPIView):
+    """Handles listing all sales, filtered by ?date_from= / ?date_to=, ?recorder=, ?status= and ?payment_type="""
 
     queryset = Sale.objects.all()
     serializer_class = SaleSerializer
     permission_classes = [IsAuthenticated, IsWarehouseOrAdmin]
 
+    FILTERS = {
+        'recorder': 'recorder_id',
+        'status': 'status',
+        'payment_type': 'payment_type',
+    }
+
     def create(self, request, *args, **kwargs):
         serializer = SaleCreateSerializer(data=request.data, context={'request': request})
         if serializer.is_valid():
@@ -212,7 +339,94 @@ class ListCreateSales(generics.ListCreateAPIView):
             return Response(serializer2.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-class SaleDetailView(APIView):
+class BulkCreateSales(APIView):
+    """
+    Ingests sales recorded offline by a POS terminal.
+
+    The body is NDJSON, one sale per line in the same shape as POST /api/sales/
+    plus an optional client "ref". Lines are parsed as they arrive and
+    committed in chunks (?chunk_size=), every sale in its own savepoint so a
+    rejected sale doesn't roll back the rest of its chunk. The response holds
+    one NDJSON result per sale, sent once everything is ingested so the writes
+    run inside the request (current user, routing, timings, metrics). A sale
+    answered 201 is committed, any other status means it wasn't saved.
+    """
+
+    permission_classes = [IsAuthenticated, IsWarehouseOrAdmin]
+
+    def get_chunk_size(self, request):
+        chunk_size = getattr(settings, 'BULK_SALES_CHUNK_SIZE', 200)
+        max_chunk_size = getattr(settings, 'BULK_SALES_MAX_CHUNK_SIZE', 1000)
+
+        try:
+            chunk_size = int(request.query_params.get('chunk_size', chunk_size))
+        except ValueError:
+            pass
+
+        return max(1, min(chunk_size, max_chunk_size))
+
+    def ingest_chunk(self, request, chunk):
+
+        # Load every product of the chunk with a single query
+        product_ids = set()
+        for index, document, error in chunk:
+            for item in (document or {}).get('items') or []:
+                try:
+                    product_ids.add(int(item.get('product')))
+                except (AttributeError, TypeError, ValueError):
+                    continue
+
+        context = {'request': request, 'products': Product.objects.in_bulk(product_ids)}
+        results = []
+
+        try:
+            with transaction.atomic():
+                for index, document, error in chunk:
+                    result = {"index": index, "ref": (document or {}).get('ref')}
+
+                    if error:
+                        results.append({**result, "status": status.HTTP_400_BAD_REQUEST, "errors": {"detail": error}})
+                        continue
+
+                    serializer = SaleCreateSerializer(data=document, context=context)
+
+                    try:
+                        with transaction.atomic():
+                            serializer.is_valid(raise_exception=True)
+                            sale = serializer.save()
+                    except exceptions.APIException as error:
+                        # Invalid sale (400) or stock still changing under it (409)
+                        results.append({**result, "status": error.status_code, "errors": error.detail})
+                        continue
+                    except DatabaseError as error:
+                        results.append({**result, "status": status.HTTP_500_INTERNAL_SERVER_ERROR, "errors": {"detail": str(error)}})
+                        continue
+
+                    results.append({**result, "status": status.HTTP_201_CREATED, "sale": SaleSerializer(sale).data})
+        except DatabaseError as error:
+            # The chunk couldn't be committed, none of its sales were saved
+            return [
+                {
+                    "index": index, "ref": (document or {}).get('ref'),
+                    "status": status.HTTP_500_INTERNAL_SERVER_ERROR, "errors": {"detail": str(error)}
+                }
+                for index, document, _ in chunk
+            ]
+
+        return results
+
+    def post(self, request):
+
+        lines = [
+            json.dumps(result, cls=JSONEncoder) + "\n"
+            for chunk in chunked(iter_ndjson(request.stream or []), self.get_chunk_size(request))
+            for result in self.ingest_chunk(request, chunk)
+        ]
+
+        return HttpResponse(lines, content_type='application/x-ndjson')
+
+
+class SaleDetailView(ConditionalGetMixin, APIView):
     """Handles retrieving and updating individual sales"""
 
     permission_classes = [IsAuthenticated, IsWarehouseOrAdmin]
@@ -224,6 +438,21 @@ class SaleDetailView(APIView):
         except Sale.DoesNotExist:
             return None
 
+    def get_validators(self, request, sale_id):
+
+        # Changes to the items bump the sale, the names shown for them come from the products
+        row = Sale.objects.filter(sale_id=sale_id).values_list('version', 'updated_at').annotate(
+            products_updated_at=models.Max('sale_products__product__updated_at'),
+            categories_updated_at=models.Max('sale_products__product__category__updated_at'),
+        ).order_by('sale_id').first()
+
+        if row is None:
+            return None
+
+        version, *moments = row
+
+        return f"sale:{sale_id}:{version}:{moments}", max(filter(None, moments))
+
     # Retrieve a sale
     def get(self, request, sale_id):
 
@@ -260,32 +489,59 @@ class SaleDetailView(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class SaleProductView(APIView):
-    """Retrieves SaleProducts by sale_id"""
+# Filters of the sale item lists, the cashier and payment type are the sale's
+SALE_PRODUCT_FILTERS = {
+    'recorder': 'sale__recorder_id',
+    'status': 'status',
+    'payment_type': 'sale__payment_type',
+}
 
-    permission_classes = [IsAuthenticated]
+class SaleByCodeView(SaleDetailView):
+    """Retrieves a sale by the code printed on its receipt"""
+
+    http_method_names = ['get', 'head', 'options']
 
-    def get(self, *args, **kwargs):
+    def initial(self, request, *args, code=None, **kwargs):
 
-        saleproduct = SaleProduct.objects.filter(sale_id=self.kwargs['sale_id'])
-        serializer = SaleProductSerializer(saleproduct, many=True)
+        # One lookup on the unique code index, then it's the sale detail
+        self.sale_id = Sale.objects.filter(code=code).values_list('sale_id', flat=True).first()
 
-        return Response(serializer.data,status=status.HTTP_200_OK)
+        super().initial(request, *args, sale_id=self.sale_id, **kwargs)
 
-class ProductSaleView(APIView):
-    """Retrieves SaleProducts by product_id"""
+    def get(self, request, code):
+
+        if self.sale_id is None:
+            return Response({"error": "Sale does not exist"}, status.HTTP_404_NOT_FOUND)
+
+        return super().get(request, self.sale_id)
+
+
+@read_from_replica
+class SaleProductView(ListFilterMixin, FastListMixin, generics.ListAPIView):
+    """Retrieves SaleProducts by sale_id, filtered by ?date_from= / ?date_to=, ?recorder=, ?status= and ?payment_type="""
 
     permission_classes = [IsAuthenticated]
+    serializer_class = SaleProductSerializer
 
-    def get(self, *args, **kwargs):
+    FILTERS = SALE_PRODUCT_FILTERS
 
-        saleproduct = SaleProduct.objects.filter(product_id=self.kwargs['product_id'])
-        serializer = SaleProductSerializer(saleproduct, many=True)
+    def get_queryset(self):
+        return SaleProduct.objects.filter(sale_id=self.kwargs['sale_id'])
+
+@read_from_replica
+class ProductSaleView(ListFilterMixin, FastListMixin, generics.ListAPIView):
+    """Retrieves SaleProducts by product_id, filtered by ?date_from= / ?date_to=, ?recorder=, ?status= and ?payment_type="""
 
-        return Response(serializer.data,status=status.HTTP_200_OK)
+    permission_classes = [IsAuthenticated]
+    serializer_class = SaleProductSerializer
+
+    FILTERS = SALE_PRODUCT_FILTERS
+
+    def get_queryset(self):
+        return SaleProduct.objects.filter(product_id=self.kwargs['product_id'])
 
 
-class ListCreateSaleProducts(generics.ListCreateAPIView):
+class ListCreateSaleProducts(FastListMixin, generics.ListCreateAPIView):
     """Lists all the SaleProducts"""
 
     queryset = SaleProduct.objects.all()
@@ -344,7 +600,8 @@ class SaleProductDetailView(APIView):
         sale_product.delete()
         return Response({"success: SaleProduct deleted"}, status=status.HTTP_204_NO_CONTENT)
 
-class ListProductPriceHistory(generics.ListAPIView):
+@read_from_replica
+class ListProductPriceHistory(ConditionalListMixin, generics.ListAPIView):
     """Retrieves the list oll price changes"""
 
     queryset = ProductPriceHistory.objects.all()
@@ -352,7 +609,7 @@ class ListProductPriceHistory(generics.ListAPIView):
     serializer_class = ProductPriceHistorySerializer
 
 
-class ProductPriceHistoryDetailView(APIView):
+class ProductPriceHistoryDetailView(ConditionalGetMixin, APIView):
     """Retrieves, updates, deletes singular ProductPriceHistory"""
 
     permission_classes = [IsAuthenticated, IsWarehouseOrAdmin]
@@ -364,6 +621,15 @@ class ProductPriceHistoryDetailView(APIView):
         except ProductPriceHistory.DoesNotExist:
             return None
 
+    def get_validators(self, request, id):
+
+        row = ProductPriceHistory.objects.filter(id=id).values_list('version', 'updated_at').first()
+
+        if row is None:
+            return None
+
+        return f"price-history:{id}:{row[0]}:{row[1]}", row[1]
+
     # Retrieves a ProductPriceHistory
     def get(self, request, id):
 
@@ -389,47 +655,376 @@ class ProductPriceHistoryDetailView(APIView):
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
-class ProductPriceHistoryByProduct(generics.ListAPIView):
+@read_from_replica
+class ProductPriceHistoryByProduct(ConditionalListMixin, generics.ListAPIView):
     """Returns all price-history for a product"""
 
     permission_classes = [IsAuthenticated, IsWarehouseOrAdmin]
     serializer_class = ProductPriceHistorySerializer
 
-    @override
     def get_queryset(self):
         product_id = self.kwargs['product_id']
         qs = ProductPriceHistory.objects.filter(product_id=product_id)
         return qs
 
 
-class ProductPriceHistoryByRecorder(generics.ListAPIView):
+@read_from_replica
+class ProductPriceHistoryByRecorder(ConditionalListMixin, generics.ListAPIView):
     """Returns all price-history by recorder"""
 
     permission_classes = [IsAuthenticated, IsWarehouseOrAdmin]
     serializer_class = ProductPriceHistorySerializer
 
-    @override
     def get_queryset(self):
         recorder_id = self.kwargs['recorder_id']
         qs = ProductPriceHistory.objects.filter(recorder_id=recorder_id)
         return qs
 
 
-class ProductPriceHistoryByProductByRecorder(generics.ListAPIView):
+@read_from_replica
+class ProductPriceHistoryByProductByRecorder(ConditionalListMixin, generics.ListAPIView):
     """Returns all price-history for a product by a recorder"""
 
     permission_classes = [IsAuthenticated, IsWarehouseOrAdmin]
     serializer_class = ProductPriceHistorySerializer
 
-    @override
     def get_queryset(self):
         product_id = self.kwargs['product_id']
         recorder_id = self.kwargs['recorder_id']
         qs = ProductPriceHistory.objects.filter(recorder_id=recorder_id, product_id=product_id)
         return qs
 
-class ListCreateProductBatches(generics.ListCreateAPIView):
+class ListCreateProductBatches(ConditionalListMixin, FastListMixin, generics.ListCreateAPIView):
 
     queryset = ProductBatch.objects.all()
     serializer_class = ProductBatchSerializer
-    permission_classes = [IsAuthenticated, IsWarehouseOrAdmin]
\ No newline at end of file
+    permission_classes = [IsAuthenticated, IsWarehouseOrAdmin]
+
+
+class ListCreateProductBarcodes(generics.ListCreateAPIView):
+
+    queryset = ProductBarcode.objects.all()
+    serializer_class = ProductBarcodeSerializer
+    permission_classes = [IsAuthenticated, IsWarehouseOrAdmin]
+
+
+class StockCheckView(APIView):
+    """Pre-validates a whole basket against the stock in one round trip"""
+
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+
+        serializer = StockCheckSerializer(data=request.data)
+
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        lines = check_availability(
+            (item['product'], item['retailPrice'], item['quantity'])
+            for item in serializer.validated_data['items']
+        )
+
+        for line in lines:
+            for key in ('retailPrice', 'requested', 'available'):
+                line[key] = str(line[key])
+
+        return Response({
+            "available": all(line['sufficient'] for line in lines),
+            "items": lines,
+        }, status=status.HTTP_200_OK)
+
+
+@read_from_replica
+class ExportView(APIView):
+    """
+    Streams every row of `queryset` as CSV or NDJSON (?output=).
+
+    Rows are read as `columns` tuples through a server-side cursor and written
+    out as they arrive, so memory stays flat regardless of the export size.
+    Supports ?date_from= / ?date_to= on `date_field` (dates are inclusive) and
+    ?status= on `status_field`.
+    """
+
+    permission_classes = [IsAuthenticated, IsWarehouseOrAdmin]
+
+    queryset = None
+    columns = ()
+    date_field = None
+    status_field = None
+    filename = 'export'
+
+    def filter_queryset(self, queryset, params):
+
+        if params.get('date_from'):
+            queryset = queryset.filter(**{f'{self.date_field}__gte': parse_moment(params['date_from'])})
+
+        if params.get('date_to'):
+            lookup = 'lte' if is_datetime(params['date_to']) else 'lt'
+            queryset = queryset.filter(**{f'{self.date_field}__{lookup}': parse_moment(params['date_to'], end=True)})
+
+        if params.get('status'):
+            queryset = queryset.filter(**{self.status_field: params['status']})
+
+        return queryset
+
+    def get(self, request):
+
+        output = request.query_params.get('output', 'csv')
+
+        if output not in EXPORT_FORMATS:
+            return Response({"error": f"Unsupported output {output}"}, status.HTTP_400_BAD_REQUEST)
+
+        try:
+            queryset = self.filter_queryset(self.queryset.all(), request.query_params)
+        except ValueError as error:
+            return Response({"error": f"Invalid date {error}"}, status.HTTP_400_BAD_REQUEST)
+
+        # The rows are read after the view returns, outside the request's database routing
+        queryset = queryset.using(queryset.db)
+
+        rows = queryset.order_by('pk').values_list(*self.columns).iterator(
+            chunk_size=getattr(settings, 'EXPORT_CHUNK_SIZE', 2000)
+        )
+
+        headers = [column.replace('__', '_') for column in self.columns]
+
+        stream, content_type = EXPORT_FORMATS[output]
+        response = StreamingHttpResponse(stream(headers, rows), content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="{self.filename}.{output}"'
+
+        return response
+
+
+class ExportSales(ExportView):
+    """Exports the sales"""
+
+    queryset = Sale.objects.all()
+    columns = ('sale_id', 'code', 'created_at', 'totalAmount', 'status', 'payment_type', 'recorder_id')
+    date_field = 'created_at'
+    status_field = 'status'
+    filename = 'sales'
+
+
+class ExportSaleProducts(ExportView):
+    """Exports the sale lines, filtered by their creation date (only the matching partitions are read)"""
+
+    queryset = SaleProduct.objects.all()
+    columns = ('id', 'sale_id', 'sale__created_at', 'product_id', 'quantity', 'retailPrice', 'status', 'created_at')
+    date_field = 'created_at'
+    status_field = 'status'
+    filename = 'sale-products'
+
+
+class ExportProductBatches(ExportView):
+    """Exports the product batches, ?status= filters by source"""
+
+    queryset = ProductBatch.objects.all()
+    columns = (
+        'id', 'product_id', 'recorder_id', 'quantity', 'unitPrice', 'retailPrice', 'source', 'arrival_date'
+    )
+    date_field = 'arrival_date'
+    status_field = 'source'
+    filename = 'product-batches'
+
+
+class ExportArchivedProductBatches(ExportView):
+    """Exports the archived (depleted) product batches, ?status= filters by source"""
+
+    queryset = ArchivedProductBatch.objects.all()
+    columns = (
+        'id', 'product_id', 'recorder_id', 'quantity', 'unitPrice', 'retailPrice', 'source', 'arrival_date', 'archived_at'
+    )
+    date_field = 'arrival_date'
+    status_field = 'source'
+    filename = 'archived-product-batches'
+
+
+@read_from_replica
+class SalesReportView(APIView):
+    """
+    Base for the reports served from the sales rollups.
+
+    Filters: ?date_from= / ?date_to= (dates are inclusive), ?product=,
+    ?category=, ?recorder= and ?payment_type=.
+    """
+
+    permission_classes = [IsAuthenticated, IsWarehouseOrAdmin]
+
+    FILTERS = {
+        'product': 'product_id',
+        'category': 'product__category_id',
+        'recorder': 'recorder_id',
+        'payment_type': 'payment_type',
+    }
+
+    TOTALS = {
+        'sold_quantity': models.Sum('sold_quantity'),
+        'sold_amount': models.Sum('sold_amount'),
+        'sold_lines': models.Sum('sold_lines'),
+        'returned_quantity': models.Sum('returned_quantity'),
+        'returned_amount': models.Sum('returned_amount'),
+        'returned_lines': models.Sum('returned_lines'),
+    }
+
+    def get_rollups(self, params, granularity):
+
+        queryset = SalesRollup.objects.filter(granularity=granularity)
+
+        if params.get('date_from'):
+            queryset = queryset.filter(period__gte=parse_moment(params['date_from']))
+
+        if params.get('date_to'):
+            lookup = 'period__lte' if is_datetime(params['date_to']) else 'period__lt'
+            queryset = queryset.filter(**{lookup: parse_moment(params['date_to'], end=True)})
+
+        for param, field in self.FILTERS.items():
+            if params.get(param):
+                queryset = queryset.filter(**{field: params[param]})
+
+        return queryset
+
+    def format_totals(self, row):
+        row = {key: (value if value is not None else 0) for key, value in row.items()}
+        row['net_amount'] = row['sold_amount'] - row['returned_amount']
+
+        return {
+            key: (str(Decimal(value).quantize(Decimal('0.01'))) if key.endswith(('quantity', 'amount')) else value)
+            for key, value in row.items()
+        }
+
+
+class SalesTotalsReport(SalesReportView):
+    """Returns the sales totals, overall or per ?group_by=product|category|recorder|payment_type"""
+
+    def get(self, request):
+
+        params = request.query_params
+        group_by = params.get('group_by')
+
+        if group_by and group_by not in self.FILTERS:
+            return Response({"error": f"Unsupported group_by {group_by}"}, status.HTTP_400_BAD_REQUEST)
+
+        # Daily rollups are enough unless the range starts or ends mid-day
+        granularity = SalesRollup.GranularityChoices.DAY
+        if any(is_datetime(params.get(param, '')) for param in ('date_from', 'date_to')):
+            granularity = SalesRollup.GranularityChoices.HOUR
+
+        try:
+            queryset = self.get_rollups(params, granularity)
+        except ValueError as error:
+            return Response({"error": f"Invalid date {error}"}, status.HTTP_400_BAD_REQUEST)
+
+        if not group_by:
+            return Response(self.format_totals(queryset.aggregate(**self.TOTALS)), status=status.HTTP_200_OK)
+
+        field = self.FILTERS[group_by]
+        rows = queryset.values(field).annotate(**self.TOTALS).order_by(field)
+
+        # Rollups store a missing product or cashier as 0
+        return Response([
+            {group_by: row.pop(field) or None, **self.format_totals(row)} for row in rows
+        ], status=status.HTTP_200_OK)
+
+
+class SalesTimeSeriesReport(SalesReportView):
+    """Returns the sales totals per period, ?granularity=hour|day"""
+
+    def get(self, request):
+
+        granularity = request.query_params.get('granularity', 'day').capitalize()
+
+        if granularity not in SalesRollup.GranularityChoices.values:
+            return Response({"error": f"Unsupported granularity {granularity}"}, status.HTTP_400_BAD_REQUEST)
+
+        try:
+            queryset = self.get_rollups(request.query_params, granularity)
+        except ValueError as error:
+            return Response({"error": f"Invalid date {error}"}, status.HTTP_400_BAD_REQUEST)
+
+        rows = queryset.values('period').annotate(**self.TOTALS).order_by('period')
+
+        return Response([
+            {'period': row.pop('period'), **self.format_totals(row)} for row in rows
+        ], status=status.HTTP_200_OK)
+
+
+@read_from_replica
+class MarginReport(APIView):
+    """
+    Returns revenue, cost of goods and gross margin from the batch allocations.
+
+    Overall or per ?group_by=sale|product|recorder, filtered by ?date_from= /
+    ?date_to= (dates are inclusive), ?sale=, ?product= and ?recorder=.
+    """
+
+    permission_classes = [IsAuthenticated, IsWarehouseOrAdmin]
+
+    GROUPS = {
+        'sale': 'sale_product__sale_id',
+        'product': 'product_id',
+        'recorder': 'sale_product__sale__recorder_id',
+    }
+
+    TOTALS = {
+        'total_quantity': models.Sum('quantity'),
+        'revenue': models.Sum(models.F('quantity') * models.F('retailPrice')),
+        'cost': models.Sum(models.F('quantity') * models.F('unitPrice')),
+    }
+
+    def format_totals(self, row):
+        row = {key: Decimal(row[key] or 0).quantize(Decimal('0.01')) for key in self.TOTALS}
+        row['margin'] = row['revenue'] - row['cost']
+
+        return {key: str(value) for key, value in row.items()}
+
+    def get(self, request):
+
+        params = request.query_params
+        group_by = params.get('group_by')
+
+        if group_by and group_by not in self.GROUPS:
+            return Response({"error": f"Unsupported group_by {group_by}"}, status.HTTP_400_BAD_REQUEST)
+
+        queryset = BatchAllocation.objects.all()
+
+        try:
+            if params.get('date_from'):
+                queryset = queryset.filter(created_at__gte=parse_moment(params['date_from']))
+
+            if params.get('date_to'):
+                lookup = 'created_at__lte' if is_datetime(params['date_to']) else 'created_at__lt'
+                queryset = queryset.filter(**{lookup: parse_moment(params['date_to'], end=True)})
+        except ValueError as error:
+            return Response({"error": f"Invalid date {error}"}, status.HTTP_400_BAD_REQUEST)
+
+        for param, field in self.GROUPS.items():
+            if params.get(param):
+                queryset = queryset.filter(**{field: params[param]})
+
+        if not group_by:
+            return Response(self.format_totals(queryset.aggregate(**self.TOTALS)), status=status.HTTP_200_OK)
+
+        field = self.GROUPS[group_by]
+        rows = queryset.values(field).annotate(**self.TOTALS).order_by(field)
+
+        return Response([
+            {group_by: row[field], **self.format_totals(row)} for row in rows
+        ], status=status.HTTP_200_OK)
+
+
+class DatabasePoolStats(APIView):
+    """Reports the connection pool of every database, for this worker process"""
+
+    permission_classes = [IsAuthenticated, IsAdminUser]
+
+    def get(self, request):
+
+        pools = {}
+
+        for alias in connections:
+            # Only the PostgreSQL backend has pools, None when pooling is off
+            pool = getattr(connections[alias], 'pool', None)
+            pools[alias] = pool.get_stats() if pool is not None else None
+
+        return Response(pools, status=status.HTTP_200_OK)
@@ -9,10 +9,14 @@ https://docs.djangoproject.com/en/5.1/topics/settings/
 For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
+import importlib.util
 import os.path
+import sys
 from pathlib import Path
 from datetime import timedelta
 
+from pharmacy_app.utils.sampling import should_profile
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -26,6 +30,8 @@ SECRET_KEY = 'django-insecure-_sgv4c4l(&vl3@8f046&660qu+*6ed&&!k8g(buem=6^di=vm4
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
 
+TESTING = sys.argv[1:2] == ['test']
+
 ALLOWED_HOSTS = []
 
 
@@ -48,6 +54,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'pharmacy_app.metrics.MetricsMiddleware',
+    'pharmacy_app.timing.ServerTimingMiddleware',
+    'pharmacy_app.profiling.SlowRequestProfilingMiddleware',
     'silk.middleware.SilkyMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -57,6 +66,7 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'pharmacy_app.middleware.CurrentUserMiddleware',
+    'pharmacy_app.middleware.ReplicaRoutingMiddleware',
     "debug_toolbar.middleware.DebugToolbarMiddleware",
 ]
 
@@ -88,13 +98,116 @@ WSGI_APPLICATION = 'django_pharmacy.wsgi.application'
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.postgresql',
-        'NAME': 'pharmacy_db',
-        'USER': 'postgres',
-        'PASSWORD': '1649',
-        'HOST': 'localhost',
+        'NAME': os.environ.get('DB_NAME', 'pharmacy_db'),
+        'USER': os.environ.get('DB_USER', 'postgres'),
+        'PASSWORD': os.environ.get('DB_PASSWORD', '1649'),
+        'HOST': os.environ.get('DB_HOST', 'localhost'),
+        'PORT': os.environ.get('DB_PORT', ''),
+        # Validate connections before reusing them (pool checkout or persistent connection)
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {},
+    }
+}
+
+# Connection pooling (psycopg 3). Every worker process has its own pool, so workers x
+# DB_POOL_MAX_SIZE must stay below the server's max_connections. Without psycopg_pool,
+# or with DB_POOL=0, connections are kept open per thread for DB_CONN_MAX_AGE seconds.
+DB_POOL = os.environ.get('DB_POOL', '1' if importlib.util.find_spec('psycopg_pool') else '0') == '1'
+
+if DB_POOL:
+    DATABASES['default']['OPTIONS']['pool'] = {
+        'min_size': int(os.environ.get('DB_POOL_MIN_SIZE', 2)),
+        'max_size': int(os.environ.get('DB_POOL_MAX_SIZE', 10)),
+        # Seconds a request waits for a free connection before failing
+        'timeout': float(os.environ.get('DB_POOL_TIMEOUT', 5)),
+        # Seconds before idle connections above min_size are closed / any connection is recycled
+        'max_idle': float(os.environ.get('DB_POOL_MAX_IDLE', 300)),
+        'max_lifetime': float(os.environ.get('DB_POOL_MAX_LIFETIME', 1800)),
+    }
+else:
+    DATABASES['default']['CONN_MAX_AGE'] = int(os.environ.get('DB_CONN_MAX_AGE', 60))
+
+# Read replicas, e.g. DB_REPLICA_HOSTS=replica1,replica2 (DB_REPLICA_NAME when the database
+# name differs). The reads of @read_from_replica views go to a random one of them, see
+# pharmacy_app.routers. Tests run them as mirrors of the primary.
+DATABASE_REPLICAS = []
+
+for index, host in enumerate(filter(None, os.environ.get('DB_REPLICA_HOSTS', '').split(','))):
+    alias = 'replica' if index == 0 else f'replica_{index + 1}'
+    DATABASES[alias] = {
+        **DATABASES['default'],
+        'NAME': os.environ.get('DB_REPLICA_NAME', DATABASES['default']['NAME']),
+        'HOST': host.strip(),
+        'TEST': {'MIRROR': 'default'},
     }
+    DATABASE_REPLICAS.append(alias)
+
+# Profiling data (Silk) is kept out of the application database, create its tables with
+# `manage.py migrate --database=profiling`
+DATABASES['profiling'] = {
+    'ENGINE': os.environ.get('PROFILING_DB_ENGINE', 'django.db.backends.sqlite3'),
+    'NAME': os.environ.get('PROFILING_DB_NAME', str(BASE_DIR / 'profiling.sqlite3')),
 }
 
+DATABASE_ROUTERS = ['pharmacy_app.routers.ProfilingRouter', 'pharmacy_app.routers.PrimaryReplicaRouter']
+
+# Seconds a client that wrote keeps reading from the primary, longer than the replica lag
+REPLICA_LAG_WINDOW = float(os.environ.get('DB_REPLICA_LAG_WINDOW', 5))
+
+
+# Caches
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+
+# Catalog payloads are cached in process memory unless a shared cache is configured,
+# e.g. CATALOG_CACHE_URL=redis://localhost:6379/1. In process memory invalidations only reach
+# the process that made the change, the others serve their copy until it expires, so
+# production settings require the shared cache. The in-memory one holds
+# CATALOG_CACHE_MAX_ENTRIES keys, about four per product (payload, barcode, sellable stock,
+# list pages) before it starts evicting.
+CATALOG_CACHE_URL = os.environ.get('CATALOG_CACHE_URL')
+CATALOG_CACHE_MAX_ENTRIES = int(os.environ.get('CATALOG_CACHE_MAX_ENTRIES', 200000))
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'catalog': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': CATALOG_CACHE_URL,
+    } if CATALOG_CACHE_URL else {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'catalog',
+        'OPTIONS': {'MAX_ENTRIES': CATALOG_CACHE_MAX_ENTRIES},
+    },
+}
+
+CATALOG_CACHE_TIMEOUT = 300
+
+# In-memory product search index (pharmacy_app.search), built when a process starts serving and
+# synced with the changes of other processes at most every SEARCH_INDEX_SYNC_INTERVAL seconds.
+# Until it's built searches go to the database, on PostgreSQL through the pg_trgm extension and
+# trigram indexes on the titles (created by migrate, the database user needs the CREATE privilege). Under tests the first
+# search builds it instead, a background build would race the test database.
+SEARCH_INDEX_WARM = not TESTING
+SEARCH_INDEX_SYNC_INTERVAL = 1
+
+# Seconds the tombstones of deleted products / categories are kept for the indexes of other
+# processes, an index that hasn't synced for longer is rebuilt
+SEARCH_INDEX_TOMBSTONE_TIMEOUT = 86400
+
+# Depleted batches untouched for this many days are moved to the archive table (archive_batches)
+BATCH_ARCHIVE_AFTER_DAYS = 90
+
+# Monthly partitions of the sales and sale items (partition_sales), created this many months
+# ahead on migrate, by `partition_sales create` and by the first checkout of each month, detached
+# by `partition_sales detach` after SALES_PARTITION_RETENTION_MONTHS (the sales rollups keep
+# their totals). Sales outside the monthly partitions go to a default partition meanwhile.
+SALES_PARTITION_MONTHS_AHEAD = 3
+SALES_PARTITION_RETENTION_MONTHS = 24
+
+# Receipt codes are <prefix>-<number>, sales created with a terminal use it as the prefix instead
+SALE_CODE_PREFIX = 'SALE'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -147,8 +260,17 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.DjangoModelPermissionsOrAnonReadOnly'
     ],
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
+    'DEFAULT_RENDERER_CLASSES': [
+        'pharmacy_app.timing.TimedJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PAGINATION_CLASS': 'api.pagination.KeysetPagination',
+    'PAGE_SIZE': 100,
 }
 
+# Upper bound for the ?page_size= of the list endpoints
+API_MAX_PAGE_SIZE = 1000
+
 # Custom User modal specification
 AUTH_USER_MODEL = 'pharmacy_app.Staff'
 
@@ -162,6 +284,48 @@ SIMPLE_JWT = {
     'REFRESH_TOKEN_LIFETIME': timedelta(days=10),
 }
 
+# Offline sale ingestion (POST /api/sales/bulk/), sales committed per transaction
+BULK_SALES_CHUNK_SIZE = 200
+BULK_SALES_MAX_CHUNK_SIZE = 1000
+
+# Rows fetched per round trip by the streaming exports (/api/export/...)
+EXPORT_CHUNK_SIZE = 2000
+
+# Request profiling. Silk records a PROFILING_SAMPLE_RATE fraction of the requests and the ones
+# sent with an "X-Profile: <PROFILING_TOKEN>" header, requests slower than
+# PROFILING_SLOW_REQUEST_MS are recorded after the fact.
+PROFILING_SAMPLE_RATE = float(os.environ.get('PROFILING_SAMPLE_RATE', 0))
+PROFILING_SLOW_REQUEST_MS = float(os.environ.get('PROFILING_SLOW_REQUEST_MS', 1000))
+PROFILING_TOKEN = os.environ.get('PROFILING_TOKEN')
+
+SILKY_INTERCEPT_FUNC = should_profile
+
+# Server-Timing / slow log thresholds (pharmacy_app.timing), logged as JSON lines
+SLOW_REQUEST_LOG_MS = float(os.environ.get('SLOW_REQUEST_LOG_MS', 500))
+SLOW_QUERY_LOG_MS = float(os.environ.get('SLOW_QUERY_LOG_MS', 100))
+
+# Prometheus metrics at /metrics (pharmacy_app.metrics). With several worker processes set
+# PROMETHEUS_MULTIPROC_DIR to an empty directory before they start, so their samples add up.
+# Scrapers send "Authorization: Bearer <METRICS_TOKEN>" when a token is set.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'pharmacy_app.timing': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+    },
+}
+
 SPECTACULAR_SETTINGS = {
     'TITLE': 'Pharmacy API',
     'DESCRIPTION': 'Pharmacy App API',
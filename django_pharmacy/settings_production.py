@@ -0,0 +1,46 @@
+"""
+Production settings for django_pharmacy project.
+
+Extends the development settings without the debug-only apps, their
+middleware and URL routes, and with the shared catalog cache
+(CATALOG_CACHE_URL) required. Silk is only kept with PROFILING=1, and then
+records sampled, slow and opted-in requests only (see settings.py).
+
+Use with DJANGO_SETTINGS_MODULE=django_pharmacy.settings_production.
+"""
+import os
+
+from django_pharmacy.settings import *  # noqa: F401,F403
+from django_pharmacy.settings import CACHES, DATABASES, INSTALLED_APPS, MIDDLEWARE
+
+DEBUG = False
+
+SECRET_KEY = os.environ['DJANGO_SECRET_KEY']
+
+ALLOWED_HOSTS = os.environ.get('DJANGO_ALLOWED_HOSTS', '').split(',')
+
+# Catalog invalidations have to reach every worker process, which a per-process cache doesn't do
+CATALOG_CACHE_URL = os.environ['CATALOG_CACHE_URL']
+CACHES = {
+    **CACHES,
+    'catalog': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': CATALOG_CACHE_URL,
+    },
+}
+
+DEBUG_APPS = {'debug_toolbar', 'django_extensions'}
+DEBUG_MIDDLEWARE = {'debug_toolbar.middleware.DebugToolbarMiddleware'}
+
+if os.environ.get('PROFILING') != '1':
+    DEBUG_APPS.add('silk')
+    DEBUG_MIDDLEWARE |= {'silk.middleware.SilkyMiddleware', 'pharmacy_app.profiling.SlowRequestProfilingMiddleware'}
+    DATABASES = {alias: database for alias, database in DATABASES.items() if alias != 'profiling'}
+
+INSTALLED_APPS = list(dict.fromkeys(app for app in INSTALLED_APPS if app not in DEBUG_APPS))
+MIDDLEWARE = [middleware for middleware in MIDDLEWARE if middleware not in DEBUG_MIDDLEWARE]
+
+PROFILING_SAMPLE_RATE = float(os.environ.get('PROFILING_SAMPLE_RATE', 0.01))
+
+SESSION_COOKIE_SECURE = True
+CSRF_COOKIE_SECURE = True
@@ -4,7 +4,12 @@ from pharmacy_app.models import *
 admin.site.register(Staff)
 admin.site.register(Sale)
 admin.site.register(Product)
+admin.site.register(ProductBarcode)
 admin.site.register(Category)
 admin.site.register(ProductPriceHistory)
 admin.site.register(SaleProduct)
 admin.site.register(ProductBatch)
+admin.site.register(ArchivedProductBatch)
+admin.site.register(StockLevel)
+admin.site.register(SalesRollup)
+admin.site.register(BatchAllocation)
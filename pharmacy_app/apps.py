@@ -6,4 +6,24 @@ class PharmacyAppConfig(AppConfig):
     name = 'pharmacy_app'
 
     def ready(self):
-        import pharmacy_app.signals
\ No newline at end of file
+        import pharmacy_app.signals
+
+        from django.db.backends.signals import connection_created
+        from pharmacy_app.timing import install_query_timer
+
+        connection_created.connect(install_query_timer)
+
+        from django.core.signals import request_started
+        from pharmacy_app.search import create_trigram_indexes_on_migrate, warm_on_first_request
+
+        # Build the product search index when the process starts serving
+        request_started.connect(warm_on_first_request)
+
+        from django.db.models.signals import post_migrate
+        from pharmacy_app.partitions import create_on_migrate
+
+        # Keep the sales partitions of the coming months in place
+        post_migrate.connect(create_on_migrate, sender=self)
+
+        # The database search fallback uses pg_trgm on PostgreSQL
+        post_migrate.connect(create_trigram_indexes_on_migrate, sender=self)
\ No newline at end of file
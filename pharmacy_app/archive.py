@@ -0,0 +1,75 @@
+from django.db import transaction
+from django.db.models import Case, When, Value
+
+from pharmacy_app.models import ProductBatch, ArchivedProductBatch
+
+
+ARCHIVED_FIELDS = (
+    'id', 'product_id', 'recorder_id', 'quantity', 'unitPrice', 'retailPrice', 'source', 'arrival_date', 'updated_at'
+)
+
+
+def archive_batches(before, limit, after=0):
+    """
+    Moves up to `limit` depleted batches, untouched since `before`, to the archive.
+
+    The chunk is copied and deleted in one short transaction, walking the
+    primary key from `after`. Batches locked by a checkout or a return are
+    skipped rather than waited for, and a batch that got stock back before its
+    lock was taken stays where it is. Returns the ids moved, the caller
+    resumes after the last one.
+    """
+
+    with transaction.atomic():
+        rows = list(
+            ProductBatch.objects.select_for_update(skip_locked=True)
+            .filter(pk__gt=after, quantity=0, updated_at__lt=before)
+            .order_by('pk')
+            .values_list(*ARCHIVED_FIELDS)[:limit]
+        )
+
+        if rows:
+            ArchivedProductBatch.objects.bulk_create(
+                [ArchivedProductBatch(**dict(zip(ARCHIVED_FIELDS, row))) for row in rows]
+            )
+            ProductBatch.objects.filter(pk__in=[row[0] for row in rows]).delete()
+
+    return [row[0] for row in rows]
+
+
+def restore_batches(batch_ids):
+    """
+    Moves archived batches back to ProductBatch under their ids, empty.
+
+    Used when a sale item taken from an archived batch is returned, the stock
+    goes back into the batch it came from. Returns the ids restored.
+    """
+
+    archived = list(ArchivedProductBatch.objects.select_for_update().filter(pk__in=batch_ids))
+
+    if not archived:
+        return set()
+
+    ProductBatch.objects.bulk_create([
+        ProductBatch(
+            id=batch.pk,
+            product_id=batch.product_id,
+            recorder_id=batch.recorder_id,
+
+            quantity=batch.quantity,
+            unitPrice=batch.unitPrice,
+            retailPrice=batch.retailPrice,
+            source=batch.source
+        )
+        for batch in archived
+    ])
+
+    # auto_now_add stamped the inserts, the batches keep their place in the FIFO order
+    ProductBatch.objects.filter(pk__in=[batch.pk for batch in archived]).update(arrival_date=Case(
+        *(When(pk=batch.pk, then=Value(batch.arrival_date)) for batch in archived),
+        output_field=ProductBatch._meta.get_field('arrival_date'),
+    ))
+
+    ArchivedProductBatch.objects.filter(pk__in=[batch.pk for batch in archived]).delete()
+
+    return {batch.pk for batch in archived}
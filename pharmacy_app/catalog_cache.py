@@ -0,0 +1,228 @@
+import asyncio
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+_MISSING = object()
+
+
+def get_cache():
+    return caches[getattr(settings, 'CATALOG_CACHE_ALIAS', 'catalog')]
+
+
+def get_or_build(key, build, timeout=None):
+    """
+    Returns the cached value of `key`, building and caching it on a miss.
+
+    Values are stored with a soft expiry ahead of the real one. The first
+    caller past the soft expiry takes a short lock and rebuilds the value while
+    everybody else keeps getting the stale one, and on a cold miss the other
+    callers wait briefly for the lock holder instead of all hitting the
+    database at once (stampede protection). `build` returning None isn't cached.
+    """
+
+    cache = get_cache()
+    timeout = timeout or getattr(settings, 'CATALOG_CACHE_TIMEOUT', 300)
+    lock_timeout = getattr(settings, 'CATALOG_CACHE_LOCK_TIMEOUT', 10)
+    lock_key = f"{key}:lock"
+
+    entry = cache.get(key)
+
+    if entry is not None:
+        value, fresh_until = entry
+
+        if fresh_until > time.time() or not cache.add(lock_key, 1, lock_timeout):
+            return value
+
+    elif not cache.add(lock_key, 1, lock_timeout):
+
+        # Somebody else is building it, wait for their value a little while
+        deadline = time.monotonic() + getattr(settings, 'CATALOG_CACHE_WAIT', 0.5)
+        while time.monotonic() < deadline:
+            time.sleep(0.02)
+            entry = cache.get(key)
+            if entry is not None:
+                return entry[0]
+
+        return build()
+
+    try:
+        value = build()
+
+        if value is not None:
+            put(key, value, timeout)
+
+        return value
+    finally:
+        cache.delete(lock_key)
+
+
+def put(key, value, timeout=None):
+    """Caches a value built elsewhere the way get_or_build() would have"""
+
+    timeout = timeout or getattr(settings, 'CATALOG_CACHE_TIMEOUT', 300)
+
+    # Keep serving the stale value for a grace period while it's rebuilt
+    get_cache().set(key, (value, time.time() + timeout), timeout * 2)
+
+
+async def aget_or_build(key, build, timeout=None):
+    """Async version of get_or_build(), `build` is a coroutine function"""
+
+    cache = get_cache()
+    timeout = timeout or getattr(settings, 'CATALOG_CACHE_TIMEOUT', 300)
+    lock_timeout = getattr(settings, 'CATALOG_CACHE_LOCK_TIMEOUT', 10)
+    lock_key = f"{key}:lock"
+
+    entry = await cache.aget(key)
+
+    if entry is not None:
+        value, fresh_until = entry
+
+        if fresh_until > time.time() or not await cache.aadd(lock_key, 1, lock_timeout):
+            return value
+
+    elif not await cache.aadd(lock_key, 1, lock_timeout):
+
+        deadline = time.monotonic() + getattr(settings, 'CATALOG_CACHE_WAIT', 0.5)
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.02)
+            entry = await cache.aget(key)
+            if entry is not None:
+                return entry[0]
+
+        return await build()
+
+    try:
+        value = await build()
+
+        if value is not None:
+            await cache.aset(key, (value, time.time() + timeout), timeout * 2)
+
+        return value
+    finally:
+        await cache.adelete(lock_key)
+
+
+def get_versioned(key, version, build, timeout=None):
+    """
+    get_or_build() for payloads served under validators derived from `version`.
+
+    The payload is cached with the version it was built for. A copy of another
+    version (changed by another process, or stale past its soft expiry) is
+    rebuilt instead of served, so an old body never goes out under a newer ETag.
+    """
+
+    def build_entry():
+        payload = build()
+        return None if payload is None else (version, payload)
+
+    entry = get_or_build(key, build_entry, timeout)
+
+    if entry is not None and entry[0] == version:
+        return entry[1]
+
+    payload = build()
+
+    if payload is not None:
+        put(key, (version, payload), timeout)
+
+    return payload
+
+
+async def aget_versioned(key, version, build, timeout=None):
+    """Async version of get_versioned(), `build` is a coroutine function"""
+
+    async def build_entry():
+        payload = await build()
+        return None if payload is None else (version, payload)
+
+    entry = await aget_or_build(key, build_entry, timeout)
+
+    if entry is not None and entry[0] == version:
+        return entry[1]
+
+    payload = await build()
+
+    if payload is not None:
+        timeout = timeout or getattr(settings, 'CATALOG_CACHE_TIMEOUT', 300)
+        await get_cache().aset(key, ((version, payload), time.time() + timeout), timeout * 2)
+
+    return payload
+
+
+def get_generation(name):
+    """Returns the current generation of a cached list, bumped on every change to it"""
+
+    cache = get_cache()
+    generation = cache.get(f"catalog:{name}:generation")
+
+    if generation is None:
+        generation = time.time_ns()
+        cache.add(f"catalog:{name}:generation", generation, None)
+
+    return generation
+
+
+def bump_generation(name):
+    """Makes every cached page of a list stale at once"""
+
+    get_cache().set(f"catalog:{name}:generation", time.time_ns(), None)
+
+
+def list_key(name, url):
+    """Returns the cache key of a list page, one per generation and URL (cursor, page size)"""
+
+    digest = hashlib.md5(url.encode()).hexdigest()
+
+    return f"catalog:{name}:{get_generation(name)}:{digest}"
+
+
+def product_key(product_id):
+    return f"catalog:product:{product_id}"
+
+
+def category_key(category_id):
+    return f"catalog:category:{category_id}"
+
+
+def sellable_key(product_id):
+    return f"catalog:sellable:{product_id}"
+
+
+def barcode_key(code):
+    # Barcodes are free text, keep the key within the backends' limits
+    return f"catalog:barcode:{hashlib.md5(code.encode()).hexdigest()}"
+
+
+def invalidate_products(*product_ids, lists=True):
+    """Drops the cached payloads of the given products and, with `lists`, the product list"""
+
+    get_cache().delete_many([
+        key for product_id in product_ids for key in (product_key(product_id), sellable_key(product_id))
+    ])
+
+    if lists:
+        bump_generation('products')
+
+
+def invalidate_category(category_id):
+    """Drops the cached payload of a category and the category list"""
+
+    get_cache().delete(category_key(category_id))
+    bump_generation('categories')
+
+
+def invalidate_stock(*product_ids):
+    """Drops the cached sellable prices and stock of the given products"""
+
+    get_cache().delete_many([sellable_key(product_id) for product_id in product_ids])
+
+
+def invalidate_barcodes(*codes):
+    """Drops the cached product ids of the given barcodes"""
+
+    get_cache().delete_many([barcode_key(code) for code in codes])
@@ -0,0 +1,398 @@
+import uuid
+from collections import defaultdict
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q, F, Case, When, Value, Sum
+
+from pharmacy_app import metrics, partitions
+from pharmacy_app.archive import restore_batches
+from pharmacy_app.models import Sale, SaleProduct, ProductBatch, BatchAllocation
+from pharmacy_app.rollups import line_state, update_rollups
+from pharmacy_app.stock import adjust_stock
+
+
+class InsufficientStockError(Exception):
+    """Raised when the batches can't cover a sold line"""
+
+    def __init__(self, product_id, retail_price):
+        self.product_id = product_id
+        self.retail_price = retail_price
+        super().__init__(f"Stock is not enough for product {product_id} at price ${retail_price}.")
+
+
+class StockConflictError(Exception):
+    """Raised when a locked batch no longer holds the quantity allocated from it"""
+
+
+def format_sale_code(number, prefix=None):
+    """The receipt code of a sale number, e.g. SALE-000123 or STORE2-000124 with a store / terminal prefix"""
+
+    return f"{prefix or getattr(settings, 'SALE_CODE_PREFIX', 'SALE')}-{number:06d}"
+
+
+def create_numbered_sale(prefix=None, **fields):
+    """
+    Inserts a sale numbered from its primary key sequence.
+
+    On PostgreSQL the number is drawn with nextval() first, so the sale is
+    inserted with its final code in one statement. Numbers are never reused,
+    rolled back checkouts only leave gaps, and the codes are unique without a
+    retry loop whatever the prefix. Other databases get the code right after
+    the insert.
+    """
+
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, %s))", [Sale._meta.db_table, Sale._meta.pk.column])
+            number = cursor.fetchone()[0]
+
+        return Sale.objects.create(sale_id=number, code=format_sale_code(number, prefix), **fields)
+
+    with transaction.atomic():
+        sale = Sale.objects.create(code=uuid.uuid4().hex, **fields)
+        sale.code = format_sale_code(sale.pk, prefix)
+        Sale.objects.filter(pk=sale.pk).update(code=sale.code)
+
+    return sale
+
+
+def _pick_batches(shortage, exclude):
+    """
+    Picks, per (product, price) pair, the oldest in-stock batches covering the missing quantity.
+
+    The read takes no locks and is answered from the partial covering index,
+    only the returned batches are locked afterwards.
+    """
+
+    query = Q()
+    for product_id, price in shortage:
+        query |= Q(product_id=product_id, retailPrice=price)
+
+    candidates = ProductBatch.objects.filter(query, quantity__gt=0).exclude(pk__in=exclude).order_by(
+        'product_id', 'retailPrice', 'arrival_date', 'pk'
+    ).values_list('pk', 'product_id', 'retailPrice', 'quantity')
+
+    missing = dict(shortage)
+    picked = []
+    scanned = 0
+
+    for pk, product_id, price, quantity in candidates:
+        key = (product_id, price)
+        scanned += 1
+
+        if missing.get(key, 0) <= 0:
+            continue
+
+        missing[key] -= quantity
+        picked.append(pk)
+
+    metrics.BATCH_ROWS_SCANNED.inc(scanned)
+
+    return picked
+
+
+def _allocate(lines, locked):
+    """
+    Splits every line over the locked batches of its product and price, oldest first (FIFO).
+
+    Returns the allocations as (line, batch_id, quantity, unit_price) and the
+    quantity still missing per (product, price) pair.
+    """
+
+    batches = defaultdict(list)
+    for pk, (product_id, price, arrival_date, quantity, unit_price) in sorted(locked.items(), key=lambda item: (item[1][2], item[0])):
+        batches[(product_id, price)].append([pk, quantity, unit_price])
+
+    allocations = []
+    shortage = defaultdict(Decimal)
+
+    for line in lines:
+        key = (line.product_id, line.retailPrice)
+        remaining_qty = line.quantity
+
+        for batch in batches[key]:
+            if remaining_qty == 0:
+                break
+
+            taken = min(batch[1], remaining_qty)
+
+            if taken:
+                batch[1] -= taken
+                remaining_qty -= taken
+                allocations.append((line, batch[0], taken, batch[2]))
+
+        if remaining_qty > 0:
+            shortage[key] += remaining_qty
+
+    return allocations, shortage
+
+
+def allocate_batches(lines):
+    """
+    Reserves batch stock for the sold lines, FIFO, under row locks.
+
+    Only the batches needed to cover the lines are locked (SELECT ... FOR
+    UPDATE, in primary key order to keep the lock order of concurrent checkouts
+    consistent). If a concurrent checkout drained some of them in the meantime,
+    the next oldest batches are locked until the lines are covered or the stock
+    runs out. Returns the allocations as (line, batch_id, quantity, unit_price).
+    """
+
+    demand = defaultdict(Decimal)
+    for line in lines:
+        demand[(line.product_id, line.retailPrice)] += line.quantity
+
+    locked = {}
+    shortage = demand
+
+    while shortage:
+        picked = _pick_batches(shortage, locked.keys())
+
+        if not picked:
+            product_id, price = next(iter(shortage))
+            raise InsufficientStockError(product_id, price)
+
+        rows = ProductBatch.objects.select_for_update().filter(pk__in=picked).order_by('pk').values_list(
+            'pk', 'product_id', 'retailPrice', 'arrival_date', 'quantity', 'unitPrice'
+        )
+        for pk, product_id, price, arrival_date, quantity, unit_price in rows:
+            locked[pk] = (product_id, price, arrival_date, quantity, unit_price)
+
+        allocations, shortage = _allocate(lines, locked)
+
+    return allocations
+
+
+@metrics.STOCK_DEPLETION.time()
+def deplete_batches(lines):
+    """
+    Takes the quantity of the sold lines out of the matching batches.
+
+    The batches are reserved with allocate_batches and decremented with a single
+    conditional UPDATE ... SET quantity = quantity - n WHERE quantity >= n, so
+    a decrement can never be lost or drive a batch negative. What each line
+    took from each batch is recorded as a BatchAllocation at the batch's unit
+    cost. Returns the stock-level changes to apply.
+    """
+
+    lines = [line for line in lines if line.quantity]
+
+    if not lines:
+        return []
+
+    allocations = allocate_batches(lines)
+
+    taken = defaultdict(Decimal)
+    for line, batch_id, quantity, unit_price in allocations:
+        taken[batch_id] += quantity
+
+    condition = Q()
+    for batch_id, quantity in taken.items():
+        condition |= Q(pk=batch_id, quantity__gte=quantity)
+
+    updated = ProductBatch.objects.filter(condition).update(quantity=Case(
+        *(When(pk=batch_id, then=F('quantity') - Value(quantity)) for batch_id, quantity in taken.items()),
+        output_field=ProductBatch._meta.get_field('quantity'),
+    ), **ProductBatch.touched())
+
+    if updated != len(taken):
+        raise StockConflictError("Batch stock changed while it was being allocated.")
+
+    BatchAllocation.objects.bulk_create([
+        BatchAllocation(
+            sale_product_id=line.pk,
+            batch_id=batch_id,
+            product_id=line.product_id,
+
+            quantity=quantity,
+            unitPrice=unit_price,
+            retailPrice=line.retailPrice
+        )
+        for line, batch_id, quantity, unit_price in allocations
+    ])
+
+    return [(line.product_id, line.retailPrice, -line.quantity) for line in lines]
+
+
+def reverse_allocations(lines, recorder=None):
+    """
+    Puts the stock of returned lines back into the batches it was taken from.
+
+    Every allocation still held by a line is reversed with a negative
+    allocation, so cost of goods nets out, and its quantity is added back to
+    the original batch in one UPDATE, archived batches are restored for it
+    first. Allocations whose batch no longer exists at all are restocked as a
+    new batch at the original unit cost. Returns the lines
+    that had nothing to reverse and the stock-level changes to apply.
+    """
+
+    held = BatchAllocation.objects.filter(sale_product__in=[line.pk for line in lines if line.pk]).values(
+        'sale_product_id', 'batch_id', 'product_id', 'unitPrice', 'retailPrice'
+    ).annotate(held=Sum('quantity')).filter(held__gt=0).order_by()
+    held = list(held)
+
+    if not held:
+        return lines, []
+
+    restocked = defaultdict(Decimal)
+    for allocation in held:
+        restocked[allocation['batch_id']] += allocation['held']
+
+    # Locked, so the archiver can't move them away between this read and the update
+    existing = set(
+        ProductBatch.objects.select_for_update().filter(pk__in=restocked.keys()).order_by('pk').values_list('pk', flat=True)
+    )
+    existing |= restore_batches(restocked.keys() - existing)
+
+    if existing:
+        ProductBatch.objects.filter(pk__in=existing).update(quantity=Case(
+            *(When(pk=batch_id, then=F('quantity') + Value(restocked[batch_id])) for batch_id in existing),
+            output_field=ProductBatch._meta.get_field('quantity'),
+        ), **ProductBatch.touched())
+
+    ProductBatch.objects.bulk_create([
+        ProductBatch(
+            product_id=allocation['product_id'],
+            recorder=recorder,
+
+            quantity=allocation['held'],
+            unitPrice=allocation['unitPrice'],
+            retailPrice=allocation['retailPrice'],
+            source=ProductBatch.ProductBatchSourceChoices.RETURNED
+        )
+        for allocation in held if allocation['batch_id'] not in existing
+    ])
+
+    BatchAllocation.objects.bulk_create([
+        BatchAllocation(
+            sale_product_id=allocation['sale_product_id'],
+            batch_id=allocation['batch_id'],
+            product_id=allocation['product_id'],
+
+            quantity=-allocation['held'],
+            unitPrice=allocation['unitPrice'],
+            retailPrice=allocation['retailPrice']
+        )
+        for allocation in held
+    ])
+
+    reversed_lines = {allocation['sale_product_id'] for allocation in held}
+    changes = [(allocation['product_id'], allocation['retailPrice'], allocation['held']) for allocation in held]
+
+    return [line for line in lines if line.pk not in reversed_lines], changes
+
+
+def restock_returns(lines, recorder=None):
+    """
+    Restocks returned lines, returns the stock-level changes to apply.
+
+    Lines that were sold from batches go back into those batches, other
+    returns are stored as a new batch.
+    """
+
+    lines, changes = reverse_allocations(lines, recorder)
+
+    ProductBatch.objects.bulk_create([
+        ProductBatch(
+            product_id=line.product_id,
+            recorder=recorder,
+
+            quantity=line.quantity,
+            unitPrice=line.retailPrice,
+            retailPrice=line.retailPrice,
+            source=ProductBatch.ProductBatchSourceChoices.RETURNED
+        )
+        for line in lines
+    ])
+
+    return changes + [(line.product_id, line.retailPrice, line.quantity) for line in lines]
+
+
+def settle_lines(lines, recorder=None):
+    """Applies the stock effect of lines that have just become SOLD or RETURNED"""
+
+    sold = [line for line in lines if line.status == SaleProduct.SaleProductStatusChoices.SOLD]
+    returned = [line for line in lines if line.status == SaleProduct.SaleProductStatusChoices.RETURNED]
+
+    with transaction.atomic():
+        changes = []
+
+        if sold:
+            changes += deplete_batches(sold)
+        if returned:
+            changes += restock_returns(returned, recorder)
+
+        adjust_stock(changes)
+
+
+def sell_pending_lines(sale):
+    """Marks the pending lines of a sale as sold and depletes their stock"""
+
+    with transaction.atomic():
+        lines = list(sale.sale_products.filter(status=SaleProduct.SaleProductStatusChoices.PENDING))
+
+        if not lines:
+            return
+
+        SaleProduct.objects.filter(pk__in=[line.pk for line in lines]).update(
+            status=SaleProduct.SaleProductStatusChoices.SOLD
+        )
+
+        for line in lines:
+            line.status = SaleProduct.SaleProductStatusChoices.SOLD
+
+        settle_lines(lines)
+        update_rollups(added=[line_state(line, sale) for line in lines])
+
+
+def commit_sale(recorder, items, prefix=None, **sale_fields):
+    """
+    Creates a sale with all its lines in one transaction.
+
+    The sale row is inserted with its final total, the lines are inserted with
+    a single bulk insert and their stock is settled with a fixed number of
+    statements, so the query count doesn't grow with the size of the cart.
+    `prefix` replaces SALE_CODE_PREFIX in the receipt code.
+    """
+
+    total = sum((item['retailPrice'] * item['quantity'] for item in items), Decimal(0))
+
+    # The months ahead are created here too, not only on migrate
+    partitions.ensure_current()
+
+    with transaction.atomic():
+        sale = create_numbered_sale(
+            prefix,
+            recorder=recorder,
+            totalAmount=total,
+            **sale_fields
+        )
+
+        lines = SaleProduct.objects.bulk_create([SaleProduct(sale=sale, **item) for item in items])
+        settle_lines(lines, recorder)
+        update_rollups(added=[line_state(line, sale) for line in lines])
+
+        if sale.status == Sale.SaleStatusChoices.CLOSED:
+            sell_pending_lines(sale)
+
+        transaction.on_commit(lambda: metrics.record_sale(len(lines)))
+
+    return sale
+
+
+def close_sale(sale):
+    """Moves a sale from IN_PROGRESS to CLOSED, selling its pending lines once"""
+
+    with transaction.atomic():
+        closed = Sale.objects.filter(
+            pk=sale.pk, status=Sale.SaleStatusChoices.IN_PROGRESS
+        ).update(status=Sale.SaleStatusChoices.CLOSED, **Sale.touched())
+
+        sale.status = Sale.SaleStatusChoices.CLOSED
+
+        if closed:
+            sell_pending_lines(sale)
+
+    return sale
@@ -0,0 +1,47 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from pharmacy_app.archive import archive_batches
+from pharmacy_app.models import ProductBatch
+
+
+class Command(BaseCommand):
+    help = "Moves depleted batches older than --days to the archive table, in chunks, can be stopped and rerun any time"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=getattr(settings, 'BATCH_ARCHIVE_AFTER_DAYS', 90),
+                            help="Archive the batches depleted (last changed) more than this many days ago")
+        parser.add_argument('--chunk-size', type=int, default=1000, help="Batches moved per transaction")
+        parser.add_argument('--max-chunks', type=int, default=None, help="Stop after this many chunks")
+        parser.add_argument('--pause', type=float, default=0, help="Seconds to sleep between chunks")
+        parser.add_argument('--dry-run', action='store_true', help="Only count the batches due for the archive")
+
+    def handle(self, *args, **kwargs):
+
+        before = timezone.now() - timedelta(days=kwargs['days'])
+
+        if kwargs['dry_run']:
+            due = ProductBatch.objects.filter(quantity=0, updated_at__lt=before).count()
+            self.stdout.write(f"{due} batches depleted before {before:%Y-%m-%d %H:%M} are due for the archive")
+            return
+
+        # Everything before the cursor has been moved or skipped, a rerun starts over from what's left
+        after, chunks, moved = 0, 0, 0
+
+        while kwargs['max_chunks'] is None or chunks < kwargs['max_chunks']:
+            batch_ids = archive_batches(before, kwargs['chunk_size'], after)
+
+            if not batch_ids:
+                break
+
+            after, chunks, moved = batch_ids[-1], chunks + 1, moved + len(batch_ids)
+            self.stdout.write(f"Archived {moved} batches (up to id {after})")
+
+            if kwargs['pause']:
+                time.sleep(kwargs['pause'])
+
+        self.stdout.write(self.style.SUCCESS(f"Archived {moved} batches depleted before {before:%Y-%m-%d %H:%M}"))
@@ -0,0 +1,340 @@
+import json
+import math
+import random
+import re
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from io import StringIO
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test import Client
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import AccessToken
+
+from pharmacy_app.checkout import commit_sale
+from pharmacy_app.models import Staff, Category, Product, ProductBatch, ProductPriceHistory, Sale, SaleProduct, StockLevel
+
+BENCH_USERNAME = "bench"
+
+DEFAULT_MIX = "checkout=2,browse=5,sale=2,history=1"
+
+_QUERIES = re.compile(r'db;dur=[\d.]+;desc="(\d+) queries"')
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted values"""
+
+    if not values:
+        return None
+
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summarize(samples, elapsed):
+    """Latency percentiles (ms), throughput (req/s) and queries per request of (status, seconds, queries) samples"""
+
+    latencies = sorted(duration * 1000 for status, duration, queries in samples)
+    queries = [queries for status, duration, queries in samples if queries is not None]
+
+    return {
+        'requests': len(samples),
+        'errors': sum(1 for status, duration, queries in samples if status >= 400),
+        'throughput': round(len(samples) / elapsed, 1) if elapsed else None,
+        'p50_ms': round(percentile(latencies, 50), 2) if latencies else None,
+        'p95_ms': round(percentile(latencies, 95), 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99), 2) if latencies else None,
+        'max_ms': round(latencies[-1], 2) if latencies else None,
+        'queries_per_request': round(sum(queries) / len(queries), 2) if queries else None,
+    }
+
+
+class InProcessTransport:
+    """Sends the requests through the Django test client, in the benchmark process"""
+
+    def __init__(self, token):
+        # Any host the settings accept, the client's "testserver" only is under the test runner
+        host = next((host for host in settings.ALLOWED_HOSTS if host != '*' and not host.startswith('.')), 'localhost')
+
+        self.client = Client(raise_request_exception=False, headers={'Authorization': f'Bearer {token}', 'Host': host})
+
+    def request(self, method, path, body=None):
+
+        if method == 'GET':
+            response = self.client.get(path)
+        else:
+            response = self.client.post(path, json.dumps(body), content_type='application/json')
+
+        return response.status_code, response.headers.get('Server-Timing', '')
+
+
+class HttpTransport:
+    """Sends the requests to a running server"""
+
+    def __init__(self, token, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
+
+    def request(self, method, path, body=None):
+
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(self.base_url + path, data=data, headers=self.headers, method=method)
+
+        try:
+            with urllib.request.urlopen(request) as response:
+                response.read()
+                return response.status, response.headers.get('Server-Timing', '')
+        except urllib.error.HTTPError as error:
+            return error.code, error.headers.get('Server-Timing', '')
+
+
+class Command(BaseCommand):
+    help = "Drives a concurrent request mix against the API and reports latency, throughput and queries per request"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed-products', type=int, default=0, help="Seed this many products (with batches and price history) first")
+        parser.add_argument('--seed-sales', type=int, default=0, help="Seed this many sales first")
+        parser.add_argument('--random-seed', type=int, default=1, help="Seed of the data and request generators")
+        parser.add_argument('--requests', type=int, default=1000, help="Requests to send, over all workers")
+        parser.add_argument('--concurrency', type=int, default=8, help="Concurrent workers")
+        parser.add_argument('--warmup', type=int, default=50, help="Requests sent before measuring")
+        parser.add_argument('--mix', default=DEFAULT_MIX, help=f"Scenario weights (default {DEFAULT_MIX})")
+        parser.add_argument('--url', help="Base URL of a running server, requests go through the test client otherwise")
+        parser.add_argument('--output', help="File to save the results to, as JSON")
+        parser.add_argument('--compare', help="Results JSON of an earlier run to compare with")
+
+    # Seeding
+
+    def seed(self, rng, product_count, sale_count):
+        user = self.get_user()
+
+        if product_count:
+            categories = Category.objects.bulk_create([
+                Category(title=f"Bench category {i + 1}") for i in range(max(1, product_count // 25))
+            ])
+            products = Product.objects.bulk_create([
+                Product(title=f"Bench product {i + 1}", category=rng.choice(categories), recorder=user)
+                for i in range(product_count)
+            ])
+
+            batches = []
+            history = []
+            for product in products:
+                price = Decimal(rng.randint(100, 10000)) / 100
+
+                # Plenty of stock so the checkouts of a run don't exhaust it
+                batches += [
+                    ProductBatch(product=product, recorder=user, quantity=10000, unitPrice=price * Decimal('0.7'), retailPrice=price)
+                    for _ in range(rng.randint(1, 3))
+                ]
+                history += [
+                    ProductPriceHistory(product=product, recorder=user, oldPrice=price, newPrice=price)
+                    for _ in range(rng.randint(1, 5))
+                ]
+
+            ProductBatch.objects.bulk_create(batches, batch_size=2000)
+            ProductPriceHistory.objects.bulk_create(history, batch_size=2000)
+
+            # Bulk inserts skip the signals keeping the stock levels
+            call_command('rebuild_stock_levels', stdout=StringIO())
+
+        stock = self.load_stock()
+
+        for _ in range(sale_count):
+            commit_sale(user, [
+                {
+                    'product_id': product_id,
+                    'quantity': Decimal(rng.randint(1, 3)),
+                    'retailPrice': price,
+                    'status': SaleProduct.SaleProductStatusChoices.SOLD,
+                }
+                for product_id, price in rng.sample(stock, min(len(stock), rng.randint(1, 5)))
+            ], payment_type=rng.choice(Sale.PaymentTypeChoices.values), status=Sale.SaleStatusChoices.CLOSED)
+
+        self.stdout.write(f"Seeded {product_count} products and {sale_count} sales")
+
+    def get_user(self):
+        user = Staff.objects.filter(username=BENCH_USERNAME).first()
+        return user or Staff.objects.create_user(username=BENCH_USERNAME, first_name="Bench", role=Staff.StaffRoleChoices.ADMIN)
+
+    def load_stock(self):
+        """(product, price) pairs that are in stock"""
+        return list(StockLevel.objects.filter(quantity__gt=0).values_list('product_id', 'retailPrice').order_by('product_id', 'retailPrice'))
+
+    # Scenarios
+
+    def checkout(self, rng):
+        return 'POST', '/api/sales/', {
+            'payment_type': rng.choice(Sale.PaymentTypeChoices.values),
+            'items': [
+                {'product': product_id, 'quantity': rng.randint(1, 3), 'retailPrice': str(price), 'status': SaleProduct.SaleProductStatusChoices.SOLD}
+                for product_id, price in rng.sample(self.stock, min(len(self.stock), rng.randint(1, 5)))
+            ],
+        }
+
+    def browse(self, rng):
+        return 'GET', rng.choice([
+            '/api/products/',
+            '/api/categories/',
+            f'/api/products/{rng.choice(self.product_ids)}/',
+            f'/api/categories/{rng.choice(self.category_ids)}/',
+        ]), None
+
+    def sale(self, rng):
+        return 'GET', f'/api/sales/{rng.choice(self.sale_ids)}/', None
+
+    def history(self, rng):
+        return 'GET', f'/api/price-history/product/{rng.choice(self.product_ids)}/', None
+
+    def parse_mix(self, mix):
+        weights = {}
+
+        for part in mix.split(','):
+            name, _, weight = part.partition('=')
+            name = name.strip()
+
+            if name not in ('checkout', 'browse', 'sale', 'history'):
+                raise CommandError(f"Unknown scenario {name!r}")
+
+            weights[name] = float(weight or 1)
+
+        return weights
+
+    # Running
+
+    def worker(self, index, count, transport_factory, weights, record):
+        rng = random.Random(self.random_seed * 1000 + index)
+        transport = transport_factory()
+        scenarios = list(weights)
+
+        try:
+            for _ in range(count):
+                name = rng.choices(scenarios, weights=list(weights.values()))[0]
+                method, path, body = getattr(self, name)(rng)
+
+                start = time.perf_counter()
+                status, server_timing = transport.request(method, path, body)
+                duration = time.perf_counter() - start
+
+                match = _QUERIES.search(server_timing)
+                record(name, status, duration, int(match.group(1)) if match else None)
+        finally:
+            # Worker threads have connections of their own
+            if threading.current_thread() is not threading.main_thread():
+                connections.close_all()
+
+    def run(self, total, concurrency, transport_factory, weights):
+        samples = defaultdict(list)
+        lock = threading.Lock()
+
+        def record(name, status, duration, queries):
+            with lock:
+                samples[name].append((status, duration, queries))
+
+        counts = [total // concurrency + (1 if i < total % concurrency else 0) for i in range(concurrency)]
+
+        start = time.perf_counter()
+
+        if concurrency == 1:
+            self.worker(0, total, transport_factory, weights, record)
+        else:
+            with ThreadPoolExecutor(concurrency) as executor:
+                for future in [
+                    executor.submit(self.worker, i, count, transport_factory, weights, record)
+                    for i, count in enumerate(counts)
+                ]:
+                    future.result()
+
+        return samples, time.perf_counter() - start
+
+    def git_commit(self):
+        try:
+            return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def report(self, results, previous):
+        self.stdout.write(f"{'scenario':<10} {'requests':>8} {'errors':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'queries':>8}")
+
+        for name, stats in results['scenarios'].items():
+            line = f"{name:<10} " + " ".join(
+                f"{'-' if stats[key] is None else stats[key]:>{width}}"
+                for key, width in [('requests', 8), ('errors', 6), ('throughput', 8), ('p50_ms', 8), ('p95_ms', 8), ('p99_ms', 8), ('queries_per_request', 8)]
+            )
+
+            before = previous.get('scenarios', {}).get(name, {}) if previous else {}
+
+            if before.get('p95_ms') and stats['p95_ms']:
+                change = (stats['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100
+                line += f"  p95 {change:+.1f}% vs {(previous.get('commit') or 'previous')[:8]}"
+
+            style = self.style.WARNING if stats['errors'] else self.style.SUCCESS
+            self.stdout.write(style(line))
+
+    def handle(self, *args, **options):
+        self.random_seed = options['random_seed']
+        rng = random.Random(self.random_seed)
+        weights = self.parse_mix(options['mix'])
+
+        if options['seed_products'] or options['seed_sales']:
+            self.seed(rng, options['seed_products'], options['seed_sales'])
+
+        self.stock = self.load_stock()
+        self.product_ids = sorted({product_id for product_id, price in self.stock})
+        self.category_ids = list(Category.objects.values_list('id', flat=True).order_by('id'))
+        self.sale_ids = list(Sale.objects.values_list('sale_id', flat=True).order_by('sale_id'))
+
+        if not self.stock or not self.category_ids:
+            raise CommandError("There are no products in stock to benchmark with, seed some with --seed-products")
+
+        if not self.sale_ids:
+            weights.pop('sale', None)
+
+        token = str(AccessToken.for_user(self.get_user()))
+
+        if options['url']:
+            transport_factory = lambda: HttpTransport(token, options['url'])
+        else:
+            transport_factory = lambda: InProcessTransport(token)
+
+        concurrency = max(1, options['concurrency'])
+
+        if options['warmup']:
+            self.run(options['warmup'], min(concurrency, options['warmup']), transport_factory, weights)
+
+        samples, elapsed = self.run(options['requests'], concurrency, transport_factory, weights)
+
+        results = {
+            'commit': self.git_commit(),
+            'started_at': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'target': options['url'] or 'in-process',
+            'options': {key: options[key] for key in ('requests', 'concurrency', 'warmup', 'mix', 'random_seed')},
+            'elapsed_s': round(elapsed, 3),
+            'total': summarize([sample for name in samples for sample in samples[name]], elapsed),
+            'scenarios': {name: summarize(samples[name], elapsed) for name in weights if name in samples},
+        }
+
+        previous = None
+        if options['compare']:
+            with open(options['compare']) as file:
+                previous = json.load(file)
+
+        self.report(results, previous)
+
+        total = results['total']
+        self.stdout.write(f"{total['requests']} requests in {results['elapsed_s']}s, {total['throughput']} req/s, p95 {total['p95_ms']} ms")
+
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                json.dump(results, file, indent=2)
+
+            self.stdout.write(self.style.SUCCESS(f"Results saved to {options['output']}"))
@@ -0,0 +1,73 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.fast import FastJSONRenderer, compile_serializer, orjson
+from pharmacy_app.serializers import ProductListSerializer, SaleSerializer, SaleProductSerializer, ProductBatchSerializer
+from pharmacy_app.timing import TimedJSONRenderer
+
+# The serializers of the list endpoints rendered by FastListMixin
+SERIALIZERS = {
+    'products': ProductListSerializer,
+    'sales': SaleSerializer,
+    'sale-items': SaleProductSerializer,
+    'product-batches': ProductBatchSerializer,
+}
+
+
+def best_of(repeat, function):
+    """The fastest of `repeat` runs of function() in seconds, and its last result"""
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+
+    return min(timings), result
+
+
+class Command(BaseCommand):
+    help = (
+        "Times rendering a list of rows through the serializers and JSONRenderer against the "
+        "values_list() path of FastListMixin, and checks both give the same bytes"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100000, help="rows rendered per list")
+        parser.add_argument('--repeat', type=int, default=3, help="runs per path, the fastest one is reported")
+        parser.add_argument('--only', choices=list(SERIALIZERS), action='append', help="lists to time (default: all)")
+
+    def handle(self, *args, **options):
+
+        rows, repeat = options['rows'], max(1, options['repeat'])
+
+        if orjson is None:
+            self.stdout.write(self.style.WARNING("orjson isn't installed, the fast path encodes with JSONRenderer"))
+
+        for name in options['only'] or SERIALIZERS:
+            serializer_class = SERIALIZERS[name]
+            queryset = serializer_class.Meta.model.objects.order_by('-pk')
+            columns, render = compile_serializer(serializer_class)
+
+            count = queryset[:rows].count()
+            if count < rows:
+                self.stdout.write(self.style.WARNING(f"{name}: only {count} rows, populate_db creates more"))
+
+            serializer_time, expected = best_of(
+                repeat, lambda: TimedJSONRenderer().render(serializer_class(queryset[:rows], many=True).data)
+            )
+            fast_time, content = best_of(
+                repeat, lambda: FastJSONRenderer().render(render(queryset.values_list(*columns, named=True)[:rows]))
+            )
+
+            if content != expected:
+                raise CommandError(f"{name}: the fast path renders different bytes")
+
+            self.stdout.write(
+                f"{name}: {count} rows, {len(content) / 1024 / 1024:.1f} MiB, "
+                f"serializer {serializer_time * 1000:.0f} ms, fast {fast_time * 1000:.0f} ms, "
+                f"{serializer_time / fast_time:.1f}x"
+            )
+
+        self.stdout.write(self.style.SUCCESS("Both paths rendered the same bytes"))
@@ -0,0 +1,88 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from pharmacy_app import partitions
+from pharmacy_app.models import SaleProduct
+
+
+class Command(BaseCommand):
+    help = (
+        "Manages the monthly partitions of the sales and sale items (PostgreSQL): "
+        "convert the tables once, create the coming months, detach the old ones, list them"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['convert', 'create', 'detach', 'list'])
+        parser.add_argument('--ahead', type=int, default=getattr(settings, 'SALES_PARTITION_MONTHS_AHEAD', 3),
+                            help="create: months to create ahead of the current one")
+        parser.add_argument('--keep', type=int, default=getattr(settings, 'SALES_PARTITION_RETENTION_MONTHS', 24),
+                            help="detach: months to keep attached, the current one included")
+        parser.add_argument('--drop', action='store_true', help="detach: drop the detached partitions")
+        parser.add_argument('--tablespace', help="detach: move the detached partitions to this (cheaper) tablespace")
+        parser.add_argument('--chunk-size', type=int, default=50000, help="convert: rows copied per statement")
+        parser.add_argument('--backfill-lines', action='store_true',
+                            help="convert: give the existing sale items the creation time of their sale first")
+
+    def handle(self, *args, **options):
+
+        if not partitions.is_supported():
+            raise CommandError("Partitioning needs PostgreSQL")
+
+        getattr(self, options['action'])(options)
+
+    def convert(self, options):
+
+        for model in partitions.PARTITIONED:
+            if partitions.is_partitioned(model):
+                self.stdout.write(f"{model._meta.db_table} is already partitioned")
+                continue
+
+            relaxed = partitions.convert(
+                model, options['chunk_size'], backfill_lines=options['backfill_lines'] and model is SaleProduct
+            )
+
+            for name in relaxed:
+                self.stdout.write(self.style.WARNING(f"Unique index {name} doesn't cover created_at, it's a plain index now"))
+
+            self.stdout.write(self.style.SUCCESS(f"Partitioned {model._meta.db_table} by month"))
+
+    def create(self, options):
+
+        start = timezone.now()
+        created = partitions.ensure_partitions(start, partitions.add_months(partitions.month_start(start), options['ahead']))
+
+        self.stdout.write(self.style.SUCCESS(f"Created {len(created)} partitions" + (f": {', '.join(created)}" if created else "")))
+
+    def detach(self, options):
+
+        if options['drop'] and options['tablespace']:
+            raise CommandError("Use either --drop or --tablespace")
+
+        before = partitions.add_months(partitions.month_start(timezone.now()), 1 - max(1, options['keep']))
+
+        # Sale items first, their sales stay readable until the items are gone
+        for model in reversed(partitions.PARTITIONED):
+            if not partitions.is_partitioned(model):
+                continue
+
+            for name in partitions.detach_partitions(model, before, options['drop'], options['tablespace']):
+                self.stdout.write(f"Detached {name}" + (" and dropped it" if options['drop'] else ""))
+
+        # rebuild_rollups recomputes from the attached rows only
+        self.stdout.write(self.style.SUCCESS(
+            f"Detached the partitions before {before:%Y-%m}, their totals stay in the sales rollups "
+            f"as long as they aren't rebuilt"
+        ))
+
+    def list(self, options):
+
+        for model in partitions.PARTITIONED:
+            table = model._meta.db_table
+
+            if not partitions.is_partitioned(model):
+                self.stdout.write(f"{table}: not partitioned")
+                continue
+
+            for month, name in partitions.list_partitions(table):
+                self.stdout.write(f"{table}: {month:%Y-%m} {name}")
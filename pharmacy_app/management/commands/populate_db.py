@@ -1,80 +1,311 @@
+import bisect
 import random
+from contextlib import contextmanager
+from datetime import datetime, time, timedelta
 from decimal import Decimal
-from django.core.management.base import BaseCommand
+from io import StringIO
+from itertools import accumulate, islice
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.utils import timezone
+
+from pharmacy_app import partitions
+from pharmacy_app.checkout import format_sale_code
 from pharmacy_app.models import Staff, Sale, Category, Product, SaleProduct, ProductPriceHistory, ProductBatch
 
+CENT = Decimal('0.01')
+
+CATEGORY_TITLES = [
+    "Medicine", "Clinical", "Inhalant", "Vitamins", "First aid", "Personal care", "Baby care", "Dermatology",
+    "Cold and flu", "Pain relief", "Digestive health", "Eye care",
+]
+
+# Opening hours, weighted towards the lunch and evening peaks
+HOUR_WEIGHTS = {8: 3, 9: 5, 10: 6, 11: 7, 12: 9, 13: 9, 14: 6, 15: 6, 16: 7, 17: 9, 18: 10, 19: 8, 20: 5, 21: 3}
+
+QUANTITY_WEIGHTS = {1: 70, 2: 15, 3: 7, 5: 5, 10: 3}
+
+# Columns the rows are generated for, by attribute name
+CATEGORY_FIELDS = ('id', 'title', 'version', 'updated_at')
+PRODUCT_FIELDS = ('id', 'title', 'recorder_id', 'category_id', 'version', 'updated_at')
+PRICE_HISTORY_FIELDS = ('id', 'product_id', 'oldPrice', 'newPrice', 'recorder_id', 'version', 'updated_at')
+BATCH_FIELDS = (
+    'id', 'product_id', 'recorder_id', 'quantity', 'unitPrice', 'retailPrice', 'source', 'arrival_date', 'version', 'updated_at'
+)
+SALE_FIELDS = ('sale_id', 'code', 'recorder_id', 'totalAmount', 'status', 'payment_type', 'created_at', 'version', 'updated_at')
+LINE_FIELDS = ('id', 'sale_id', 'product_id', 'quantity', 'retailPrice', 'status', 'created_at')
+
+
+@contextmanager
+def explicit_timestamps(*models):
+    """Lets inserts keep the auto_now / auto_now_add values they're given, to load history"""
+
+    fields = [
+        field for model in models for field in model._meta.concrete_fields
+        if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False)
+    ]
+    flags = [(field, field.auto_now, field.auto_now_add) for field in fields]
+
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in flags:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
 
 class Command(BaseCommand):
-    help = "Populate the database with test data"
+    help = "Populate the database with test data, sized and seeded by the options"
 
-    def handle(self, *args, **kwargs):
-        # Create Staff
-        admin = Staff.objects.create_user(username="admin", first_name="Admin", role=Staff.StaffRoleChoices.ADMIN,
-                                          password="0000")
-        cashier = Staff.objects.create_user(username="cashier", first_name="Cashier", role=Staff.StaffRoleChoices.CASHIER,
-                                            password="0000")
-        warehouse = Staff.objects.create_user(username="warehouse", first_name="Warehouse",
-                                              role=Staff.StaffRoleChoices.WAREHOUSE, password="000")
+    def add_arguments(self, parser):
+        parser.add_argument('--categories', type=int, default=3)
+        parser.add_argument('--products', type=int, default=15)
+        parser.add_argument('--batches', type=int, default=1, help="Batches per product")
+        parser.add_argument('--sales', type=int, default=3)
+        parser.add_argument('--lines', type=float, default=2, help="Average lines per sale")
+        parser.add_argument('--months', type=int, default=1, help="Months of history to spread the sales, batches and price changes over")
+        parser.add_argument('--cashiers', type=int, default=1)
+        parser.add_argument('--return-rate', type=float, default=0.02, help="Share of the sold lines that are returned")
+        parser.add_argument('--price-change-rate', type=float, default=0.3, help="Chance of a price change per product and month")
+        parser.add_argument('--seed', type=int, default=42, help="Random seed, the same options and seed give the same data")
+        parser.add_argument('--until', help="Date the history ends on (YYYY-MM-DD), today by default")
+        parser.add_argument('--chunk-size', type=int, default=10000, help="Rows per insert")
+        parser.add_argument(
+            '--skip-rollups', action='store_true',
+            help="Leave the sales rollups to a separate rebuild_rollups run, for the largest datasets"
+        )
 
-        # Create Categories
-        categories = [Category.objects.create(title=title) for title in ["Medicine", "Clinical", "Inhalant"]]
+    # Inserting
 
-        # Create Products
-        products = []
-        for category in categories:
-            for i in range(5):
-                product = Product.objects.create(
-                    title=f"{category.title} Product {i + 1}",
-                    recorder=warehouse,
-                    category=category
-                )
-                products.append(product)
-
-        # Create Product Batches
-        for product in products:
-            batch = ProductBatch.objects.create(
-                product=product,
-                recorder=warehouse,
-                quantity=Decimal(random.randint(10, 100)),
-                unitPrice=Decimal(random.uniform(5, 50)),
-                retailPrice=Decimal(random.uniform(51, 100)),
-                source=ProductBatch.ProductBatchSourceChoices.PURCHASED,
-            )
+    def insert(self, model, fields, rows):
+        """Inserts rows of values of the fields in chunks, with COPY on PostgreSQL and bulk_create elsewhere"""
 
-            # Create Price History
-            ProductPriceHistory.objects.create(
-                product=product,
-                oldPrice=batch.unitPrice,
-                newPrice=batch.retailPrice,
-                recorder=warehouse
-            )
+        count = 0
+        rows = iter(rows)
+
+        while chunk := list(islice(rows, self.chunk_size)):
+            with transaction.atomic():
+                if connection.vendor == 'postgresql':
+                    self.copy(model, fields, chunk)
+                else:
+                    model.objects.bulk_create([model(**dict(zip(fields, row))) for row in chunk])
+
+            count += len(chunk)
+
+        return count
 
-        # Create Sales
-        for _ in range(3):
-            sale = Sale.objects.create(
-                code=f"SALE-{random.randint(1000, 9999)}",
-                recorder=cashier,
-                totalAmount=Decimal(0),
-                status=Sale.SaleStatusChoices.IN_PROGRESS,
-                payment_type=random.choice([Sale.PaymentTypeChoices.CARD, Sale.PaymentTypeChoices.CASH])
+    def copy(self, model, fields, rows):
+        columns = ", ".join(connection.ops.quote_name(model._meta.get_field(name).column) for name in fields)
+
+        with connection.cursor() as cursor:
+            with cursor.cursor.copy(f"COPY {connection.ops.quote_name(model._meta.db_table)} ({columns}) FROM STDIN") as copy:
+                for row in rows:
+                    copy.write_row(row)
+
+    def next_ids(self, model):
+        """Primary keys for the new rows of a model, assigned up front so related rows can refer to them"""
+
+        last = model.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+        return iter(range(last + 1, 2 ** 31))
+
+    def reset_sequences(self, *models):
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), models):
+                cursor.execute(sql)
+
+    # Generating
+
+    def random_moment(self):
+        day = self.start.date() + timedelta(days=self.rng.randrange(self.days))
+        hour = self.rng.choices(self.hours, cum_weights=self.hour_weights)[0]
+        moment = datetime.combine(day, time(hour), tzinfo=self.start.tzinfo)
+
+        return moment + timedelta(seconds=self.rng.randrange(3600))
+
+    def create_staff(self, cashier_count):
+
+        def get_or_create(username, first_name, role, password):
+            staff = Staff.objects.filter(username=username).first()
+            return staff or Staff.objects.create_user(username=username, first_name=first_name, role=role, password=password)
+
+        get_or_create("admin", "Admin", Staff.StaffRoleChoices.ADMIN, "0000")
+        warehouse = get_or_create("warehouse", "Warehouse", Staff.StaffRoleChoices.WAREHOUSE, "000")
+        cashiers = [
+            get_or_create("cashier" if i == 0 else f"cashier{i + 1}", f"Cashier {i + 1}", Staff.StaffRoleChoices.CASHIER, "0000")
+            for i in range(max(1, cashier_count))
+        ]
+
+        return warehouse.pk, [cashier.pk for cashier in cashiers]
+
+    def create_catalog(self, warehouse_id, category_count, product_count):
+        category_ids = self.next_ids(Category)
+        categories = [
+            (
+                next(category_ids),
+                CATEGORY_TITLES[i % len(CATEGORY_TITLES)] + (f" {i // len(CATEGORY_TITLES) + 1}" if i >= len(CATEGORY_TITLES) else ""),
+                1, self.start,
             )
+            for i in range(max(1, category_count))
+        ]
+        self.insert(Category, CATEGORY_FIELDS, categories)
+
+        product_ids = self.next_ids(Product)
+        products = []
+        numbers = {}
+
+        for _ in range(product_count):
+            category_id, title = self.rng.choice(categories)[:2]
+            numbers[category_id] = numbers.get(category_id, 0) + 1
+            products.append((next(product_ids), f"{title} Product {numbers[category_id]}", warehouse_id, category_id, 1, self.start))
+
+        self.insert(Product, PRODUCT_FIELDS, products)
+
+        return [product[0] for product in products]
 
-            total_amount = Decimal(0)
-            for _ in range(2):
-                product = random.choice(products)
-                quantity = Decimal(random.randint(1, 5))
-                retail_price = product.batches.first().retailPrice
-                sale_product = SaleProduct.objects.create(
-                    sale=sale,
-                    product=product,
-                    quantity=quantity,
-                    retailPrice=retail_price,
-                    status=SaleProduct.SaleProductStatusChoices.SOLD
+    def create_prices(self, warehouse_id, product_ids, change_rate):
+        """Draws every product's price over time, returns {product: ([since], [price])}"""
+
+        prices = {}
+        history_ids = self.next_ids(ProductPriceHistory)
+        history = []
+
+        for product_id in product_ids:
+            price = Decimal(min(500.0, max(0.5, self.rng.lognormvariate(2.5, 0.8)))).quantize(CENT)
+            moments, values = [self.start], [price]
+
+            for month in range(self.months):
+                if self.rng.random() >= change_rate:
+                    continue
+
+                moment = self.start + timedelta(days=30 * month + self.rng.randrange(30))
+                new_price = (price * Decimal(self.rng.uniform(0.9, 1.2))).quantize(CENT)
+
+                history.append((next(history_ids), product_id, price, new_price, warehouse_id, 1, moment))
+                moments.append(moment)
+                values.append(new_price)
+                price = new_price
+
+            prices[product_id] = (moments, values)
+
+        self.insert(ProductPriceHistory, PRICE_HISTORY_FIELDS, history)
+
+        return prices
+
+    def price_at(self, product_id, moment):
+        moments, values = self.prices[product_id]
+        return values[max(0, bisect.bisect_right(moments, moment) - 1)]
+
+    def generate_batches(self, warehouse_id, product_ids, batches_per_product):
+        batch_ids = self.next_ids(ProductBatch)
+        purchased = ProductBatch.ProductBatchSourceChoices.PURCHASED.value
+
+        for product_id in product_ids:
+            for _ in range(batches_per_product):
+                arrival = self.random_moment()
+                retail_price = self.price_at(product_id, arrival)
+                unit_price = (retail_price * Decimal(self.rng.uniform(0.55, 0.8))).quantize(CENT)
+
+                yield (
+                    next(batch_ids), product_id, warehouse_id, Decimal(self.rng.randint(20, 500)),
+                    unit_price, retail_price, purchased, arrival, 1, arrival,
                 )
-                total_amount += quantity * retail_price
 
-            sale.totalAmount = total_amount
-            sale.status = Sale.SaleStatusChoices.CLOSED
-            sale.save()
+    def create_sales(self, cashier_ids, product_ids, sale_count, average_lines, return_rate):
+        """Inserts the sales in chunks, a few best-sellers make up most of the lines"""
+
+        # Zipf-like popularity over a shuffled catalog
+        popular = list(product_ids)
+        self.rng.shuffle(popular)
+        popularity = list(accumulate(1 / rank ** 1.1 for rank in range(1, len(popular) + 1)))
+
+        quantities = [Decimal(quantity) for quantity in QUANTITY_WEIGHTS]
+        quantity_weights = list(accumulate(QUANTITY_WEIGHTS.values()))
+        extra_lines = max(0.0, average_lines - 1)
+
+        sold, returned = SaleProduct.SaleProductStatusChoices.SOLD.value, SaleProduct.SaleProductStatusChoices.RETURNED.value
+        closed = Sale.SaleStatusChoices.CLOSED.value
+        card, cash = Sale.PaymentTypeChoices.CARD.value, Sale.PaymentTypeChoices.CASH.value
+
+        sale_ids = self.next_ids(Sale)
+        line_ids = self.next_ids(SaleProduct)
+
+        # Sales arrive as a Poisson process over the period, so they're in creation order
+        gap = (self.until - self.start).total_seconds() / max(1, sale_count)
+        moment = self.start
+        created = lines_created = 0
+
+        while created < sale_count:
+            sales, lines = [], []
+
+            for _ in range(min(self.chunk_size, sale_count - created)):
+                moment = min(self.until, moment + timedelta(seconds=self.rng.expovariate(1 / gap)))
+                sale_id = next(sale_ids)
+                total = Decimal(0)
+
+                line_count = 1 + (min(49, int(self.rng.expovariate(1 / extra_lines))) if extra_lines else 0)
+                for product_id in set(self.rng.choices(popular, cum_weights=popularity, k=line_count)):
+                    quantity = self.rng.choices(quantities, cum_weights=quantity_weights)[0]
+                    price = self.price_at(product_id, moment)
+                    total += quantity * price
+
+                    lines.append((
+                        next(line_ids), sale_id, product_id, quantity, price,
+                        returned if self.rng.random() < return_rate else sold, moment,
+                    ))
+
+                sales.append((
+                    sale_id, format_sale_code(sale_id), self.rng.choice(cashier_ids), total, closed,
+                    card if self.rng.random() < 0.65 else cash, moment, 1, moment,
+                ))
+
+            created += self.insert(Sale, SALE_FIELDS, sales)
+            lines_created += self.insert(SaleProduct, LINE_FIELDS, lines)
+
+            self.stdout.write(f"Sales: {created} / {sale_count} ({lines_created} lines)")
+
+        return lines_created
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options['seed'])
+        self.chunk_size = max(1, options['chunk_size'])
+        self.months = max(1, options['months'])
+
+        try:
+            until = datetime.strptime(options['until'], '%Y-%m-%d').date() if options['until'] else timezone.localdate()
+        except ValueError:
+            raise CommandError("--until must be a YYYY-MM-DD date")
+
+        self.until = datetime.combine(until + timedelta(days=1), time(), tzinfo=timezone.get_current_timezone())
+        self.start = self.until - timedelta(days=30 * self.months)
+        self.days = (self.until - self.start).days
+        self.hours, self.hour_weights = list(HOUR_WEIGHTS), list(accumulate(HOUR_WEIGHTS.values()))
+
+        warehouse_id, cashier_ids = self.create_staff(options['cashiers'])
+
+        # Rows are generated as tuples, building model instances would take most of the time
+        # The history needs the partitions of the past months, on a partitioned database
+        partitions.ensure_partitions(self.start, self.until)
+
+        with explicit_timestamps(Category, Product, ProductPriceHistory, ProductBatch, Sale, SaleProduct):
+            product_ids = self.create_catalog(warehouse_id, options['categories'], options['products'])
+            self.prices = self.create_prices(warehouse_id, product_ids, options['price_change_rate'])
+
+            batch_count = self.insert(ProductBatch, BATCH_FIELDS, self.generate_batches(warehouse_id, product_ids, options['batches']))
+            line_count = self.create_sales(cashier_ids, product_ids, options['sales'], options['lines'], options['return_rate'])
+
+        self.reset_sequences(Category, Product, ProductPriceHistory, ProductBatch, Sale, SaleProduct)
+
+        # Bulk inserts skip the signals, the denormalized tables are rebuilt from the rows
+        call_command('rebuild_stock_levels', stdout=StringIO())
+
+        if not options['skip_rollups']:
+            call_command('rebuild_rollups', stdout=StringIO())
 
-        self.stdout.write(self.style.SUCCESS("Database populated successfully!"))
+        self.stdout.write(self.style.SUCCESS(
+            f"Database populated successfully! {len(product_ids)} products, {batch_count} batches, "
+            f"{options['sales']} sales with {line_count} lines"
+        ))
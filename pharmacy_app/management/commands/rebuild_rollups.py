@@ -0,0 +1,94 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDay, TruncHour
+
+from pharmacy_app.models import SaleProduct, SalesRollup
+from pharmacy_app.rollups import KEY_FIELDS, VALUE_FIELDS
+from pharmacy_app.utils.upsert import lock_for_rebuild
+
+
+KEY_COLUMNS = tuple(f'{name}_id' if name in ('product', 'recorder') else name for name in KEY_FIELDS)
+
+TRUNCATE = {
+    SalesRollup.GranularityChoices.HOUR: TruncHour,
+    SalesRollup.GranularityChoices.DAY: TruncDay,
+}
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the sales rollups from the sale items (checkouts wait while it runs), or checks them with --verify"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify', action='store_true', help="Only compare the rollups with the sale items")
+
+    def expected_rollups(self):
+        """Aggregates the sold and returned sale items into rollup rows"""
+
+        rollups = defaultdict(lambda: [0] * len(VALUE_FIELDS))
+
+        for granularity, trunc in TRUNCATE.items():
+            lines = SaleProduct.objects.filter(
+                sale__isnull=False,
+                status__in=[SaleProduct.SaleProductStatusChoices.SOLD, SaleProduct.SaleProductStatusChoices.RETURNED],
+            ).values_list(
+                trunc('sale__created_at'), 'product_id', 'sale__recorder_id', 'sale__payment_type', 'status'
+            ).annotate(
+                total_quantity=Sum('quantity'), total_amount=Sum(F('quantity') * F('retailPrice')), line_count=Count('id')
+            ).order_by()
+
+            for period, product_id, recorder_id, payment_type, status, quantity, amount, count in lines.iterator():
+                values = rollups[(granularity, period, product_id or 0, recorder_id or 0, payment_type)]
+                offset = 0 if status == SaleProduct.SaleProductStatusChoices.SOLD else 3
+                values[offset:offset + 3] = [quantity, amount, count]
+
+        return rollups
+
+    def stored_rollups(self):
+        rollups = {}
+
+        for row in SalesRollup.objects.values_list(*KEY_COLUMNS, *VALUE_FIELDS).iterator():
+            key, values = row[:len(KEY_COLUMNS)], list(row[len(KEY_COLUMNS):])
+
+            # Rows that went back to zero are the same as missing ones
+            if any(values):
+                rollups[key] = values
+
+        return rollups
+
+    def handle(self, *args, **kwargs):
+
+        if kwargs['verify']:
+            expected = self.expected_rollups()
+            stored = self.stored_rollups()
+            mismatched = [key for key in expected.keys() | stored.keys() if expected.get(key) != stored.get(key)]
+
+            for key in mismatched[:20]:
+                self.stdout.write(self.style.WARNING(f"{key}: expected {expected.get(key)}, stored {stored.get(key)}"))
+
+            if mismatched:
+                raise CommandError(f"{len(mismatched)} of {len(expected)} rollups don't match the sale items")
+
+            self.stdout.write(self.style.SUCCESS(f"All {len(expected)} rollups match the sale items"))
+            return
+
+        with transaction.atomic():
+            # Aggregate once rollup writers are blocked, the sales in flight apply their deltas after
+            lock_for_rebuild(SalesRollup)
+            expected = self.expected_rollups()
+
+            SalesRollup.objects.all().delete()
+            SalesRollup.objects.bulk_create(
+                (
+                    SalesRollup(
+                        **dict(zip(KEY_COLUMNS, key)),
+                        **dict(zip(VALUE_FIELDS, values))
+                    )
+                    for key, values in expected.items()
+                ),
+                batch_size=2000,
+            )
+
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {len(expected)} sales rollups"))
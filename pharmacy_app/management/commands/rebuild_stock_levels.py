@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+
+from pharmacy_app.models import ProductBatch, StockLevel
+from pharmacy_app.utils.upsert import lock_for_rebuild
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the stock-level table from the product batches, checkouts wait while it runs"
+
+    def handle(self, *args, **kwargs):
+
+        levels = ProductBatch.objects.values('product_id', 'retailPrice').annotate(total=Sum('quantity'))
+
+        with transaction.atomic():
+            # Read the batches once stock writers are blocked, the ones in flight apply their deltas after
+            lock_for_rebuild(StockLevel)
+
+            StockLevel.objects.all().delete()
+            StockLevel.objects.bulk_create(
+                (
+                    StockLevel(product_id=level['product_id'], retailPrice=level['retailPrice'], quantity=level['total'])
+                    for level in levels.iterator(chunk_size=2000)
+                ),
+                batch_size=2000,
+            )
+
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {StockLevel.objects.count()} stock levels"))
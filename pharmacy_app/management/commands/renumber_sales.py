@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Min
+
+from pharmacy_app.checkout import format_sale_code
+from pharmacy_app.models import Sale
+
+
+class Command(BaseCommand):
+    help = (
+        "Gives the sales sharing a receipt code (from the old random codes) a numbered one, "
+        "the oldest sale keeps it. Run it before adding the unique index on Sale.code"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **kwargs):
+
+        duplicates = list(Sale.objects.values('code').annotate(count=Count('pk'), first=Min('pk')).filter(count__gt=1).order_by())
+        keep = {row['first'] for row in duplicates}
+        codes = [row['code'] for row in duplicates]
+
+        sale_ids = [
+            sale_id for sale_id in Sale.objects.filter(code__in=codes).values_list('pk', flat=True).order_by('pk')
+            if sale_id not in keep
+        ]
+
+        for start in range(0, len(sale_ids), kwargs['chunk_size']):
+            with transaction.atomic():
+                sales = [Sale(pk=sale_id, code=format_sale_code(sale_id)) for sale_id in sale_ids[start:start + kwargs['chunk_size']]]
+                Sale.objects.bulk_update(sales, ['code'])
+
+        self.stdout.write(self.style.SUCCESS(f"Renumbered {len(sale_ids)} sales"))
@@ -0,0 +1,108 @@
+import os
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.http import require_GET
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+)
+
+# Every worker process writes its samples to files in PROMETHEUS_MULTIPROC_DIR
+# when it is set (before the workers start), /metrics sums them up per host.
+# Only counters and histograms are used, they add up across processes.
+
+REQUESTS = Counter(
+    'pharmacy_http_requests', 'Requests handled, per view, method and status',
+    ['view', 'method', 'status']
+)
+REQUEST_LATENCY = Histogram(
+    'pharmacy_http_request_duration_seconds', 'Time to answer a request, per view and method',
+    ['view', 'method']
+)
+
+SALES = Counter('pharmacy_sales', 'Sales committed')
+SALE_LINES = Histogram(
+    'pharmacy_sale_lines', 'Lines per committed sale',
+    buckets=(1, 2, 3, 5, 8, 13, 21, 34, 55, 89, float('inf'))
+)
+STOCK_DEPLETION = Histogram(
+    'pharmacy_stock_depletion_seconds', 'Time to allocate and deplete the batches of sold lines',
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, float('inf'))
+)
+STOCK_VALIDATION_FAILURES = Counter(
+    'pharmacy_stock_validation_failures', 'Sales rejected for insufficient stock, per checkout stage',
+    ['stage']
+)
+BATCH_ROWS_SCANNED = Counter('pharmacy_batch_rows_scanned', 'Batch rows read to pick the batches of sold lines')
+
+
+def record_sale(lines):
+    """Counts a committed sale with its number of lines"""
+
+    SALES.inc()
+    SALE_LINES.observe(lines)
+
+
+def get_registry():
+
+    if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        return REGISTRY
+
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+@require_GET
+def metrics_view(request):
+    """Serves the metrics in the Prometheus text format, behind METRICS_TOKEN when one is set"""
+
+    token = getattr(settings, 'METRICS_TOKEN', None)
+
+    if token and not constant_time_compare(request.headers.get('Authorization', ''), f"Bearer {token}"):
+        return HttpResponse(status=401)
+
+    return HttpResponse(generate_latest(get_registry()), content_type=CONTENT_TYPE_LATEST)
+
+
+class MetricsMiddleware:
+    """Counts requests and observes their latency per view (the URL name, not the path, to bound the labels)"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        start = time.perf_counter()
+        response = self.get_response(request)
+        self.observe(request, response, time.perf_counter() - start)
+
+        return response
+
+    async def __acall__(self, request):
+
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        self.observe(request, response, time.perf_counter() - start)
+
+        return response
+
+    def observe(self, request, response, duration):
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else 'unresolved'
+
+        REQUESTS.labels(view, request.method, response.status_code).inc()
+        REQUEST_LATENCY.labels(view, request.method).observe(duration)
@@ -1,8 +1,95 @@
-from django.utils.deprecation import MiddlewareMixin
-from pharmacy_app.utils.thread_local import set_current_user
+import time
 
-class CurrentUserMiddleware(MiddlewareMixin):
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
 
-    def process_request(self, request):
-        if request.user.is_authenticated:
-            set_current_user(request.user)
\ No newline at end of file
+from pharmacy_app.routers import routing
+from pharmacy_app.utils.current_user import bind_request, release_request
+
+
+class CurrentUserMiddleware:
+    """Makes the request's user available to signals for the duration of the request"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        token = bind_request(request)
+        try:
+            return self.get_response(request)
+        finally:
+            release_request(token)
+
+    async def __acall__(self, request):
+
+        token = bind_request(request)
+        try:
+            return await self.get_response(request)
+        finally:
+            release_request(token)
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Lets the safe requests of @read_from_replica views read from a replica.
+
+    A request that writes is pinned to the primary and so is its client, by
+    a cookie, for REPLICA_LAG_WINDOW seconds after the write.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    COOKIE = 'db_primary_until'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def recently_wrote(self, request):
+        try:
+            return float(request.COOKIES.get(self.COOKIE, 0)) > time.time()
+        except ValueError:
+            return False
+
+    def remember_write(self, response, state):
+
+        if state.wrote:
+            window = getattr(settings, 'REPLICA_LAG_WINDOW', 5)
+            response.set_cookie(self.COOKIE, str(time.time() + window), max_age=window, httponly=True, samesite='Lax')
+
+        return response
+
+    def __call__(self, request):
+
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        with routing(pinned=self.recently_wrote(request)) as state:
+            request.db_routing = state
+            return self.remember_write(self.get_response(request), state)
+
+    async def __acall__(self, request):
+
+        with routing(pinned=self.recently_wrote(request)) as state:
+            request.db_routing = state
+            return self.remember_write(await self.get_response(request), state)
+
+    def process_view(self, request, view_func, args, kwargs):
+
+        view = getattr(view_func, 'cls', None) or getattr(view_func, 'view_class', None) or view_func
+
+        if request.method in ('GET', 'HEAD') and getattr(view, 'read_from_replica', False):
+            request.db_routing.replica = True
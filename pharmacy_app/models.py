@@ -1,7 +1,8 @@
 import uuid
 from django.contrib.auth.models import AbstractUser, Permission, Group
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
 
 
 class Staff(AbstractUser):
@@ -30,14 +31,48 @@ class Staff(AbstractUser):
         return self.first_name
 
 
-class Category(models.Model):
+class VersionedModel(models.Model):
+    """Keeps a version counter and modification time, used to revalidate HTTP caches"""
+
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+    version = models.PositiveIntegerField(default=1, editable=False)
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+
+        if not self._state.adding:
+            self.version += 1
+
+        # A partial save still has to move the validators
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = {*update_fields, 'updated_at', 'version'}
+
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def touch(cls, **filters):
+        """Bumps the version of the matching rows, for changes made without saving them"""
+
+        return cls.objects.filter(**filters).update(**cls.touched())
+
+    @staticmethod
+    def touched():
+        """Returns the update() values that bump the version, to go along with bulk updates"""
+
+        return {'version': models.F('version') + 1, 'updated_at': timezone.now()}
+
+
+class Category(VersionedModel):
     title = models.CharField(max_length=120)
 
     def __str__(self):
         return self.title
 
 
-class Product(models.Model):
+class Product(VersionedModel):
 
     title = models.CharField(max_length=120)
     photo = models.ImageField(null=True, blank=True)
@@ -47,7 +82,20 @@ class Product(models.Model):
     def __str__(self):
         return self.title
 
-class Sale(models.Model):
+
+class ProductBarcode(models.Model):
+    """A barcode / SKU printed on a product's packaging, a product can have several"""
+
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="barcodes")
+
+    # Unique, so it is also the index the till's scan lookup goes through
+    code = models.CharField(max_length=64, unique=True)
+
+    def __str__(self):
+        return self.code
+
+
+class Sale(VersionedModel):
 
     class SaleStatusChoices(models.TextChoices):
         IN_PROGRESS = "InProgress"
@@ -58,16 +106,32 @@ class Sale(models.Model):
         CASH = "Cash"
 
     sale_id = models.AutoField(primary_key=True)
-    code = models.CharField(max_length=120)
+    # Receipt number, drawn from the primary key sequence (checkout.create_numbered_sale)
+    code = models.CharField(max_length=120, unique=True)
     recorder = models.ForeignKey(Staff, on_delete=models.SET_NULL, null=True)
     totalAmount = models.DecimalField(max_digits=10, decimal_places=2)
     status = models.CharField(choices=SaleStatusChoices, default=SaleStatusChoices.IN_PROGRESS)
     payment_type = models.CharField(choices=PaymentTypeChoices, default=PaymentTypeChoices.CARD)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
     items = models.ManyToManyField(Product, through='SaleProduct', related_name='items')
 
+    class Meta:
+        indexes = [
+            # The list filters (ListFilterMixin), alone or with a date range
+            models.Index(fields=['recorder', 'created_at'], name='sale_recorder_date_idx'),
+            models.Index(fields=['status', 'created_at'], name='sale_status_date_idx'),
+            models.Index(fields=['payment_type', 'created_at'], name='sale_payment_date_idx'),
+        ]
+
     def __str__(self):
         return self.code
 
+    def save(self, *args, **kwargs):
+
+        # Closing the sale sells its pending items (signals) in the same transaction
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
 
 class SaleProduct(models.Model):
 
@@ -76,26 +140,52 @@ class SaleProduct(models.Model):
         RETURNED = "Returned"
         PENDING = "Pending"
 
-    sale = models.ForeignKey(Sale, related_name='sale_products', on_delete=models.SET_NULL, null=True)
+    # Without a constraint, the sales table can be partitioned (partition_sales)
+    sale = models.ForeignKey(Sale, related_name='sale_products', on_delete=models.SET_NULL, null=True, db_constraint=False)
     product = models.ForeignKey(Product, on_delete=models.SET_NULL, null=True)
     quantity = models.DecimalField(decimal_places=2, max_digits=20)
     retailPrice = models.DecimalField(decimal_places=2, max_digits=20)
     status = models.CharField(choices=SaleProductStatusChoices)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of the items of a sale / the sales of a product
+            models.Index(fields=['sale', 'id'], name='saleproduct_sale_page_idx'),
+            models.Index(fields=['product', 'id'], name='saleproduct_product_page_idx'),
+            # The list filters (ListFilterMixin) of the sales of a product, and the items by status
+            models.Index(fields=['product', 'created_at'], name='saleproduct_product_date_idx'),
+            models.Index(fields=['product', 'status', 'id'], name='saleproduct_product_status_idx'),
+            models.Index(fields=['status', 'created_at'], name='saleproduct_status_date_idx'),
+        ]
 
     @property
     def total(self):
         return self.quantity * self.retailPrice
 
+    def save(self, *args, **kwargs):
+
+        # Roll the item back if its stock can't be settled (signals)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
 
-class ProductPriceHistory(models.Model):
+
+class ProductPriceHistory(VersionedModel):
 
     product = models.ForeignKey(Product, on_delete=models.SET_NULL, null=True)
     oldPrice = models.DecimalField(decimal_places=2, max_digits=20)
     newPrice = models.DecimalField(decimal_places=2, max_digits=20)
     recorder = models.ForeignKey(Staff, on_delete=models.SET_NULL, null=True)
 
+    class Meta:
+        indexes = [
+            # Keyset pagination of the price history by product / by recorder
+            models.Index(fields=['product', 'id'], name='pricehistory_product_page_idx'),
+            models.Index(fields=['recorder', 'id'], name='pricehistory_recorder_page_idx'),
+        ]
+
 
-class ProductBatch(models.Model):
+class ProductBatch(VersionedModel):
 
     class ProductBatchSourceChoices(models.TextChoices):
         PURCHASED = "Purchased"
@@ -111,9 +201,138 @@ class ProductBatch(models.Model):
 
     arrival_date = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # Serves the FIFO depletion scan with an index-only read of the in-stock batches
+            models.Index(
+                fields=['product', 'retailPrice', 'arrival_date'],
+                include=['id', 'quantity'],
+                condition=models.Q(quantity__gt=0),
+                name='batch_in_stock_fifo_idx',
+            ),
+        ]
+
     def __str__(self):
         return f"{self.product.title} - {self.quantity} units @ ${self.unitPrice}"
 
+    def save(self, *args, **kwargs):
+
+        # Keep the batch and its stock level (updated by signals) in one transaction
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+
+        with transaction.atomic():
+            return super().delete(*args, **kwargs)
+
     @property
     def profit_per_sale(self):
-            return self.retailPrice - self.unitPrice
\ No newline at end of file
+            return self.retailPrice - self.unitPrice
+
+
+class ArchivedProductBatch(models.Model):
+    """A depleted ProductBatch moved out of the hot table (archive_batches), under its original id"""
+
+    id = models.BigIntegerField(primary_key=True)
+
+    # Kept without constraints like the allocations pointing here, the history outlives the product
+    product = models.ForeignKey(Product, on_delete=models.DO_NOTHING, db_constraint=False, null=True, related_name='+')
+    recorder = models.ForeignKey(Staff, on_delete=models.DO_NOTHING, db_constraint=False, null=True, related_name='+')
+
+    quantity = models.DecimalField(decimal_places=2, max_digits=20)
+    unitPrice = models.DecimalField(decimal_places=2, max_digits=20)
+    retailPrice = models.DecimalField(decimal_places=2, max_digits=20)
+    source = models.CharField(choices=ProductBatch.ProductBatchSourceChoices, max_length=20)
+
+    arrival_date = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['product', 'arrival_date'], name='archivedbatch_product_date_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} - archived batch @ ${self.unitPrice}"
+
+
+class StockLevel(models.Model):
+    """Denormalized on-hand quantity of a product at a retail price"""
+
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="stock_levels")
+    retailPrice = models.DecimalField(decimal_places=2, max_digits=20)
+    quantity = models.DecimalField(decimal_places=2, max_digits=20, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'retailPrice'], name='unique_stock_level'),
+        ]
+
+    def __str__(self):
+        return f"{self.product.title} - {self.quantity} units @ ${self.retailPrice}"
+
+
+class SalesRollup(models.Model):
+    """Sold and returned totals per period, product, cashier and payment type"""
+
+    class GranularityChoices(models.TextChoices):
+        HOUR = "Hour"
+        DAY = "Day"
+
+    granularity = models.CharField(choices=GranularityChoices, max_length=10)
+    period = models.DateTimeField()
+
+    # Kept without constraints so the history survives deleting the product or staff. A missing
+    # product or cashier is stored as 0 to keep NULLs out of the unique key, null=True only makes
+    # joins through them outer joins.
+    product = models.ForeignKey(Product, on_delete=models.DO_NOTHING, db_constraint=False, null=True, related_name='+')
+    recorder = models.ForeignKey(Staff, on_delete=models.DO_NOTHING, db_constraint=False, null=True, related_name='+')
+    payment_type = models.CharField(choices=Sale.PaymentTypeChoices, max_length=10)
+
+    sold_quantity = models.DecimalField(decimal_places=2, max_digits=20, default=0)
+    sold_amount = models.DecimalField(decimal_places=2, max_digits=20, default=0)
+    sold_lines = models.IntegerField(default=0)
+    returned_quantity = models.DecimalField(decimal_places=2, max_digits=20, default=0)
+    returned_amount = models.DecimalField(decimal_places=2, max_digits=20, default=0)
+    returned_lines = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['granularity', 'period', 'product', 'recorder', 'payment_type'],
+                name='unique_sales_rollup',
+            ),
+        ]
+
+
+class BatchAllocation(models.Model):
+    """Quantity of a batch that went into a sale item, negative when the item was returned"""
+
+    # Without a constraint, the sale items table can be partitioned (partition_sales)
+    sale_product = models.ForeignKey(SaleProduct, on_delete=models.CASCADE, related_name='allocations', db_constraint=False)
+
+    # Kept without constraints so the cost history survives deleting the batch or product
+    batch = models.ForeignKey(ProductBatch, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    product = models.ForeignKey(Product, on_delete=models.DO_NOTHING, db_constraint=False, null=True, related_name='+')
+
+    quantity = models.DecimalField(decimal_places=2, max_digits=20)
+    unitPrice = models.DecimalField(decimal_places=2, max_digits=20)
+    retailPrice = models.DecimalField(decimal_places=2, max_digits=20)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['product', 'created_at'], name='allocation_product_date_idx'),
+            models.Index(fields=['created_at'], name='allocation_date_idx'),
+        ]
+
+    @property
+    def cost(self):
+        return self.quantity * self.unitPrice
+
+    @property
+    def revenue(self):
+        return self.quantity * self.retailPrice
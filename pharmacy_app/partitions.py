@@ -0,0 +1,336 @@
+import logging
+import re
+from datetime import datetime
+
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+from django.utils import timezone
+
+from pharmacy_app.models import Sale, SaleProduct
+
+# Range partitioned by month on their creation time (PostgreSQL only), sales first,
+# converting a table drops the foreign keys pointing at it
+PARTITIONED = (Sale, SaleProduct)
+PARTITION_KEY = 'created_at'
+
+_MONTH = re.compile(r'_y(\d{4})m(\d{2})$')
+
+logger = logging.getLogger(__name__)
+
+
+def is_supported():
+    return connection.vendor == 'postgresql'
+
+
+def qn(name):
+    return connection.ops.quote_name(name)
+
+
+def month_start(moment):
+    """The first moment of the month of `moment`, in the project's time zone"""
+
+    return timezone.localtime(moment, timezone.get_default_timezone()).replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0
+    )
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def partition_name(table, month):
+    return f"{table}_y{month.year}m{month.month:02d}"
+
+
+def default_partition_name(table):
+    return f"{table}_default"
+
+
+def is_partitioned(model):
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)", [model._meta.db_table])
+        return cursor.fetchone() is not None
+
+
+def list_partitions(table):
+    """Returns the monthly partitions of a table as sorted (month, name) pairs"""
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass(%s)",
+            [table]
+        )
+        names = [name for name, in cursor.fetchall()]
+
+    partitions = []
+    for name in names:
+        match = _MONTH.search(name)
+        if match:
+            month = datetime(int(match[1]), int(match[2]), 1, tzinfo=timezone.get_default_timezone())
+            partitions.append((month, name))
+
+    return sorted(partitions)
+
+
+def create_default_partition(table):
+    """Creates the partition rows outside every month go to, so inserts never fail for a missing month"""
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS {qn(default_partition_name(table))} PARTITION OF {qn(table)} DEFAULT")
+
+
+def create_partitions(table, start, end):
+    """
+    Creates the missing monthly partitions of a table from the month of `start` through the month of `end`.
+
+    Rows of a new month already in the default partition are moved to it, the
+    month is then attached like the others.
+    """
+
+    existing = {name for month, name in list_partitions(table)}
+    default = default_partition_name(table)
+    key = qn(PARTITION_KEY)
+    created = []
+
+    month = month_start(start)
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL", [default])
+        has_default = cursor.fetchone()[0]
+
+        while month <= end:
+            name = partition_name(table, month)
+            bounds = [month, add_months(month, 1)]
+
+            if name in existing:
+                month = add_months(month, 1)
+                continue
+
+            if has_default:
+                with transaction.atomic():
+                    cursor.execute(
+                        f"CREATE TABLE {qn(name)} (LIKE {qn(table)} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING STORAGE)"
+                    )
+                    cursor.execute(
+                        f"WITH moved AS (DELETE FROM {qn(default)} WHERE {key} >= %s AND {key} < %s RETURNING *) "
+                        f"INSERT INTO {qn(name)} SELECT * FROM moved",
+                        bounds
+                    )
+                    cursor.execute(f"ALTER TABLE {qn(table)} ATTACH PARTITION {qn(name)} FOR VALUES FROM (%s) TO (%s)", bounds)
+            else:
+                cursor.execute(f"CREATE TABLE {qn(name)} PARTITION OF {qn(table)} FOR VALUES FROM (%s) TO (%s)", bounds)
+
+            created.append(name)
+            month = add_months(month, 1)
+
+    return created
+
+
+def ensure_partitions(start=None, end=None):
+    """
+    Creates the partitions the sales between `start` and `end` go to.
+
+    Defaults to the current month through SALES_PARTITION_MONTHS_AHEAD months
+    ahead. Runs on migrate, from partition_sales create and from the first
+    checkout of every month (ensure_current). Sales outside the partitions
+    still go to the default partition, and move to their month once it's
+    created. Does nothing until the tables have been converted.
+    """
+
+    if not is_supported():
+        return []
+
+    start = start or timezone.now()
+    end = end or add_months(month_start(start), getattr(settings, 'SALES_PARTITION_MONTHS_AHEAD', 3))
+    created = []
+
+    for model in PARTITIONED:
+        if is_partitioned(model):
+            create_default_partition(model._meta.db_table)
+            created += create_partitions(model._meta.db_table, start, end)
+
+    return created
+
+
+# Start of the month after the last one this process ensured the partitions in
+_ensured_until = None
+
+
+def ensure_current():
+    """
+    Tops up the partitions ahead the first time a process checks out in a month.
+
+    A comparison the rest of the month. Called by commit_sale(), so the months
+    ahead keep coming without migrate or a scheduled partition_sales create.
+    Failing to create them (e.g. another process creating the same month) is
+    left to the next month's check, the sale itself isn't affected.
+    """
+
+    global _ensured_until
+
+    now = timezone.now()
+
+    if not is_supported() or (_ensured_until is not None and now < _ensured_until):
+        return
+
+    try:
+        with transaction.atomic():
+            ensure_partitions(now)
+    except DatabaseError:
+        logger.exception("Couldn't create the sales partitions ahead")
+
+    _ensured_until = add_months(month_start(now), 1)
+
+
+def create_on_migrate(sender, **kwargs):
+    """post_migrate receiver keeping the partitions of the coming months in place"""
+
+    if sender.name == 'pharmacy_app':
+        ensure_partitions()
+
+
+def convert(model, chunk_size=50000, backfill_lines=False):
+    """
+    Turns the table of `model` into a table partitioned by month, in one transaction.
+
+    Writes are blocked while the rows are copied to the new partitions and the
+    table is locked exclusively for the swap, so it's meant for a maintenance
+    window. The primary key becomes (pk, created_at) as PostgreSQL requires,
+    foreign keys into the table are dropped (the models don't declare them)
+    and its other indexes and foreign keys are recreated on the new table.
+    Unique indexes not covering created_at can't be, they come back as plain
+    indexes (the sale codes are unique by construction), their names are
+    returned.
+    """
+
+    table = model._meta.db_table
+    new_table = f"{table}_partitioned"
+    pk = model._meta.pk.column
+    key = model._meta.get_field(PARTITION_KEY).column
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"LOCK TABLE {qn(table)} IN SHARE MODE")
+
+        if backfill_lines:
+            # Lines from before the column existed share the time it was added, give them their sale's
+            cursor.execute(
+                f"UPDATE {qn(table)} AS line SET {qn(key)} = sale.{qn(Sale._meta.get_field(PARTITION_KEY).column)} "
+                f"FROM {qn(Sale._meta.db_table)} AS sale "
+                f"WHERE line.{qn(model._meta.get_field('sale').column)} = sale.{qn(Sale._meta.pk.column)}"
+            )
+
+        cursor.execute(
+            "SELECT pg_get_indexdef(i.indexrelid), i.indisunique, i.indisprimary, c.relname "
+            "FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE i.indrelid = to_regclass(%s)",
+            [table]
+        )
+        indexes = cursor.fetchall()
+
+        partitioned_tables = {partitioned._meta.db_table for partitioned in PARTITIONED}
+
+        cursor.execute(
+            "SELECT conname, pg_get_constraintdef(oid), confrelid::regclass::text FROM pg_constraint "
+            "WHERE conrelid = to_regclass(%s) AND contype = 'f'",
+            [table]
+        )
+        foreign_keys = [
+            (name, definition) for name, definition, target in cursor.fetchall()
+            if target.strip('"') not in partitioned_tables
+        ]
+
+        cursor.execute(
+            "SELECT conrelid::regclass::text, conname FROM pg_constraint WHERE confrelid = to_regclass(%s) AND contype = 'f'",
+            [table]
+        )
+        incoming = cursor.fetchall()
+
+        cursor.execute(f"SELECT MIN({qn(key)}), MAX({qn(key)}), MAX({qn(pk)}), COUNT(*) FROM {qn(table)}")
+        first, last, last_pk, count = cursor.fetchone()
+
+        cursor.execute(
+            f"CREATE TABLE {qn(new_table)} (LIKE {qn(table)} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING STORAGE INCLUDING COMMENTS) "
+            f"PARTITION BY RANGE ({qn(key)})"
+        )
+        cursor.execute(f"ALTER TABLE {qn(new_table)} ADD PRIMARY KEY ({qn(pk)}, {qn(key)})")
+
+        now = timezone.now()
+        create_default_partition(new_table)
+        create_partitions(
+            new_table, min(first or now, now),
+            add_months(month_start(max(last or now, now)), getattr(settings, 'SALES_PARTITION_MONTHS_AHEAD', 3))
+        )
+
+        # Copied in primary key ranges, to keep each statement's memory bounded
+        for low in range(0, last_pk or 0, chunk_size):
+            cursor.execute(
+                f"INSERT INTO {qn(new_table)} SELECT * FROM {qn(table)} WHERE {qn(pk)} > %s AND {qn(pk)} <= %s",
+                [low, low + chunk_size]
+            )
+
+        cursor.execute(f"SELECT COUNT(*) FROM {qn(new_table)}")
+        if cursor.fetchone()[0] != count:
+            raise RuntimeError(f"Copied a different number of rows than {table} holds, nothing was changed")
+
+        cursor.execute(f"LOCK TABLE {qn(table)} IN ACCESS EXCLUSIVE MODE")
+
+        for referencing, name in incoming:
+            cursor.execute(f"ALTER TABLE {referencing} DROP CONSTRAINT {qn(name)}")
+
+        cursor.execute(f"DROP TABLE {qn(table)}")
+        cursor.execute(f"ALTER TABLE {qn(new_table)} RENAME TO {qn(table)}")
+
+        # The partitions keep the names they were created with under the old table name
+        for month, name in list_partitions(table):
+            cursor.execute(f"ALTER TABLE {qn(name)} RENAME TO {qn(partition_name(table, month))}")
+        cursor.execute(f"ALTER TABLE {qn(default_partition_name(new_table))} RENAME TO {qn(default_partition_name(table))}")
+
+        sequence = f"{table}_{pk}_seq"
+        cursor.execute(f"CREATE SEQUENCE {qn(sequence)} OWNED BY {qn(table)}.{qn(pk)}")
+        cursor.execute("SELECT setval(%s, %s, false)", [sequence, (last_pk or 0) + 1])
+        cursor.execute(f"ALTER TABLE {qn(table)} ALTER COLUMN {qn(pk)} SET DEFAULT nextval(%s::regclass)", [sequence])
+
+        relaxed = []
+        for definition, unique, primary, name in indexes:
+            if primary:
+                continue
+            if unique:
+                definition = definition.replace("CREATE UNIQUE INDEX", "CREATE INDEX", 1)
+                relaxed.append(name)
+            cursor.execute(definition)
+
+        for name, definition in foreign_keys:
+            cursor.execute(f"ALTER TABLE {qn(table)} ADD CONSTRAINT {qn(name)} {definition}")
+
+    return relaxed
+
+
+def detach_partitions(model, before, drop=False, tablespace=None):
+    """
+    Detaches the monthly partitions ending before `before`, oldest first.
+
+    A detached partition stays around as a plain table, unless it's dropped or
+    moved to `tablespace` (cheaper, e.g. compressed, storage). Detaching is
+    done concurrently where the server supports it (PostgreSQL 14), so it
+    doesn't block the queries on the rest of the table. Returns the names.
+    """
+
+    table = model._meta.db_table
+    concurrently = " CONCURRENTLY" if connection.pg_version >= 140000 else ""
+    detached = []
+
+    with connection.cursor() as cursor:
+        for month, name in list_partitions(table):
+            if add_months(month, 1) > before:
+                break
+
+            cursor.execute(f"ALTER TABLE {qn(table)} DETACH PARTITION {qn(name)}{concurrently}")
+
+            if drop:
+                cursor.execute(f"DROP TABLE {qn(name)}")
+            elif tablespace:
+                cursor.execute(f"ALTER TABLE {qn(name)} SET TABLESPACE {qn(tablespace)}")
+
+            detached.append(name)
+
+    return detached
@@ -0,0 +1,109 @@
+import json
+import time
+from datetime import timedelta
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import models, router, transaction
+from django.utils import timezone
+
+from pharmacy_app.timing import get_timings
+
+
+def record_request(request, response, started, finished, timings):
+    """
+    Stores a request that wasn't sampled up front in Silk's tables.
+
+    The queries come from the request's Server-Timing numbers, so only the
+    ones slower than SLOW_QUERY_LOG_MS are kept with their SQL.
+    """
+
+    from silk.models import Request, Response, SQLQuery
+
+    # Taken before writing, the writes would otherwise count as the request's queries
+    queries = list(timings.slow_queries) if timings else []
+    num_queries = timings.queries if timings else 0
+
+    with transaction.atomic(using=router.db_for_write(Request)):
+        silk_request = Request(
+            path=request.path,
+            method=request.method,
+            query_params=json.dumps(request.GET.dict()),
+            view_name=getattr(request.resolver_match, 'view_name', '') or '',
+            start_time=started,
+            end_time=finished,
+            num_sql_queries=num_queries,
+        )
+        silk_request.save()
+
+        Response.objects.create(request=silk_request, status_code=response.status_code)
+
+        # Silk's manager saves the request again for every query, write them in one statement instead
+        models.QuerySet(SQLQuery).using(router.db_for_write(SQLQuery)).bulk_create([
+            SQLQuery(
+                request=silk_request,
+                query=sql,
+                start_time=query_finished - timedelta(seconds=duration),
+                end_time=query_finished,
+                time_taken=duration * 1000,
+                traceback='',
+            )
+            for sql, duration, query_finished in queries
+        ])
+
+
+class SlowRequestProfilingMiddleware:
+    """
+    Stores requests slower than PROFILING_SLOW_REQUEST_MS in the profiling store.
+
+    Silk decides whether to profile a request before it runs, this catches
+    the slow ones it skipped. It wraps no connections itself, the query
+    count and the slow queries are the ones ServerTimingMiddleware (which
+    must come first) already collects.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.threshold = getattr(settings, 'PROFILING_SLOW_REQUEST_MS', None)
+
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def finish(self, request, response, started, duration, timings):
+
+        if getattr(request, 'silk_is_intercepted', False) or duration * 1000 < self.threshold:
+            return
+
+        record_request(request, response, started, started + timedelta(seconds=duration), timings)
+
+    def __call__(self, request):
+
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        if self.threshold is None:
+            return self.get_response(request)
+
+        started, start = timezone.now(), time.perf_counter()
+
+        response = self.get_response(request)
+
+        self.finish(request, response, started, time.perf_counter() - start, get_timings())
+
+        return response
+
+    async def __acall__(self, request):
+
+        if self.threshold is None:
+            return await self.get_response(request)
+
+        started, start = timezone.now(), time.perf_counter()
+
+        response = await self.get_response(request)
+
+        await sync_to_async(self.finish)(request, response, started, time.perf_counter() - start, get_timings())
+
+        return response
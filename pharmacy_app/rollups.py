@@ -0,0 +1,85 @@
+from collections import namedtuple
+from decimal import Decimal
+
+from django.utils import timezone
+
+from pharmacy_app.models import SaleProduct, SalesRollup
+from pharmacy_app.utils.upsert import upsert_increment
+
+
+KEY_FIELDS = ('granularity', 'period', 'product', 'recorder', 'payment_type')
+VALUE_FIELDS = (
+    'sold_quantity', 'sold_amount', 'sold_lines', 'returned_quantity', 'returned_amount', 'returned_lines'
+)
+
+# What a sale line adds to the rollups, captured before and after a change
+LineState = namedtuple(
+    'LineState', ('product_id', 'status', 'quantity', 'retailPrice', 'created_at', 'recorder_id', 'payment_type')
+)
+
+
+def line_state(line, sale):
+    """Returns the rollup state of a line of the given sale, or None when it isn't part of a sale"""
+
+    if sale is None:
+        return None
+
+    return LineState(
+        line.product_id, line.status, line.quantity, line.retailPrice,
+        sale.created_at, sale.recorder_id, sale.payment_type
+    )
+
+
+def truncate(moment, granularity):
+    """Returns the start of the hour or day `moment` falls in, in the current time zone"""
+
+    moment = timezone.localtime(moment).replace(minute=0, second=0, microsecond=0)
+
+    if granularity == SalesRollup.GranularityChoices.DAY:
+        moment = moment.replace(hour=0)
+
+    return moment
+
+
+def _contribution(state, sign):
+    """Returns the rollup deltas of a line state, or None for lines that aren't sold or returned"""
+
+    amount = state.quantity * state.retailPrice
+    zero = Decimal(0)
+
+    if state.status == SaleProduct.SaleProductStatusChoices.SOLD:
+        return [sign * state.quantity, sign * amount, sign, zero, zero, 0]
+
+    if state.status == SaleProduct.SaleProductStatusChoices.RETURNED:
+        return [zero, zero, 0, sign * state.quantity, sign * amount, sign]
+
+    return None
+
+
+def update_rollups(removed=(), added=()):
+    """
+    Moves line states out of / into the hourly and daily rollups.
+
+    A change to a line is passed as its state before (removed) and after
+    (added); all the deltas are written with one upsert statement.
+    """
+
+    rows = []
+
+    for states, sign in ((removed, -1), (added, 1)):
+        for state in states:
+            if state is None:
+                continue
+
+            deltas = _contribution(state, sign)
+            if deltas is None:
+                continue
+
+            for granularity in SalesRollup.GranularityChoices.values:
+                key = [
+                    granularity, truncate(state.created_at, granularity),
+                    state.product_id or 0, state.recorder_id or 0, state.payment_type
+                ]
+                rows.append(key + deltas)
+
+    return upsert_increment(SalesRollup, KEY_FIELDS, VALUE_FIELDS, rows)
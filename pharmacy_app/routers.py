@@ -0,0 +1,117 @@
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+
+class RoutingState:
+    """Where the reads of the current request may go"""
+
+    __slots__ = ('replica', 'pinned', 'wrote')
+
+    def __init__(self, replica=False, pinned=False):
+        # The view allows replica reads / reads must see recent writes / the request wrote
+        self.replica = replica
+        self.pinned = pinned
+        self.wrote = False
+
+
+_routing = ContextVar('db_routing', default=None)
+
+# Apps whose writes don't make the following reads need the primary (profiling data)
+UNPINNED_APPS = {'silk'}
+
+PROFILING_DB_ALIAS = 'profiling'
+
+
+def read_from_replica(view):
+    """Marks a view whose safe (GET / HEAD) requests may read from a replica"""
+
+    view.read_from_replica = True
+    return view
+
+
+@contextmanager
+def routing(replica=False, pinned=False):
+    """Routes the reads made inside the block, the request middleware uses it per request"""
+
+    state = RoutingState(replica, pinned)
+    token = _routing.set(state)
+    try:
+        yield state
+    finally:
+        _routing.reset(token)
+
+
+class ProfilingRouter:
+    """Keeps Silk's profiling data in its own database, when one is configured"""
+
+    def _db_for(self, model):
+        if model._meta.app_label == 'silk' and PROFILING_DB_ALIAS in settings.DATABASES:
+            return PROFILING_DB_ALIAS
+        return None
+
+    def db_for_read(self, model, **hints):
+        return self._db_for(model)
+
+    def db_for_write(self, model, **hints):
+        return self._db_for(model)
+
+    def allow_relation(self, obj1, obj2, **hints):
+
+        if 'silk' in (obj1._meta.app_label, obj2._meta.app_label):
+            return obj1._meta.app_label == obj2._meta.app_label
+
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+
+        if PROFILING_DB_ALIAS not in settings.DATABASES:
+            return None
+
+        if app_label == 'silk' or db == PROFILING_DB_ALIAS:
+            return app_label == 'silk' and db == PROFILING_DB_ALIAS
+
+        return None
+
+
+class PrimaryReplicaRouter:
+    """
+    Sends the reads of replica-enabled views to a random replica.
+
+    Everything else goes to the primary: writes, reads outside such views
+    and every read of a request after it wrote (or locked rows, which goes
+    through db_for_write too).
+    A request that wrote also keeps the client on the primary for a short
+    window (see ReplicaRoutingMiddleware), so it reads its own writes despite
+    the replica lag.
+    """
+
+    def db_for_read(self, model, **hints):
+
+        state = _routing.get()
+        replicas = getattr(settings, 'DATABASE_REPLICAS', [])
+
+        if state is None or not state.replica or state.pinned or not replicas:
+            return DEFAULT_DB_ALIAS
+
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+
+        state = _routing.get()
+
+        if state is not None and model._meta.app_label not in UNPINNED_APPS:
+            state.pinned = state.wrote = True
+
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get their schema through replication
+        return db == DEFAULT_DB_ALIAS
@@ -0,0 +1,617 @@
+import bisect
+import heapq
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import connections, transaction
+from django.db.models import F, Q, Value
+from django.utils import timezone
+
+from pharmacy_app import catalog_cache
+from pharmacy_app.models import Product, Category
+
+_WORDS = re.compile(r'\w+')
+
+# Matches ranked and candidates read per query, bounding the work of short / common terms
+MAX_MATCHES = 100
+MAX_SCANNED = 2000
+
+# Words read when correcting a term, the closest ones compared and their least similarity
+MAX_POSTINGS = 5000
+MAX_CORRECTIONS = 50
+MIN_SIMILARITY = 0.4
+
+# Least word similarity of a title to the query in the database search
+MIN_DATABASE_SIMILARITY = 0.3
+
+
+def normalize(text):
+    """Casefolds the text and strips its accents"""
+
+    text = unicodedata.normalize('NFKD', text.casefold())
+    return ''.join(char for char in text if not unicodedata.combining(char))
+
+
+def split_words(text):
+    return tuple(_WORDS.findall(normalize(text or '')))
+
+
+def word_text(words):
+    """The words as one space-delimited string, so word matches are substring checks"""
+
+    return f" {' '.join(words)} "
+
+
+def trigrams(word):
+    """Trigrams of a word, padded like pg_trgm so short words and word starts have some"""
+
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class ProductIndex:
+    """
+    In-memory typeahead index over the product and category titles.
+
+    Every word of a title is kept in a sorted list of (word, id) pairs, so a
+    prefix is found with two binary searches and its matches are read in
+    order. Terms matching no word are corrected to the closest word of the
+    vocabulary by trigram similarity, for typos.
+    """
+
+    def __init__(self, products=(), categories=()):
+        self.products = {}
+        self.categories = {}
+        self.category_products = defaultdict(set)
+        self.product_words = []
+        self.category_words = []
+        self.vocabulary = Counter()
+        self.word_trigrams = defaultdict(set)
+
+        for category_id, title in categories:
+            words = split_words(title)
+            self.categories[category_id] = (title, word_text(words))
+            self.category_words += [(word, category_id) for word in words]
+
+        for product_id, title, category_id in products:
+            words = split_words(title)
+            self.products[product_id] = (title, category_id, word_text(words))
+            self.category_products[category_id].add(product_id)
+            self.product_words += [(word, product_id) for word in words]
+            self.vocabulary.update(words)
+
+        for word in self.vocabulary:
+            for gram in trigrams(word):
+                self.word_trigrams[gram].add(word)
+
+        self.product_words.sort()
+        self.category_words.sort()
+
+    # Updates
+
+    def add_product(self, product_id, title, category_id):
+        self.remove_product(product_id)
+
+        words = split_words(title)
+        self.products[product_id] = (title, category_id, word_text(words))
+        self.category_products[category_id].add(product_id)
+
+        for word in words:
+            bisect.insort(self.product_words, (word, product_id))
+
+            if not self.vocabulary[word]:
+                for gram in trigrams(word):
+                    self.word_trigrams[gram].add(word)
+
+            self.vocabulary[word] += 1
+
+    def remove_product(self, product_id):
+        product = self.products.pop(product_id, None)
+
+        if product is None:
+            return
+
+        title, category_id, text = product
+        self.category_products[category_id].discard(product_id)
+
+        for word in text.split():
+            self._remove_pair(self.product_words, (word, product_id))
+            self.vocabulary[word] -= 1
+
+            if not self.vocabulary[word]:
+                del self.vocabulary[word]
+
+                for gram in trigrams(word):
+                    self.word_trigrams[gram].discard(word)
+
+    def add_category(self, category_id, title):
+        self._remove_category_words(category_id)
+
+        words = split_words(title)
+        self.categories[category_id] = (title, word_text(words))
+
+        for word in words:
+            bisect.insort(self.category_words, (word, category_id))
+
+    def remove_category(self, category_id):
+        self._remove_category_words(category_id)
+        self.categories.pop(category_id, None)
+
+        # The products lose their category (SET_NULL)
+        for product_id in self.category_products.pop(category_id, set()):
+            title, _, text = self.products[product_id]
+            self.products[product_id] = (title, None, text)
+            self.category_products[None].add(product_id)
+
+    def _remove_category_words(self, category_id):
+        if category_id in self.categories:
+            for word in self.categories[category_id][1].split():
+                self._remove_pair(self.category_words, (word, category_id))
+
+    @staticmethod
+    def _remove_pair(pairs, pair):
+        i = bisect.bisect_left(pairs, pair)
+        if i < len(pairs) and pairs[i] == pair:
+            del pairs[i]
+
+    # Lookups
+
+    @staticmethod
+    def _prefix_range(pairs, prefix):
+        return bisect.bisect_left(pairs, (prefix,)), bisect.bisect_left(pairs, (prefix + '\U0010ffff',))
+
+    def _candidates(self, terms):
+        """Products matching the most selective term by prefix, title matches first"""
+
+        best = None
+
+        for term in terms:
+            start, end = self._prefix_range(self.product_words, term)
+            category_start, category_end = self._prefix_range(self.category_words, term)
+            size = end - start + sum(
+                len(self.category_products[category_id]) for _, category_id in self.category_words[category_start:category_end]
+            )
+
+            if best is None or size < best[0]:
+                best = (size, start, end, category_start, category_end)
+
+        size, start, end, category_start, category_end = best
+
+        for i in range(start, end):
+            yield self.product_words[i][1]
+
+        for i in range(category_start, category_end):
+            yield from self.category_products[self.category_words[i][1]]
+
+    @staticmethod
+    def _score(needles, text, category_text):
+        """Exact title words score highest, then title prefixes, then category prefixes"""
+
+        score = 0
+
+        for word, prefix in needles:
+            if word in text:
+                score += 3
+            elif prefix in text:
+                score += 2
+            elif prefix in category_text:
+                score += 1
+            else:
+                return None
+
+        # Titles starting with what's typed first
+        if text.startswith(needles[0][1]):
+            score += 1
+
+        return score
+
+    def _match(self, terms, tier):
+        """
+        Ranks the products matching every term, as sort keys.
+
+        The candidates come in word order, exact words first. Reading stops
+        after MAX_MATCHES matches, so short prefixes cost as little as long ones.
+        """
+
+        ranked = []
+        seen = set()
+        needles = [(f" {term} ", f" {term}") for term in terms]
+
+        for scanned, product_id in enumerate(self._candidates(terms)):
+            if scanned >= MAX_SCANNED or len(ranked) >= MAX_MATCHES:
+                break
+
+            if product_id in seen:
+                continue
+            seen.add(product_id)
+
+            title, category_id, text = self.products[product_id]
+            category = self.categories.get(category_id)
+            score = self._score(needles, text, category[1] if category else '')
+
+            if score is not None:
+                ranked.append((tier, -score, len(title), title, product_id))
+
+        return ranked
+
+    def _correct(self, term):
+        """The term itself when it prefixes a word, otherwise the closest word of the vocabulary"""
+
+        for pairs in (self.product_words, self.category_words):
+            start, end = self._prefix_range(pairs, term)
+            if start < end:
+                return term
+
+        grams = trigrams(term)
+        shared = Counter()
+
+        # Words sharing the rarest trigrams are the candidates, reading every word of the common ones would be slow
+        budget = MAX_POSTINGS
+        for words in sorted((self.word_trigrams.get(gram, ()) for gram in grams), key=len):
+            budget -= len(words)
+            if budget < 0:
+                break
+            shared.update(words)
+
+        best, best_similarity = None, MIN_SIMILARITY
+
+        for word, _ in shared.most_common(MAX_CORRECTIONS):
+            word_grams = trigrams(word)
+            similarity = len(grams & word_grams) / len(grams | word_grams)
+
+            if similarity > best_similarity or (similarity == best_similarity and best is not None and word < best):
+                best, best_similarity = word, similarity
+
+        return best
+
+    def search(self, query, limit=10):
+        """Returns the best matches as (product_id, title, category_id), best first"""
+
+        terms = split_words(query)
+
+        if not terms or not self.products:
+            return []
+
+        ranked = self._match(terms, 0)
+
+        if len(ranked) < limit:
+            corrected = tuple(self._correct(term) for term in terms)
+
+            # Corrected matches rank after the exact ones
+            if None not in corrected and corrected != terms:
+                matched = {key[-1] for key in ranked}
+                ranked += [key for key in self._match(corrected, 1) if key[-1] not in matched]
+
+        return [
+            (product_id, title, self.products[product_id][1])
+            for _, _, _, title, product_id in heapq.nsmallest(limit, ranked)
+        ]
+
+    def category_title(self, category_id):
+        category = self.categories.get(category_id)
+        return category[0] if category else None
+
+
+_lock = threading.RLock()
+_index = None
+_building = False
+
+# Generations of the catalog lists the index has seen, the last deletion it has applied and
+# when it read the database last
+_generations = None
+_deletions_seen = 0
+_synced_at = None
+_checked_at = 0
+
+_DELETIONS_KEY = 'search:deletions'
+
+
+def _catalog_generations():
+    return catalog_cache.get_generation('products'), catalog_cache.get_generation('categories')
+
+
+def _last_deletion():
+    return catalog_cache.get_cache().get(_DELETIONS_KEY, 0)
+
+
+def record_deletion(kind, object_id):
+    """
+    Leaves a tombstone of a deleted product or category in the shared cache.
+
+    Tombstones are numbered, an index applies the ones after the last it has
+    seen when it syncs instead of reading every id to find what's gone. They're
+    kept SEARCH_INDEX_TOMBSTONE_TIMEOUT seconds, an index further behind is rebuilt.
+    """
+
+    cache = catalog_cache.get_cache()
+    cache.add(_DELETIONS_KEY, 0, None)
+    number = cache.incr(_DELETIONS_KEY)
+
+    cache.set(f"{_DELETIONS_KEY}:{number}", (kind, object_id), getattr(settings, 'SEARCH_INDEX_TOMBSTONE_TIMEOUT', 86400))
+
+
+def rebuild():
+    """Builds the index from the database and swaps it in"""
+
+    global _index, _generations, _deletions_seen, _synced_at
+
+    # Read before the rows, so changes made meanwhile are picked up by the next sync
+    generations, deletions_seen, synced_at = _catalog_generations(), _last_deletion(), timezone.now()
+
+    index = ProductIndex(
+        Product.objects.values_list('id', 'title', 'category_id').iterator(chunk_size=5000),
+        Category.objects.values_list('id', 'title'),
+    )
+
+    with _lock:
+        _index, _generations, _deletions_seen, _synced_at = index, generations, deletions_seen, synced_at
+
+    return index
+
+
+def _build_in_background():
+    global _building
+
+    try:
+        rebuild()
+    finally:
+        connections.close_all()
+
+        with _lock:
+            _building = False
+
+
+def warm(again=False):
+    """
+    Starts building the index in a background thread, unless it's built (or `again`) or being built.
+
+    With SEARCH_INDEX_WARM off it's built in the calling thread instead.
+    """
+
+    global _building
+
+    if not getattr(settings, 'SEARCH_INDEX_WARM', True):
+        rebuild()
+        return
+
+    with _lock:
+        if (_index is not None and not again) or _building:
+            return
+        _building = True
+
+    threading.Thread(target=_build_in_background, name='product-search-index', daemon=True).start()
+
+
+def warm_on_first_request(sender, **kwargs):
+    """request_started receiver, builds the index when a process starts serving"""
+
+    request_started.disconnect(warm_on_first_request)
+
+    if getattr(settings, 'SEARCH_INDEX_WARM', True):
+        warm()
+
+
+def _read_deletions(seen, last):
+    """The (kind, id) tombstones numbered after `seen` up to `last`, and whether some already expired"""
+
+    # The counter was evicted and started over, what it numbered is unknown
+    if last < seen:
+        return [], True
+
+    if last == seen:
+        return [], False
+
+    tombstones = catalog_cache.get_cache().get_many([f"{_DELETIONS_KEY}:{number}" for number in range(seen + 1, last + 1)])
+
+    return list(tombstones.values()), len(tombstones) < last - seen
+
+
+def _sync():
+    """
+    Catches up with changes made by other processes.
+
+    Local changes reach the index through signals, the others only move the
+    catalog generations in the shared cache. When they moved, the rows changed
+    since the last sync are re-read and the deletions recorded since then
+    dropped. The database is read without holding the lock, searches and
+    signals carry on meanwhile.
+    """
+
+    global _generations, _deletions_seen, _synced_at, _checked_at
+
+    with _lock:
+        if time.monotonic() - _checked_at < getattr(settings, 'SEARCH_INDEX_SYNC_INTERVAL', 1):
+            return
+
+        _checked_at = time.monotonic()
+        index, known_generations, deletions_seen, last_synced_at = _index, _generations, _deletions_seen, _synced_at
+
+    # Deletions are checked on their own, their tombstones can land after the generations moved
+    generations, last_deletion = _catalog_generations(), _last_deletion()
+
+    if generations == known_generations and last_deletion == deletions_seen:
+        return
+
+    # Overlaps the last read a little, for transactions committing while it ran
+    since, synced_at = last_synced_at - timedelta(seconds=5), timezone.now()
+
+    deleted, expired = _read_deletions(deletions_seen, last_deletion)
+    categories = list(Category.objects.filter(updated_at__gte=since).values_list('id', 'title'))
+    products = list(Product.objects.filter(updated_at__gte=since).values_list('id', 'title', 'category_id'))
+
+    with _lock:
+        # Rebuilt meanwhile, the new index read the database after this did
+        if _index is not index:
+            return
+
+        for category_id, title in categories:
+            index.add_category(category_id, title)
+
+        for product_id, title, category_id in products:
+            index.add_product(product_id, title, category_id)
+
+        for kind, object_id in deleted:
+            if kind == 'category':
+                index.remove_category(object_id)
+            else:
+                index.remove_product(object_id)
+
+        _generations, _deletions_seen, _synced_at = generations, last_deletion, synced_at
+
+    # Behind the tombstones kept, only a full read finds the rest
+    if expired:
+        warm(again=True)
+
+
+def _apply(update, *args):
+    """Applies a committed change to the index, once it's built"""
+
+    with _lock:
+        if _index is not None:
+            getattr(_index, update)(*args)
+
+
+def index_product(product_id, title, category_id):
+    _apply('add_product', product_id, title, category_id)
+
+
+def unindex_product(product_id):
+    record_deletion('product', product_id)
+    _apply('remove_product', product_id)
+
+
+def index_category(category_id, title):
+    _apply('add_category', category_id, title)
+
+
+def unindex_category(category_id):
+    record_deletion('category', category_id)
+    _apply('remove_category', category_id)
+
+
+def _search_trigrams(query, limit):
+    """
+    Products whose title, or half of whose category title, is word-similar to the query (PostgreSQL).
+
+    Both halves filter with the %> operator, which the gin_trgm_ops indexes on
+    the titles serve, and only the few matches are ranked by similarity.
+    """
+
+    from django.contrib.postgres.lookups import TrigramWordSimilar
+    from django.contrib.postgres.search import TrigramWordSimilarity
+
+    def similar(field):
+        return TrigramWordSimilar(F(field), Value(query))
+
+    columns = ('id', 'title', 'category_id', 'category__title', 'similarity')
+
+    with transaction.atomic(using=Product.objects.db):
+        with connections[Product.objects.db].cursor() as cursor:
+            # The threshold %> filters with, for this transaction only
+            cursor.execute("SELECT set_config('pg_trgm.word_similarity_threshold', %s, true)", [str(MIN_DATABASE_SIMILARITY)])
+
+        by_title = Product.objects.filter(similar('title')).annotate(
+            similarity=TrigramWordSimilarity(query, 'title')
+        ).order_by('-similarity', 'title', 'id').values_list(*columns)[:limit]
+
+        # Category matches count half, so their title has to be twice as similar
+        categories = Category.objects.filter(similar('title')).annotate(
+            similarity=TrigramWordSimilarity(query, 'title')
+        ).filter(similarity__gt=MIN_DATABASE_SIMILARITY * 2).values('id')
+
+        by_category = Product.objects.filter(category__in=categories).annotate(
+            similarity=TrigramWordSimilarity(query, 'category__title') * 0.5
+        ).order_by('-similarity', 'title', 'id').values_list(*columns)[:limit]
+
+        best = {}
+        for row in [*by_title, *by_category]:
+            if row[0] not in best or row[-1] > best[row[0]][-1]:
+                best[row[0]] = row
+
+    ranked = sorted(best.values(), key=lambda row: (-row[-1], row[1], row[0]))
+
+    return [row[:-1] for row in ranked[:limit]]
+
+
+def search_database(query, limit=10):
+    """
+    Searches the database, while the index is being built.
+
+    Uses trigram word similarity on PostgreSQL (pg_trgm and the title
+    indexes are created on migrate) and matches every word as a substring
+    elsewhere.
+    """
+
+    terms = split_words(query)
+
+    if not terms:
+        return []
+
+    if connections[Product.objects.db].vendor == 'postgresql':
+        return _search_trigrams(query, limit)
+
+    queryset = Product.objects.all()
+
+    for term in terms:
+        queryset = queryset.filter(Q(title__icontains=term) | Q(category__title__icontains=term))
+
+    return list(queryset.order_by('title', 'id').values_list('id', 'title', 'category_id', 'category__title')[:limit])
+
+
+def create_trigram_indexes_on_migrate(sender, using, **kwargs):
+    """
+    post_migrate receiver creating pg_trgm and the title indexes search_database() uses on PostgreSQL.
+
+    Created here rather than by a migration, the indexes need the extension
+    first and don't exist on the other databases.
+    """
+
+    connection = connections[using]
+
+    if sender.name != 'pharmacy_app' or connection.vendor != 'postgresql':
+        return
+
+    quote = connection.ops.quote_name
+
+    with connection.cursor() as cursor:
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+
+        for model, name in ((Product, 'product_title_trgm_idx'), (Category, 'category_title_trgm_idx')):
+            cursor.execute(
+                f"CREATE INDEX IF NOT EXISTS {quote(name)} ON {quote(model._meta.db_table)} "
+                f"USING gin ({quote(model._meta.get_field('title').column)} gin_trgm_ops)"
+            )
+
+
+def search_products(query, limit=10):
+    """
+    Returns the products best matching a partial title as (id, title, category_id, category_title).
+
+    Answered from the in-memory index, or from the database while the index
+    of this process is still being built. With SEARCH_INDEX_WARM off the
+    first search builds it in the request instead.
+    """
+
+    with _lock:
+        built = _index is not None
+
+    if not built:
+        if getattr(settings, 'SEARCH_INDEX_WARM', True):
+            warm()
+            return search_database(query, limit)
+
+        rebuild()
+
+    _sync()
+
+    with _lock:
+        return [
+            (product_id, title, category_id, _index.category_title(category_id))
+            for product_id, title, category_id in _index.search(query, limit)
+        ]
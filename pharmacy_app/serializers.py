@@ -1,12 +1,21 @@
-import uuid
+from decimal import Decimal
 
-from django.db.models import CharField, Sum
+from django.db import transaction
+from django.db.models import CharField
 
-from pharmacy_app.models import Staff, Product, Category, Sale, SaleProduct, ProductPriceHistory, ProductBatch
-from rest_framework import serializers
+from pharmacy_app import metrics
+from pharmacy_app.models import Staff, Product, ProductBarcode, Category, Sale, SaleProduct, ProductPriceHistory, ProductBatch
+from pharmacy_app.checkout import commit_sale, close_sale, InsufficientStockError, StockConflictError
+from pharmacy_app.stock import check_availability
+from pharmacy_app.timing import TimedSerializerMixin
+from rest_framework import exceptions, serializers, status
 
 
-class StaffSerializer(serializers.ModelSerializer):
+class ModelSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    """ModelSerializer whose output time shows up as serialization in Server-Timing"""
+
+
+class StaffSerializer(ModelSerializer):
     class Meta:
         model = Staff
         fields = ("username", "password", "first_name", "last_name", "email", "role")
@@ -28,17 +37,17 @@ class StaffSerializer(serializers.ModelSerializer):
         instance.save()
         return instance
 
-class StaffShortSerializer(serializers.ModelSerializer):
+class StaffShortSerializer(ModelSerializer):
     class Meta:
         model = Staff
         fields = ("username", "role")
 
-class CategorySerializer(serializers.ModelSerializer):
+class CategorySerializer(ModelSerializer):
     class Meta:
         model = Category
         fields = '__all__'
 
-class ProductSerializer(serializers.ModelSerializer):
+class ProductSerializer(ModelSerializer):
 
     category = CategorySerializer(read_only=True)
     recorder = StaffShortSerializer(read_only=True)
@@ -47,13 +56,13 @@ class ProductSerializer(serializers.ModelSerializer):
         model = Product
         fields= ('title', 'photo', 'category', 'recorder')
 
-class ProductListSerializer(serializers.ModelSerializer):
+class ProductListSerializer(ModelSerializer):
 
     class Meta:
         model = Product
         fields= ('id', 'title', 'category', 'recorder')
 
-class ProductLiteSerializer(serializers.ModelSerializer):
+class ProductLiteSerializer(ModelSerializer):
     category_name = serializers.CharField(source='category.title')
     recorder = StaffShortSerializer()
 
@@ -61,12 +70,12 @@ class ProductLiteSerializer(serializers.ModelSerializer):
         model = Product
         fields = ('id', 'title', 'category_name', 'recorder')
 
-class SaleProductSerializer(serializers.ModelSerializer):
+class SaleProductSerializer(ModelSerializer):
     class Meta:
         model = SaleProduct
         fields = '__all__'
 
-class ProductShortSerializer(serializers.ModelSerializer):
+class ProductShortSerializer(ModelSerializer):
 
     category = serializers.CharField(source='category.title', read_only=True)
 
@@ -74,7 +83,7 @@ class ProductShortSerializer(serializers.ModelSerializer):
         model = Product
         fields= ('title', 'category')
 
-class SaleProductExtendedSerializer(serializers.ModelSerializer):
+class SaleProductExtendedSerializer(ModelSerializer):
 
     product = serializers.CharField(source='product.title', read_only=True)
     category = serializers.CharField(source='product.category.title', read_only=True)
@@ -85,7 +94,30 @@ class SaleProductExtendedSerializer(serializers.ModelSerializer):
             'id', 'product', 'category', 'quantity', 'retailPrice', 'status', 'total'
         )
 
-class SaleExtendedSerializer(serializers.ModelSerializer):
+class StockConflict(exceptions.APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = "The stock of the sale changed while it was being processed, please try again."
+    default_code = 'stock_conflict'
+
+def settle_or_raise(settle):
+    """Runs a checkout step, retrying it once on a stock conflict and answering 400 / 409 for stock errors"""
+
+    for attempt in range(2):
+        try:
+            return settle()
+        except InsufficientStockError as error:
+            # Stock taken by a concurrent checkout after validate() passed
+            metrics.STOCK_VALIDATION_FAILURES.labels('allocate').inc()
+            raise serializers.ValidationError({
+                "items": f"The sale can't be processed. {error}"
+            })
+        except StockConflictError:
+            # A batch changed between its allocation and its decrement, the step was rolled back
+            if attempt:
+                metrics.STOCK_VALIDATION_FAILURES.labels('conflict').inc()
+                raise StockConflict()
+
+class SaleExtendedSerializer(ModelSerializer):
 
     items = SaleProductExtendedSerializer(source='sale_products', read_only=True, many=True)
     recorder = serializers.CharField(source='recorder.username', read_only=True)
@@ -94,85 +126,129 @@ class SaleExtendedSerializer(serializers.ModelSerializer):
         model = Sale
         fields = ('code', 'totalAmount', 'status', 'recorder', 'payment_type', 'items')
 
-class SaleSerializer(serializers.ModelSerializer):
+    def update(self, instance, validated_data):
+
+        closing = instance.status == Sale.SaleStatusChoices.IN_PROGRESS and validated_data.get('status') == Sale.SaleStatusChoices.CLOSED
+
+        with transaction.atomic():
+            # Closing goes through close_sale, which sells the pending items exactly once
+            if closing:
+                settle_or_raise(lambda: close_sale(instance))
+
+            return super().update(instance, validated_data)
+
+class SaleSerializer(ModelSerializer):
 
     class Meta:
         model = Sale
-        fields = ('sale_id', 'code', 'totalAmount', 'status', 'recorder', 'payment_type')
+        fields = ('sale_id', 'code', 'totalAmount', 'status', 'recorder', 'payment_type', 'created_at')
 
-class ProductPriceHistorySerializer(serializers.ModelSerializer):
+class ProductPriceHistorySerializer(ModelSerializer):
     class Meta:
         model = ProductPriceHistory
         fields = '__all__'
 
-class ProductBatchSerializer(serializers.ModelSerializer):
+class ProductBatchSerializer(ModelSerializer):
     class Meta:
         model = ProductBatch
         fields = '__all__'
 
-class SaleProductCreateSerializer(serializers.ModelSerializer):
+class ProductBarcodeSerializer(ModelSerializer):
+    class Meta:
+        model = ProductBarcode
+        fields = '__all__'
+
+class StockCheckItemSerializer(serializers.Serializer):
+
+    product = serializers.IntegerField()
+    quantity = serializers.DecimalField(decimal_places=2, max_digits=20, min_value=Decimal(0))
+    retailPrice = serializers.DecimalField(decimal_places=2, max_digits=20)
+
+class StockCheckSerializer(serializers.Serializer):
+    items = StockCheckItemSerializer(many=True)
+
+class ProductLookupField(serializers.PrimaryKeyRelatedField):
+    """Resolves the product from the products preloaded for the whole basket"""
+
+    def to_internal_value(self, data):
+        products = self.context.get('products', {})
+
+        try:
+            return products[int(data)]
+        except (KeyError, TypeError, ValueError):
+            return super().to_internal_value(data)
+
+class SaleProductCreateSerializer(ModelSerializer):
+
+    product = ProductLookupField(queryset=Product.objects.all())
 
     class Meta:
         model = SaleProduct
         fields = ('id', 'quantity', 'retailPrice', 'status', 'product')
 
 
-class SaleCreateSerializer(serializers.ModelSerializer):
+class SaleCreateSerializer(ModelSerializer):
     items = SaleProductCreateSerializer(many=True)
 
+    # Store / terminal prefix of the receipt code, SALE_CODE_PREFIX when left out
+    terminal = serializers.RegexField(r'^[A-Za-z0-9]+(-[A-Za-z0-9]+)*$', max_length=40, required=False, write_only=True)
+
     class Meta:
         model = Sale
-        fields = ('payment_type', 'items')
+        fields = ('payment_type', 'terminal', 'items')
 
-    def validate(self, attrs):
+    def to_internal_value(self, data):
 
-        # Validate each item has sufficient stock
-        items_data = attrs.get('items', [])
+        # Load every product of the basket with a single query
+        items_data = data.get('items') if hasattr(data, 'get') else None
 
-        for item_data in items_data:
+        if isinstance(items_data, list):
+            products = self.context.setdefault('products', {})
 
-            # Skip validation if item is not marked as SOLD
-            if item_data.get('status') == SaleProduct.SaleProductStatusChoices.RETURNED:
-                continue
+            product_ids = set()
+            for item_data in items_data:
+                try:
+                    product_ids.add(int(item_data.get('product')))
+                except (AttributeError, TypeError, ValueError):
+                    continue
+
+            # Products may already be preloaded by the caller (bulk ingestion)
+            missing_ids = product_ids - products.keys()
+            if missing_ids:
+                products.update(Product.objects.in_bulk(missing_ids))
+
+        return super().to_internal_value(data)
+
+    def validate(self, attrs):
 
-            # Extract details
-            product = item_data.get('product')
-            quantity = item_data.get('quantity')
-            retail_price = item_data.get('retailPrice')
+        # Validate the basket has sufficient stock, skipping returned items
+        items_data = [
+            item_data for item_data in attrs.get('items', [])
+            if item_data.get('status') != SaleProduct.SaleProductStatusChoices.RETURNED
+        ]
 
-            # Check stock
-            stock = product.batches.filter(retailPrice=retail_price).aggregate(
-                total=Sum('quantity'))['total'] or 0
+        products = {item_data['product'].pk: item_data['product'] for item_data in items_data}
 
-            if stock < quantity:
+        # One lookup in the stock-level table for the whole basket
+        availability = check_availability(
+            (item_data['product'].pk, item_data['retailPrice'], item_data['quantity'])
+            for item_data in items_data
+        )
+
+        for line in availability:
+            if not line['sufficient']:
+                metrics.STOCK_VALIDATION_FAILURES.labels('validate').inc()
                 raise serializers.ValidationError({
-                    "items": f"The sale can't be processed. Stock is not enough for product {product} at price ${retail_price}."
+                    "items": f"The sale can't be processed. Stock is not enough for product {products[line['product']]} at price ${line['retailPrice']}."
                 })
 
         return attrs
 
     def create(self, validated_data):
         items_data = validated_data.pop('items')
+        terminal = validated_data.pop('terminal', None)
 
-        # Generate a unique sale code
-        sale_code = f"SALE-{uuid.uuid4().hex[:4].upper()}"
-
-        # Create the sale
-        sale = Sale.objects.create(
-            code=sale_code,
-            recorder=self.context['request'].user,
-            totalAmount=0,
-            **validated_data
+        # Create the sale with its products in one go
+        return settle_or_raise(
+            lambda: commit_sale(self.context['request'].user, items_data, terminal and terminal.upper(), **validated_data)
         )
-
-        total = 0
-
-        # Create the sale products
-        for item_data in items_data:
-            SaleProduct.objects.create(sale=sale, **item_data)
-            total += item_data['retailPrice'] * item_data['quantity']
-
-        sale.totalAmount = total
-        sale.save()
-
-        return sale
\ No newline at end of file
@@ -1,11 +1,16 @@
-from django.db.models.signals import pre_save, post_save
-from django.dispatch import receiver
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
 from django.core.exceptions import ValidationError
-from .models import SaleProduct, ProductPriceHistory, ProductBatch, Sale
+from django.db import transaction
+from .models import SaleProduct, ProductPriceHistory, ProductBatch, Sale, Product, ProductBarcode, Category
 from django.db.models import Sum
-from pharmacy_app.utils.thread_local import get_current_user
-
-@receiver(pre_save, sender=ProductBatch)
+from pharmacy_app import catalog_cache, search
+from pharmacy_app.checkout import settle_lines, sell_pending_lines
+from pharmacy_app.rollups import line_state, update_rollups
+from pharmacy_app.stock import adjust_stock
+from pharmacy_app.timing import timed_receiver
+from pharmacy_app.utils.current_user import get_current_user
+
+@timed_receiver(pre_save, sender=ProductBatch)
 def handle_price_change(sender, instance, **kwargs):
     """Detect retail price change before saving"""
 
@@ -21,64 +26,230 @@ def handle_price_change(sender, instance, **kwargs):
                 recorder=recorder
             )
 
-@receiver(post_save, sender=SaleProduct)
+@timed_receiver(pre_save, sender=ProductBatch)
+def remember_batch_stock(sender, instance, **kwargs):
+    """Keep the stored product, price and quantity to compute the stock delta after saving"""
+
+    instance._stock_snapshot = None
+
+    if instance.pk:
+        instance._stock_snapshot = sender.objects.filter(pk=instance.pk).values_list(
+            'product_id', 'retailPrice', 'quantity'
+        ).first()
+
+@timed_receiver(post_save, sender=ProductBatch)
+def sync_stock_on_batch_save(sender, instance, created, **kwargs):
+    """Move the batch quantity into the stock level of its product and price"""
+
+    changes = [(instance.product_id, instance.retailPrice, instance.quantity)]
+
+    snapshot = getattr(instance, '_stock_snapshot', None)
+    if not created and snapshot:
+        product_id, retail_price, quantity = snapshot
+        changes.append((product_id, retail_price, -quantity))
+
+    adjust_stock(changes)
+
+@timed_receiver(post_delete, sender=ProductBatch)
+def sync_stock_on_batch_delete(sender, instance, origin=None, **kwargs):
+    """Remove the remaining batch quantity from the stock level"""
+
+    # The stock levels of a deleted product go with it, they mustn't be upserted back
+    if isinstance(origin, Product) or getattr(origin, 'model', None) is Product:
+        return
+
+    adjust_stock([(instance.product_id, instance.retailPrice, -instance.quantity)])
+
+@timed_receiver(pre_save, sender=SaleProduct)
+def remember_sale_product_status(sender, instance, **kwargs):
+    """Keep the stored row to detect status changes and move its totals after saving"""
+
+    instance._stored = None
+
+    if instance.pk:
+        instance._stored = sender.objects.filter(pk=instance.pk).values(
+            'status', 'quantity', 'retailPrice', 'product_id', 'sale_id'
+        ).first()
+
+    instance._previous_status = instance._stored['status'] if instance._stored else None
+
+@timed_receiver(post_save, sender=SaleProduct)
 def update_batch_stock(sender, instance, created, **kwargs):
     """Update batch stock only after successful save"""
 
     if not created: # If being updated, check if the status has changed
 
-        if sender.status == instance.status:
+        if getattr(instance, '_previous_status', None) == instance.status:
             return
 
+    # Returned items are saved as a new batch, sold items reduce the batch(es), pending ones wait
+    settle_lines([instance], recorder=get_current_user())
+
+@timed_receiver(post_save, sender=SaleProduct)
+def update_sale_product_rollups(sender, instance, created, **kwargs):
+    """Move the item totals in the sales rollups"""
+
+    before = None
+    stored = getattr(instance, '_stored', None)
+
+    if stored:
+        sale = instance.sale if stored['sale_id'] == instance.sale_id else Sale.objects.filter(pk=stored['sale_id']).first()
+        before = line_state(SaleProduct(**stored), sale)
+
+    after = line_state(instance, instance.sale)
 
-    if instance.status == SaleProduct.SaleProductStatusChoices.RETURNED: # If returned save as a new batch
+    if before != after:
+        update_rollups(removed=[before], added=[after])
 
-        recorder = get_current_user()
+@timed_receiver(post_delete, sender=SaleProduct)
+def remove_sale_product_rollups(sender, instance, **kwargs):
+    """Take a deleted item out of the sales rollups"""
 
-        ProductBatch.objects.create(
+    update_rollups(removed=[line_state(instance, instance.sale)])
 
-            product=instance.product,
-            recorder=recorder,
+@timed_receiver(post_save, sender=SaleProduct)
+@timed_receiver(post_delete, sender=SaleProduct)
+def touch_sale(sender, instance, **kwargs):
+    """Bump the version of the sales an item was changed in, they show their items"""
 
-            quantity=instance.quantity,
-            unitPrice=instance.retailPrice,
-            retailPrice=instance.retailPrice,
-            source=ProductBatch.ProductBatchSourceChoices.RETURNED
-        )
+    stored = getattr(instance, '_stored', None)
+    sale_ids = {instance.sale_id, stored['sale_id'] if stored else None} - {None}
 
-    elif instance.status == SaleProduct.SaleProductStatusChoices.SOLD: # If sold reduce the quantity from batch(es)
+    if sale_ids:
+        Sale.touch(pk__in=sale_ids)
 
-        batches = instance.product.batches.filter(retailPrice=instance.retailPrice, quantity__gt=0).order_by('-arrival_date') # FIFO
-        remaining_qty = instance.quantity
-        updated_batches = []
+@timed_receiver(pre_save, sender=Sale)
+def remember_sale_status(sender, instance, **kwargs):
+    """Keep the stored status to detect the sale being closed"""
 
-        for batch in batches: # Look through to reduce/empty batches
-            if remaining_qty == 0:
-                break
+    instance._stored = None
 
-            if batch.quantity >= remaining_qty:
-                batch.quantity -= remaining_qty
-                remaining_qty = 0
-            else:
-                remaining_qty -= batch.quantity
-                batch.quantity = 0
+    if instance.pk:
+        instance._stored = sender.objects.filter(pk=instance.pk).values(
+            'status', 'created_at', 'recorder_id', 'payment_type'
+        ).first()
 
-            updated_batches.append(batch)
+    instance._previous_status = instance._stored['status'] if instance._stored else None
 
-        if updated_batches:
-            ProductBatch.objects.bulk_update(updated_batches, ['quantity'])
-    else:
-        pass # Don't process anything while pending
+@timed_receiver(post_save, sender=Sale)
+def move_sale_rollups(sender, instance, **kwargs):
+    """Move the totals of the sale items when the cashier or payment type changes"""
 
-@receiver(post_save, sender=Sale)
+    stored = getattr(instance, '_stored', None)
+
+    if not stored or (stored['recorder_id'], stored['payment_type']) == (instance.recorder_id, instance.payment_type):
+        return
+
+    previous = Sale(created_at=stored['created_at'], recorder_id=stored['recorder_id'], payment_type=stored['payment_type'])
+    lines = list(instance.sale_products.all())
+
+    update_rollups(
+        removed=[line_state(line, previous) for line in lines],
+        added=[line_state(line, instance) for line in lines],
+    )
+
+@timed_receiver(post_save, sender=Sale)
 def handle_sale_finish(sender, instance, **kwargs):
-    """Marks every item as sold after"""
+    """Marks every pending item as sold after the sale is closed"""
+
+    previous_status = getattr(instance, '_previous_status', None)
+
+    if previous_status == Sale.SaleStatusChoices.IN_PROGRESS and instance.status == Sale.SaleStatusChoices.CLOSED:
+        sell_pending_lines(instance)
+
+@timed_receiver(pre_delete, sender=Sale)
+def remove_sale_rollups(sender, instance, **kwargs):
+    """Take the items of a deleted sale out of the sales rollups"""
+
+    update_rollups(removed=[line_state(line, instance) for line in instance.sale_products.all()])
+
+@timed_receiver(post_save, sender=Product)
+@timed_receiver(post_delete, sender=Product)
+def invalidate_product_cache(sender, instance, **kwargs):
+    """Drop the cached product and product list once the change is committed"""
+
+    # Read now, a deleted instance has lost its pk by the time the transaction commits
+    product_id = instance.pk
+
+    transaction.on_commit(lambda: catalog_cache.invalidate_products(product_id))
+
+@timed_receiver(post_save, sender=ProductBatch)
+@timed_receiver(post_delete, sender=ProductBatch)
+def invalidate_batch_product_cache(sender, instance, **kwargs):
+    """Drop the cached product of a changed batch"""
+
+    transaction.on_commit(lambda: catalog_cache.invalidate_products(instance.product_id, lists=False))
+
+@timed_receiver(pre_save, sender=ProductBarcode)
+def remember_barcode(sender, instance, **kwargs):
+    """Keep the stored code, a renamed barcode has to drop the old one from the cache too"""
+
+    instance._stored_code = None
+
+    if instance.pk:
+        instance._stored_code = sender.objects.filter(pk=instance.pk).values_list('code', flat=True).first()
+
+@timed_receiver(post_save, sender=ProductBarcode)
+@timed_receiver(post_delete, sender=ProductBarcode)
+def invalidate_barcode_cache(sender, instance, **kwargs):
+    """Drop the cached product of a changed barcode"""
+
+    codes = {instance.code, getattr(instance, '_stored_code', None)} - {None}
+
+    transaction.on_commit(lambda: catalog_cache.invalidate_barcodes(*codes))
+
+@timed_receiver(pre_delete, sender=Category)
+def remember_category_products(sender, instance, **kwargs):
+    """Keep the products of the category, they lose it on delete"""
+
+    instance._product_ids = list(instance.product_set.values_list('pk', flat=True))
+
+@timed_receiver(post_save, sender=Category)
+def invalidate_category_cache(sender, instance, **kwargs):
+    """Drop the cached category, category list and the products showing the category"""
+
+    product_ids = list(instance.product_set.values_list('pk', flat=True))
+
+    transaction.on_commit(lambda: (
+        catalog_cache.invalidate_category(instance.pk),
+        catalog_cache.invalidate_products(*product_ids, lists=False),
+    ))
+
+@timed_receiver(post_delete, sender=Category)
+def invalidate_deleted_category_cache(sender, instance, **kwargs):
+    """Drop the deleted category and its former products, including the product list"""
+
+    product_ids = getattr(instance, '_product_ids', [])
+    category_id = instance.pk
+
+    transaction.on_commit(lambda: (
+        catalog_cache.invalidate_category(category_id),
+        catalog_cache.invalidate_products(*product_ids),
+    ))
+
+@timed_receiver(post_save, sender=Product)
+def index_product(sender, instance, **kwargs):
+    """Update the product in the search index once the change is committed"""
+
+    transaction.on_commit(lambda: search.index_product(instance.pk, instance.title, instance.category_id))
+
+@timed_receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    """Drop the deleted product from the search index"""
+
+    # The instance loses its pk once deleted
+    product_id = instance.pk
+    transaction.on_commit(lambda: search.unindex_product(product_id))
 
-    if sender.status == Sale.SaleStatusChoices.IN_PROGRESS and instance.status == Sale.SaleStatusChoices.CLOSED:
+@timed_receiver(post_save, sender=Category)
+def index_category(sender, instance, **kwargs):
+    """Update the category title products are also found by"""
 
-        sale_products = instance.sale_products
+    transaction.on_commit(lambda: search.index_category(instance.pk, instance.title))
 
-        for product in sale_products:
-            product.status = SaleProduct.SaleProductStatusChoices.SOLD
-            product.save()
+@timed_receiver(post_delete, sender=Category)
+def unindex_category(sender, instance, **kwargs):
+    """Drop the deleted category from the search index"""
 
+    category_id = instance.pk
+    transaction.on_commit(lambda: search.unindex_category(category_id))
@@ -0,0 +1,138 @@
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Q
+
+from pharmacy_app import catalog_cache
+from pharmacy_app.models import Product, StockLevel
+from pharmacy_app.utils.upsert import upsert_increment
+
+
+def adjust_stock(changes):
+    """
+    Applies stock deltas to the stock-level table.
+
+    `changes` is an iterable of (product_id, retail_price, delta) tuples, all
+    of them are written with a single statement.
+    """
+
+    rows = [(product_id, price, delta) for product_id, price, delta in changes if delta]
+
+    product_ids = {product_id for product_id, price, delta in rows}
+    if product_ids:
+        transaction.on_commit(lambda: catalog_cache.invalidate_stock(*product_ids))
+
+    return upsert_increment(StockLevel, ('product', 'retailPrice'), ('quantity',), rows)
+
+
+def get_sellable(**filters):
+    """
+    Returns the product matching `filters` with its sellable prices and stock.
+
+    One query: the product, its category and its stock levels come back as one
+    row per price (a single row of NULL stock when it has none), the prices
+    that are out of stock are dropped here. None when nothing matches.
+    """
+
+    rows = list(
+        Product.objects.filter(**filters)
+        .values_list(
+            'id', 'title', 'category_id', 'category__title',
+            'stock_levels__retailPrice', 'stock_levels__quantity'
+        )
+        .order_by('stock_levels__retailPrice')
+    )
+
+    if not rows:
+        return None
+
+    product_id, title, category_id, category_title = rows[0][:4]
+    in_stock = [(price, quantity) for *_, price, quantity in rows if quantity is not None and quantity > 0]
+
+    return {
+        'id': product_id,
+        'title': title,
+        'category': {'id': category_id, 'title': category_title} if category_id is not None else None,
+        'prices': [{'retailPrice': str(price), 'quantity': str(quantity)} for price, quantity in in_stock],
+        'quantity': str(sum((quantity for _, quantity in in_stock), Decimal(0))),
+    }
+
+
+def _stock_levels_query(pairs):
+
+    query = Q()
+    for product_id, price in pairs:
+        query |= Q(product_id=product_id, retailPrice=price)
+
+    return StockLevel.objects.filter(query).values_list('product_id', 'retailPrice', 'quantity')
+
+
+def get_stock_levels(pairs):
+    """Returns {(product_id, retail_price): quantity} for the given pairs in one query"""
+
+    pairs = set(pairs)
+
+    if not pairs:
+        return {}
+
+    return {(product_id, price): quantity for product_id, price, quantity in _stock_levels_query(pairs)}
+
+
+async def aget_stock_levels(pairs):
+    """Async version of get_stock_levels()"""
+
+    pairs = set(pairs)
+
+    if not pairs:
+        return {}
+
+    return {(product_id, price): quantity async for product_id, price, quantity in _stock_levels_query(pairs)}
+
+
+def _requested(items):
+
+    requested = defaultdict(Decimal)
+    for product_id, price, quantity in items:
+        requested[(product_id, Decimal(price))] += Decimal(quantity)
+
+    return requested
+
+
+def _compare(requested, levels):
+
+    result = []
+    for (product_id, price), quantity in requested.items():
+        available = levels.get((product_id, price), Decimal(0))
+        result.append({
+            'product': product_id,
+            'retailPrice': price,
+            'requested': quantity,
+            'available': available,
+            'sufficient': available >= quantity,
+        })
+
+    return result
+
+
+def check_availability(items):
+    """
+    Checks a whole basket against the stock-level table.
+
+    `items` is an iterable of (product_id, retail_price, quantity) tuples. Lines
+    of the same product at the same price are summed before comparing, so the
+    basket as a whole must fit in stock. Returns one entry per distinct
+    (product, price) pair in the order they first appeared.
+    """
+
+    requested = _requested(items)
+
+    return _compare(requested, get_stock_levels(requested.keys()))
+
+
+async def acheck_availability(items):
+    """Async version of check_availability()"""
+
+    requested = _requested(items)
+
+    return _compare(requested, await aget_stock_levels(requested.keys()))
@@ -1,3 +1,1401 @@
-from django.test import TestCase
+import csv
+import importlib.util
+import json
+import os
+import random
+import runpy
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime, timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.apps import apps
+from django.conf import settings
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connection, connections
+from django.db.models import F, Sum
+from django.db.models.sql.compiler import SQLCompiler
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from prometheus_client import REGISTRY
+from rest_framework import serializers
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from api import views
+
+from pharmacy_app import catalog_cache, partitions, search
+from pharmacy_app.management.commands import benchmark
+from pharmacy_app.checkout import commit_sale, close_sale, InsufficientStockError, StockConflictError
+from pharmacy_app.utils.current_user import get_current_user
+from pharmacy_app.utils.sampling import should_profile
+from pharmacy_app.models import (
+    Staff, Category, Product, ProductBarcode, ProductBatch, ArchivedProductBatch, Sale, SaleProduct, SalesRollup, StockLevel
+)
+from pharmacy_app.routers import routing
+from pharmacy_app.stock import adjust_stock
+
+
+def sold_item(product, quantity, price):
+    return {
+        'product': product,
+        'quantity': Decimal(quantity),
+        'retailPrice': Decimal(price),
+        'status': SaleProduct.SaleProductStatusChoices.SOLD,
+    }
+
+
+class BatchAllocationTests(TestCase):
+
+    def setUp(self):
+        self.cashier = Staff.objects.create_user(username="cashier", role=Staff.StaffRoleChoices.CASHIER)
+        self.product = Product.objects.create(title="Aspirin", category=Category.objects.create(title="Medicine"))
+
+        self.old = ProductBatch.objects.create(product=self.product, quantity=5, unitPrice=1, retailPrice=10)
+        self.new = ProductBatch.objects.create(product=self.product, quantity=5, unitPrice=2, retailPrice=10)
+
+    def test_depletes_oldest_batch_first(self):
+        commit_sale(self.cashier, [sold_item(self.product, 7, 10)])
+
+        self.old.refresh_from_db()
+        self.new.refresh_from_db()
+
+        self.assertEqual(self.old.quantity, 0)
+        self.assertEqual(self.new.quantity, 3)
+        self.assertEqual(StockLevel.objects.get(product=self.product).quantity, 3)
+
+    def test_return_reverses_allocations(self):
+        sale = commit_sale(self.cashier, [sold_item(self.product, 7, 10)])
+        line = sale.sale_products.get()
+
+        self.assertEqual(
+            sorted(line.allocations.values_list('batch_id', 'quantity', 'unitPrice')),
+            [(self.old.pk, 5, 1), (self.new.pk, 2, 2)]
+        )
+
+        line.status = SaleProduct.SaleProductStatusChoices.RETURNED
+        line.save()
+
+        self.old.refresh_from_db()
+        self.new.refresh_from_db()
+
+        self.assertEqual((self.old.quantity, self.new.quantity), (5, 5))
+        self.assertEqual(line.allocations.aggregate(total=Sum('quantity'))['total'], 0)
+        self.assertEqual(ProductBatch.objects.count(), 2)
+        self.assertEqual(StockLevel.objects.get(product=self.product).quantity, 10)
+
+    def test_archives_depleted_batches_and_restores_them_on_return(self):
+        sale = commit_sale(self.cashier, [sold_item(self.product, 7, 10)])
+        ProductBatch.objects.filter(pk=self.old.pk).update(updated_at=self.old.updated_at - timedelta(days=100))
+
+        call_command('archive_batches', '--chunk-size', '1', stdout=StringIO())
+
+        self.assertEqual(list(ProductBatch.objects.values_list('pk', flat=True)), [self.new.pk])
+        self.assertEqual(ArchivedProductBatch.objects.get().pk, self.old.pk)
+
+        line = sale.sale_products.get()
+        line.status = SaleProduct.SaleProductStatusChoices.RETURNED
+        line.save()
+
+        self.old.refresh_from_db()
+
+        self.assertEqual(self.old.quantity, 5)
+        self.assertEqual(self.old.arrival_date, ProductBatch.objects.order_by('arrival_date').first().arrival_date)
+        self.assertFalse(ArchivedProductBatch.objects.exists())
+        self.assertEqual(StockLevel.objects.get(product=self.product).quantity, 10)
+
+    def test_deleting_batches_and_products_updates_stock_levels(self):
+        self.old.delete()
+        self.assertEqual(StockLevel.objects.get(product=self.product).quantity, 5)
+
+        self.product.delete()
+        self.assertFalse(StockLevel.objects.exists())
+
+    def test_rebuilds_stock_levels_from_the_batches(self):
+        StockLevel.objects.update(quantity=99)
+
+        call_command('rebuild_stock_levels', stdout=StringIO())
+
+        self.assertEqual(StockLevel.objects.get(product=self.product).quantity, 10)
+
+    def test_writes_stock_rows_in_key_order(self):
+        other = Product.objects.create(title="Zinc")
+
+        with CaptureQueriesContext(connection) as queries:
+            adjust_stock([(other.pk, Decimal('3.00'), 1), (self.product.pk, Decimal('10.00'), 1), (other.pk, Decimal('1.00'), 1)])
+
+        # Concurrent checkouts lock the rows in the same order
+        self.assertIn(
+            f"VALUES ({self.product.pk}, '10.00', '1'), ({other.pk}, '1.00', '1'), ({other.pk}, '3.00', '1')",
+            queries.captured_queries[-1]['sql']
+        )
+
+    def test_rejects_sale_over_stock(self):
+        with self.assertRaises(InsufficientStockError):
+            commit_sale(self.cashier, [sold_item(self.product, 6, 10), sold_item(self.product, 6, 10)])
+
+        self.assertEqual(ProductBatch.objects.aggregate(total=Sum('quantity'))['total'], 10)
+        self.assertEqual(StockLevel.objects.get(product=self.product).quantity, 10)
+        self.assertFalse(SaleProduct.objects.exists())
+
+
+class CheckoutTests(TestCase):
+
+    def setUp(self):
+        self.admin = Staff.objects.create_user(username="admin", role=Staff.StaffRoleChoices.ADMIN)
+        self.products = [Product.objects.create(title=f"Product {number}") for number in range(8)]
+
+        for product in self.products:
+            ProductBatch.objects.create(product=product, quantity=10, unitPrice=1, retailPrice=5)
+            ProductBatch.objects.create(product=product, quantity=10, unitPrice=2, retailPrice=5)
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def checkout(self, products, quantity='1'):
+        return self.client.post('/api/sales/', {
+            'payment_type': 'Cash',
+            'items': [{'product': product.pk, 'quantity': quantity, 'retailPrice': '5', 'status': 'Sold'} for product in products],
+        }, format='json')
+
+    def test_query_count_does_not_grow_with_the_cart(self):
+        with CaptureQueriesContext(connection) as single:
+            self.assertEqual(self.checkout(self.products[:1]).status_code, 201)
+
+        # Eight products, each line taking from two batches
+        with self.assertNumQueries(len(single.captured_queries)):
+            self.assertEqual(self.checkout(self.products, quantity='12').status_code, 201)
+
+        self.assertEqual(StockLevel.objects.get(product=self.products[-1]).quantity, 8)
+
+    def test_stock_conflict_is_retried_then_answers_409(self):
+        with mock.patch('pharmacy_app.checkout.deplete_batches', side_effect=[StockConflictError(), []]):
+            self.assertEqual(self.checkout(self.products[:1]).status_code, 201)
+
+        with mock.patch('pharmacy_app.checkout.deplete_batches', side_effect=StockConflictError()):
+            response = self.checkout(self.products[:1])
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(Sale.objects.count(), 1)
+
+    def test_closing_sells_pending_lines_once(self):
+        pending = {**sold_item(self.products[0], 3, 5), 'status': SaleProduct.SaleProductStatusChoices.PENDING}
+        sale = commit_sale(self.admin, [pending], payment_type='Cash')
+        url = f'/api/sales/{sale.pk}/'
+        data = {'code': sale.code, 'totalAmount': '15', 'payment_type': 'Cash', 'status': 'Closed'}
+
+        self.assertEqual(StockLevel.objects.get(product=self.products[0]).quantity, 20)
+
+        self.assertEqual(self.client.put(url, data, format='json').status_code, 200)
+        self.assertEqual(self.client.put(url, data, format='json').status_code, 200)
+
+        self.assertEqual(sale.sale_products.get().status, SaleProduct.SaleProductStatusChoices.SOLD)
+        self.assertEqual(StockLevel.objects.get(product=self.products[0]).quantity, 17)
+
+
+class BulkSaleTests(TestCase):
+
+    def setUp(self):
+        self.admin = Staff.objects.create_user(username="admin", role=Staff.StaffRoleChoices.ADMIN)
+        self.product = Product.objects.create(title="Aspirin")
+        ProductBatch.objects.create(product=self.product, quantity=5, unitPrice=1, retailPrice=10)
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def sale(self, ref, quantity=1):
+        return json.dumps({
+            'ref': ref, 'payment_type': 'Cash',
+            'items': [{'product': self.product.pk, 'quantity': str(quantity), 'retailPrice': '10', 'status': 'Sold'}],
+        })
+
+    def ingest(self, lines, **params):
+        response = self.client.post(
+            '/api/sales/bulk/' + (f"?chunk_size={params['chunk_size']}" if params else ''),
+            data="\n".join(lines), content_type='application/x-ndjson'
+        )
+        self.assertEqual(response.status_code, 200)
+
+        return [json.loads(line) for line in response.content.decode().splitlines()]
+
+    def test_reports_every_line(self):
+        results = self.ingest([self.sale('a'), '{not json', '', '[1, 2]', self.sale('b', quantity=50), self.sale('c')])
+
+        self.assertEqual(
+            [(result['index'], result['ref'], result['status']) for result in results],
+            [(0, 'a', 201), (1, None, 400), (2, None, 400), (3, 'b', 400), (4, 'c', 201)]
+        )
+        self.assertEqual(results[1]['errors'], {'detail': "Invalid JSON"})
+        self.assertEqual(results[2]['errors'], {'detail': "Expected a JSON object"})
+        self.assertEqual(Sale.objects.get(pk=results[4]['sale']['sale_id']).recorder, self.admin)
+
+    def test_rejected_sale_keeps_the_rest_of_its_chunk(self):
+        with mock.patch('pharmacy_app.checkout.deplete_batches', side_effect=[
+            StockConflictError(), StockConflictError(), DatabaseError("deadlock detected"), [(self.product.pk, Decimal(10), -1)]
+        ]):
+            results = self.ingest([self.sale('a'), self.sale('b'), self.sale('c')], chunk_size=10)
+
+        self.assertEqual([result['status'] for result in results], [409, 500, 201])
+        self.assertEqual(list(Sale.objects.values_list('sale_id', flat=True)), [results[2]['sale']['sale_id']])
+        self.assertEqual(StockLevel.objects.get(product=self.product).quantity, 4)
+
+    @override_settings(BULK_SALES_MAX_CHUNK_SIZE=3)
+    def test_commits_in_chunks(self):
+        lines = [self.sale(str(number)) for number in range(5)]
+
+        for params, sizes in [({'chunk_size': 2}, [2, 2, 1]), ({'chunk_size': 100}, [3, 2]), ({'chunk_size': 'x'}, [3, 2])]:
+            with self.subTest(**params), mock.patch.object(
+                views.BulkCreateSales, 'ingest_chunk', autospec=True, side_effect=views.BulkCreateSales.ingest_chunk
+            ) as ingest:
+                self.ingest(lines, **params)
+
+            self.assertEqual([len(call.args[2]) for call in ingest.call_args_list], sizes)
+
+    def test_failed_chunk_reports_every_sale(self):
+        # Fails after the first sale's savepoint was released, outside any per-sale handling
+        with mock.patch.object(
+            views, 'SaleSerializer', wraps=views.SaleSerializer, side_effect=[DatabaseError("connection lost"), mock.DEFAULT]
+        ):
+            results = self.ingest([self.sale('a'), self.sale('b'), self.sale('c')], chunk_size=2)
+
+        self.assertEqual([result['status'] for result in results], [500, 500, 201])
+        self.assertEqual(Sale.objects.count(), 1)
+
+
+class RollupTests(TestCase):
+
+    def setUp(self):
+        self.admin = Staff.objects.create_user(username="admin", role=Staff.StaffRoleChoices.ADMIN)
+        self.product = Product.objects.create(title="Aspirin")
+        ProductBatch.objects.create(product=self.product, quantity=10, unitPrice=1, retailPrice=10)
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def totals(self):
+        """(sold quantity, sold amount, returned quantity, returned amount) of the hourly and the daily rollups"""
+
+        return {
+            granularity: tuple(SalesRollup.objects.filter(granularity=granularity).aggregate(
+                Sum('sold_quantity'), Sum('sold_amount'), Sum('returned_quantity'), Sum('returned_amount')
+            ).values())
+            for granularity in SalesRollup.GranularityChoices.values
+        }
+
+    def assertTotals(self, *expected):
+        expected = tuple(Decimal(value) for value in expected)
+        self.assertEqual(self.totals(), {'Hour': expected, 'Day': expected})
+
+    def test_sales_and_returns_move_the_totals(self):
+        sale = commit_sale(self.admin, [sold_item(self.product, 2, 10), sold_item(self.product, 3, 10)])
+        self.assertTotals(5, 50, 0, 0)
+
+        line = sale.sale_products.get(quantity=3)
+        line.status = SaleProduct.SaleProductStatusChoices.RETURNED
+        line.save()
+        self.assertTotals(2, 20, 3, 30)
+
+        line.delete()
+        self.assertTotals(2, 20, 0, 0)
+
+    def test_closing_sells_the_pending_lines(self):
+        sale = commit_sale(self.admin, [{**sold_item(self.product, 4, 10), 'status': SaleProduct.SaleProductStatusChoices.PENDING}])
+        self.assertFalse(SalesRollup.objects.exists())
+
+        close_sale(sale)
+        self.assertTotals(4, 40, 0, 0)
+
+    def test_rebuilds_drifted_rollups(self):
+        commit_sale(self.admin, [sold_item(self.product, 2, 10)])
+        SalesRollup.objects.update(sold_quantity=9)
+
+        with self.assertRaises(CommandError):
+            call_command('rebuild_rollups', verify=True, stdout=StringIO())
+
+        call_command('rebuild_rollups', stdout=StringIO())
+
+        self.assertTotals(2, 20, 0, 0)
+        call_command('rebuild_rollups', verify=True, stdout=StringIO())
+
+    def test_reports_read_the_rollups(self):
+        commit_sale(self.admin, [sold_item(self.product, 2, 10)])
+        SalesRollup.objects.create(
+            granularity=SalesRollup.GranularityChoices.DAY, period=timezone.now() - timedelta(days=3),
+            product=self.product, recorder=self.admin, payment_type=Sale.PaymentTypeChoices.CASH,
+            sold_quantity=1, sold_amount=7, sold_lines=1,
+        )
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/reports/totals/', {'group_by': 'payment_type'})
+
+        self.assertEqual(
+            [(row['payment_type'], row['sold_amount'], row['sold_lines']) for row in response.data],
+            [('Card', '20.00', 1), ('Cash', '7.00', 1)]
+        )
+        self.assertFalse([
+            query for query in queries.captured_queries
+            if '"pharmacy_app_sale"' in query['sql'] or '"pharmacy_app_saleproduct"' in query['sql']
+        ])
+
+        response = self.client.get('/api/reports/timeseries/', {'granularity': 'hour'})
+        self.assertEqual([row['sold_quantity'] for row in response.data], ['2.00'])
+
+
+class CatalogCacheTests(TestCase):
+
+    def setUp(self):
+        self.cache = catalog_cache.get_cache()
+        self.cache.clear()
+
+        self.medicine = Category.objects.create(title="Medicine")
+        self.aspirin = Product.objects.create(title="Aspirin", category=self.medicine)
+        self.zinc = Product.objects.create(title="Zinc cream", category=Category.objects.create(title="Dermatology"))
+
+    def fill(self):
+        """Caches the payload of every product and category, returns the keys"""
+
+        keys = [
+            key for product in (self.aspirin, self.zinc)
+            for key in (catalog_cache.product_key(product.pk), catalog_cache.sellable_key(product.pk))
+        ] + [catalog_cache.category_key(pk) for pk in Category.objects.values_list('pk', flat=True)]
+
+        for key in keys:
+            catalog_cache.put(key, "payload")
+
+        return keys
+
+    def test_in_memory_cache_holds_the_catalog(self):
+        for product_id in range(5000):
+            catalog_cache.put(catalog_cache.product_key(product_id), "payload")
+
+        self.assertEqual(catalog_cache.get_or_build(catalog_cache.product_key(0), lambda: "rebuilt"), "payload")
+
+    def assertInvalidates(self, change, keys, lists):
+        cached = self.fill()
+        generations = {name: catalog_cache.get_generation(name) for name in ('products', 'categories')}
+
+        with self.captureOnCommitCallbacks(execute=True):
+            change()
+
+        self.assertEqual(set(cached) - set(self.cache.get_many(cached)), set(keys))
+        self.assertEqual(
+            {name for name, generation in generations.items() if catalog_cache.get_generation(name) != generation}, lists
+        )
+
+    def test_product_changes(self):
+        aspirin_keys = [catalog_cache.product_key(self.aspirin.pk), catalog_cache.sellable_key(self.aspirin.pk)]
+
+        self.assertInvalidates(self.aspirin.save, aspirin_keys, {'products'})
+        self.assertInvalidates(
+            lambda: ProductBatch.objects.create(product=self.aspirin, quantity=1, unitPrice=1, retailPrice=2), aspirin_keys, set()
+        )
+        self.assertInvalidates(self.aspirin.delete, aspirin_keys, {'products'})
+
+    def test_category_changes(self):
+        keys = [
+            catalog_cache.category_key(self.medicine.pk),
+            catalog_cache.product_key(self.aspirin.pk), catalog_cache.sellable_key(self.aspirin.pk),
+        ]
+
+        self.assertInvalidates(self.medicine.save, keys, {'categories'})
+        self.assertInvalidates(self.medicine.delete, keys, {'categories', 'products'})
+
+    def test_stale_value_is_served_while_one_caller_rebuilds(self):
+        build = mock.Mock(return_value="fresh")
+        self.cache.set("key", ("stale", time.time() - 1), 60)
+
+        self.cache.add("key:lock", 1)
+        self.assertEqual(catalog_cache.get_or_build("key", build), "stale")
+        build.assert_not_called()
+
+        self.cache.delete("key:lock")
+        self.assertEqual(catalog_cache.get_or_build("key", build), "fresh")
+        self.assertEqual(catalog_cache.get_or_build("key", build), "fresh")
+        build.assert_called_once()
+
+    @override_settings(CATALOG_CACHE_WAIT=2)
+    def test_cold_miss_waits_for_the_lock_holder(self):
+        build = mock.Mock(return_value="own")
+        self.cache.add("key:lock", 1)
+
+        builder = threading.Timer(0.1, catalog_cache.put, ["key", "built"])
+        builder.start()
+
+        self.assertEqual(catalog_cache.get_or_build("key", build), "built")
+        build.assert_not_called()
+        builder.join()
+
+
+class ConditionalGetTests(TestCase):
+
+    def setUp(self):
+        self.admin = Staff.objects.create_user(username="admin", role=Staff.StaffRoleChoices.ADMIN)
+        self.category = Category.objects.create(title="Medicine")
+        self.product = Product.objects.create(title="Aspirin", category=self.category)
+        ProductBatch.objects.create(product=self.product, quantity=5, unitPrice=1, retailPrice=10)
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def test_detail_revalidates_nested_changes(self):
+        url = f'/api/products/{self.product.pk}/'
+        etag = self.client.get(url)['ETag']
+
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.category.title = "Pharmacy"
+        self.category.save()
+
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_stale_cached_bodies_are_not_served_under_new_etags(self):
+        catalog_cache.get_cache().clear()
+        detail, category = f'/api/products/{self.product.pk}/', f'/api/categories/{self.category.pk}/'
+
+        etags = {url: self.client.get(url)['ETag'] for url in (detail, category, '/api/products/')}
+
+        # Changed by another process, whose invalidation never reaches this one's cache
+        Product.objects.filter(pk=self.product.pk).update(title="Aspirin Forte", **Product.touched())
+        Category.objects.filter(pk=self.category.pk).update(title="Pharmacy", **Category.touched())
+
+        for url, title in [(detail, "Aspirin Forte"), (category, "Pharmacy"), ('/api/products/', "Aspirin Forte")]:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etags[url])
+
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etags[url])
+            self.assertIn(title, response.content.decode())
+
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_list_revalidates_bulk_updates(self):
+        etag = self.client.get('/api/product-batches/')['ETag']
+
+        self.assertEqual(self.client.get('/api/product-batches/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        commit_sale(self.admin, [sold_item(self.product, 2, 10)])
+
+        self.assertEqual(self.client.get('/api/product-batches/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class AsyncReadTests(TestCase):
+
+    def setUp(self):
+        self.admin = Staff.objects.create_user(username="admin", role=Staff.StaffRoleChoices.ADMIN)
+        self.product = Product.objects.create(title="Aspirin", category=Category.objects.create(title="Medicine"))
+        ProductBatch.objects.create(product=self.product, quantity=5, unitPrice=1, retailPrice=10)
+
+        self.sale = commit_sale(self.admin, [sold_item(self.product, 2, 10)])
+        self.headers = {'Authorization': f'Bearer {AccessToken.for_user(self.admin)}'}
+
+    async def test_matches_sync_views(self):
+        for async_url, sync_url in [
+            (f'/api/async/products/{self.product.pk}/', f'/api/products/{self.product.pk}/'),
+            (f'/api/async/sales/{self.sale.pk}/', f'/api/sales/{self.sale.pk}/'),
+        ]:
+            response = await self.async_client.get(async_url, headers=self.headers)
+            expected = await self.async_client.get(sync_url, headers=self.headers)
+
+            self.assertEqual(response.content, expected.content)
+            self.assertEqual(response['ETag'], expected['ETag'])
+
+        self.assertIsNone(get_current_user())
+
+    async def test_rebuilds_stale_cached_bodies(self):
+        url = f'/api/async/products/{self.product.pk}/'
+        await self.async_client.get(f'/api/products/{self.product.pk}/', headers=self.headers)
+
+        await Product.objects.filter(pk=self.product.pk).aupdate(title="Aspirin Forte", **Product.touched())
+
+        response = await self.async_client.get(url, headers=self.headers)
+        self.assertEqual(json.loads(response.content)['title'], "Aspirin Forte")
+
+    async def test_requires_authentication(self):
+        response = await self.async_client.get(f'/api/async/products/{self.product.pk}/')
+
+        self.assertEqual(response.status_code, 401)
+
+
+class SaleFilterTests(TestCase):
+
+    def setUp(self):
+        self.admin = Staff.objects.create_user(username="admin", role=Staff.StaffRoleChoices.ADMIN)
+        self.cashier = Staff.objects.create_user(username="cashier", role=Staff.StaffRoleChoices.CASHIER)
+        self.product = Product.objects.create(title="Aspirin")
+        ProductBatch.objects.create(product=self.product, quantity=10, unitPrice=1, retailPrice=10)
+
+        self.old = commit_sale(self.admin, [sold_item(self.product, 1, 10)], payment_type=Sale.PaymentTypeChoices.CASH)
+        self.new = commit_sale(self.cashier, [sold_item(self.product, 2, 10)])
+
+        last_week = timezone.now() - timedelta(days=7)
+        Sale.objects.filter(pk=self.old.pk).update(created_at=last_week)
+        SaleProduct.objects.filter(sale=self.old).update(created_at=last_week)
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def ids(self, url, **params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200, response.data)
+        return [row.get('sale_id', row.get('sale')) for row in response.data['results']]
+
+    def test_filters_sales_and_items(self):
+        today = timezone.localdate().isoformat()
+        product_url = f'/api/products/{self.product.pk}/sales/'
+
+        self.assertEqual(self.ids('/api/sales/', date_from=today), [self.new.pk])
+        self.assertEqual(self.ids('/api/sales/', recorder=self.admin.pk), [self.old.pk])
+        self.assertEqual(self.ids('/api/sales/', payment_type='Cash', date_to=today), [self.old.pk])
+        self.assertEqual(self.ids('/api/sales/', status='Closed'), [])
+
+        self.assertEqual(self.ids(product_url, date_to=(timezone.localdate() - timedelta(days=8)).isoformat()), [])
+        self.assertEqual(self.ids(product_url, recorder=self.cashier.pk, status='Sold'), [self.new.pk])
+        self.assertEqual(self.ids(f'/api/sales/{self.old.pk}/products/', payment_type='Cash'), [self.old.pk])
+
+        self.assertEqual(self.client.get('/api/sales/', {'date_from': 'yesterday'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/sales/', {'recorder': 'me'}).status_code, 400)
+
+    @unittest.skipUnless(connection.vendor == 'postgresql', "EXPLAIN output is PostgreSQL's")
+    def test_filters_use_indexes(self):
+        since = timezone.now() - timedelta(days=1)
+
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+
+        for queryset, index in [
+            (Sale.objects.filter(recorder_id=self.admin.pk, created_at__gte=since), 'sale_recorder_date_idx'),
+            (Sale.objects.filter(status='InProgress', created_at__gte=since), 'sale_status_date_idx'),
+            (Sale.objects.filter(payment_type='Cash', created_at__gte=since), 'sale_payment_date_idx'),
+            (SaleProduct.objects.filter(product_id=self.product.pk, created_at__gte=since), 'saleproduct_product_date_idx'),
+            (SaleProduct.objects.filter(product_id=self.product.pk, status='Sold'), 'saleproduct_product_status_idx'),
+            (SaleProduct.objects.filter(status='Returned', created_at__gte=since), 'saleproduct_status_date_idx'),
+        ]:
+            self.assertIn(index, queryset.order_by().explain(), str(queryset.query))
+
+        self.assertIn('Index', Sale.objects.filter(code=self.new.code).explain())
+
+
+class ExportTests(TestCase):
+
+    def setUp(self):
+        self.admin = Staff.objects.create_user(username="admin", role=Staff.StaffRoleChoices.ADMIN)
+        self.product = Product.objects.create(title="Aspirin")
+        ProductBatch.objects.create(product=self.product, quantity=10, unitPrice=1, retailPrice=10)
+
+        self.old = commit_sale(self.admin, [sold_item(self.product, 1, 10)], status=Sale.SaleStatusChoices.CLOSED)
+        self.new = commit_sale(self.admin, [sold_item(self.product, 2, 10), sold_item(self.product, 3, 10)])
+
+        last_week = timezone.now() - timedelta(days=7)
+        Sale.objects.filter(pk=self.old.pk).update(created_at=last_week)
+        SaleProduct.objects.filter(sale=self.old).update(created_at=last_week)
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def export(self, url, **params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode()
+
+    def test_csv_and_ndjson(self):
+        rows = list(csv.reader(self.export('/api/export/sales/').splitlines()))
+
+        self.assertEqual(rows[0], ['sale_id', 'code', 'created_at', 'totalAmount', 'status', 'payment_type', 'recorder_id'])
+        self.assertEqual([row[1] for row in rows[1:]], [self.old.code, self.new.code])
+        self.assertEqual(rows[2][3:5], ['50.00', 'InProgress'])
+
+        lines = [json.loads(line) for line in self.export('/api/export/sale-products/', output='ndjson').splitlines()]
+
+        self.assertEqual([line['sale_id'] for line in lines], [self.old.pk, self.new.pk, self.new.pk])
+        self.assertEqual(lines[0]['sale_created_at'], Sale.objects.get(pk=self.old.pk).created_at.isoformat())
+        self.assertEqual((lines[2]['quantity'], lines[2]['status']), ('3.00', 'Sold'))
+
+    def test_filters(self):
+        today = timezone.localdate().isoformat()
+
+        def codes(**params):
+            return [row[1] for row in csv.reader(self.export('/api/export/sales/', **params).splitlines()[1:])]
+
+        self.assertEqual(codes(date_from=today), [self.new.code])
+        self.assertEqual(codes(date_to=(timezone.localdate() - timedelta(days=1)).isoformat()), [self.old.code])
+        self.assertEqual(codes(status='Closed'), [self.old.code])
+        self.assertEqual(len(self.export('/api/export/sale-products/', date_from=today).splitlines()), 3)
+
+        self.assertEqual(self.client.get('/api/export/sales/', {'date_from': 'yesterday'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/export/sales/', {'output': 'xlsx'}).status_code, 400)
+
+    @override_settings(EXPORT_CHUNK_SIZE=1)
+    def test_streams_rows(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/export/sale-products/')
+
+        # Nothing is read until the response is consumed, then the rows come one at a time
+        self.assertTrue(response.streaming)
+        self.assertFalse([query for query in queries.captured_queries if 'pharmacy_app_saleproduct' in query['sql']])
+
+        with mock.patch.object(SQLCompiler, 'execute_sql', autospec=True, side_effect=SQLCompiler.execute_sql) as execute:
+            chunks = list(response.streaming_content)
+
+        self.assertEqual(len(chunks), 4)
+        self.assertEqual(execute.call_count, 1)
+        self.assertEqual(execute.call_args.kwargs, {'chunked_fetch': True, 'chunk_size': 1})
+
+
+class SaleNumberingTests(TestCase):
+
+    def setUp(self):
+        self.admin = Staff.objects.create_user(username="admin", role=Staff.StaffRoleChoices.ADMIN)
+        self.product = Product.objects.create(title="Aspirin")
+        ProductBatch.objects.create(product=self.product, quantity=10, unitPrice=1, retailPrice=10)
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def test_codes_follow_the_sale_numbers(self):
+        first = commit_sale(self.admin, [sold_item(self.product, 1, 10)])
+        second = commit_sale(self.admin, [sold_item(self.product, 1, 10)], prefix="STORE2")
+
+        self.assertEqual(first.code, f"SALE-{first.pk:06d}")
+        self.assertEqual(second.code, f"STORE2-{second.pk:06d}")
+        self.assertEqual(Sale.objects.get(pk=second.pk).code, second.code)
+
+        response = self.client.post('/api/sales/', {
+            'payment_type': 'Cash', 'terminal': 'till-3',
+            'items': [{'product': self.product.pk, 'quantity': '1', 'retailPrice': '10', 'status': 'Sold'}],
+        }, format='json')
+
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(response.data['code'], f"TILL-3-{response.data['sale_id']:06d}")
+
+    def test_lookup_by_code(self):
+        sale = commit_sale(self.admin, [sold_item(self.product, 2, 10)])
+
+        response = self.client.get(f'/api/sales/by-code/{sale.code}/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, self.client.get(f'/api/sales/{sale.pk}/').content)
+        self.assertEqual(self.client.get(f'/api/sales/by-code/{sale.code}/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertEqual(self.client.get('/api/sales/by-code/SALE-999999/').status_code, 404)
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRoutingTests(TestCase):
+
+    def test_reads_after_a_write_stay_on_primary(self):
+        with routing(replica=True):
+            self.assertEqual(Product.objects.all().db, 'replica')
+
+            Category.objects.create(title="Medicine")
+
+            self.assertEqual(Product.objects.all().db, 'default')
+
+        with routing(replica=True, pinned=True):
+            self.assertEqual(Product.objects.all().db, 'default')
+
+        self.assertEqual(Product.objects.all().db, 'default')
+
+    def test_write_pins_the_client_to_primary(self):
+        client = APIClient()
+        client.force_authenticate(Staff.objects.create_user(username="admin", role=Staff.StaffRoleChoices.ADMIN))
+
+        self.assertNotIn('db_primary_until', client.get('/api/categories/').cookies)
+        self.assertIn('db_primary_until', client.post('/api/categories/', {"title": "Medicine"}).cookies)
+
+
+class ReplicaReadTests(TransactionTestCase):
+    """Reads served by a second database connection, a test mirror of the primary as DB_REPLICA_HOSTS configures"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+
+        # Added once the test database exists, so the connection opens that one
+        connections.settings['replica'] = {
+            **connections['default'].settings_dict, 'TEST': {**connections['default'].settings_dict['TEST'], 'MIRROR': 'default'}
+        }
+        cls.databases = {'default', 'replica'}
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.databases = {'default'}
+        connections['replica'].close()
+        del connections['replica']
+        del connections.settings['replica']
+
+        super().tearDownClass()
+
+    def setUp(self):
+        self.admin = Staff.objects.create_user(username="admin", role=Staff.StaffRoleChoices.ADMIN)
+        self.product = Product.objects.create(title="Aspirin")
+        ProductBatch.objects.create(product=self.product, quantity=10, unitPrice=1, retailPrice=10)
+        commit_sale(self.admin, [sold_item(self.product, 2, 10)])
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def request(self, method, url, data=None):
+        """Returns the response and the SQL run on the primary and on the replica"""
+
+        with CaptureQueriesContext(connections['default']) as primary, CaptureQueriesContext(connections['replica']) as replica:
+            response = getattr(self.client, method)(url, data, format='json')
+
+            # Exports read their rows while streaming
+            if response.streaming:
+                list(response.streaming_content)
+
+        return response, [query['sql'] for query in primary], [query['sql'] for query in replica]
+
+    @override_settings(DATABASE_REPLICAS=['replica'])
+    def test_safe_reads_are_served_by_the_replica(self):
+        for url in (f'/api/products/{self.product.pk}/sales/', '/api/reports/totals/', '/api/export/sales/'):
+            with self.subTest(url=url):
+                response, primary, replica = self.request('get', url)
+
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(primary, [])
+                self.assertTrue(replica)
+
+        # Views without the annotation read from the primary
+        response, primary, replica = self.request('get', '/api/categories/')
+        self.assertTrue(primary)
+        self.assertEqual(replica, [])
+
+    @override_settings(DATABASE_REPLICAS=['replica'])
+    def test_writes_stay_on_the_primary(self):
+        response, primary, replica = self.request('post', '/api/sales/', {
+            'payment_type': 'Cash',
+            'items': [{'product': self.product.pk, 'quantity': '1', 'retailPrice': '10', 'status': 'Sold'}],
+        })
+
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(any(sql.startswith('INSERT') for sql in primary))
+        self.assertEqual(replica, [])
+
+        # Unsafe methods never go to the replica, and the client reads its writes from the primary for a while
+        response, primary, replica = self.request('post', '/api/reports/totals/')
+        self.assertEqual((response.status_code, replica), (405, []))
+
+        response, primary, replica = self.request('get', f'/api/products/{self.product.pk}/sales/')
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertTrue(primary)
+        self.assertEqual(replica, [])
+
+
+def load_settings(module='django_pharmacy.settings', **environ):
+    """Runs a settings module afresh with the given environment variables, returns its settings"""
+
+    with mock.patch.dict(os.environ, environ):
+        return runpy.run_path(importlib.util.find_spec(module).origin)
+
+
+class DatabasePoolTests(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(Staff.objects.create_user(username="admin", is_staff=True))
+
+    def test_stats_without_pooling(self):
+        response = self.client.get('/api/admin/db-pool/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.data['default'])
+
+    def test_stats_of_a_pool(self):
+        pool = mock.Mock(**{'get_stats.return_value': {'pool_min': 2, 'pool_size': 3, 'requests_waiting': 0}})
+
+        with mock.patch.object(connections['default'], 'pool', pool, create=True):
+            response = self.client.get('/api/admin/db-pool/')
+
+        self.assertEqual(response.data['default'], {'pool_min': 2, 'pool_size': 3, 'requests_waiting': 0})
+
+    def test_pool_settings_from_the_environment(self):
+        database = load_settings(
+            DB_POOL='1', DB_POOL_MIN_SIZE='4', DB_POOL_MAX_SIZE='20', DB_POOL_TIMEOUT='2.5'
+        )['DATABASES']['default']
+
+        self.assertEqual(database['OPTIONS']['pool'], {
+            'min_size': 4, 'max_size': 20, 'timeout': 2.5, 'max_idle': 300.0, 'max_lifetime': 1800.0,
+        })
+        self.assertNotIn('CONN_MAX_AGE', database)
+
+        database = load_settings(DB_POOL='0', DB_CONN_MAX_AGE='30')['DATABASES']['default']
+
+        self.assertNotIn('pool', database['OPTIONS'])
+        self.assertEqual(database['CONN_MAX_AGE'], 30)
+
+
+class ProfilingTests(TestCase):
+    databases = {'default', 'profiling'}
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(Staff.objects.create_user(username="admin", is_staff=True))
+        Product.objects.create(title="Aspirin")
+
+    def profiled(self):
+        from silk.models import Request
+
+        return Request.objects.filter(path='/api/products/')
+
+    @override_settings(PROFILING_SAMPLE_RATE=0.25, PROFILING_TOKEN='secret')
+    def test_samples_a_fraction_and_opted_in_requests(self):
+        factory = RequestFactory()
+
+        for value, sampled in [(0.2, True), (0.3, False)]:
+            with mock.patch('pharmacy_app.utils.sampling.random.random', return_value=value):
+                self.assertEqual(should_profile(factory.get('/')), sampled)
+
+        with mock.patch('pharmacy_app.utils.sampling.random.random', return_value=0.9):
+            self.assertTrue(should_profile(factory.get('/', HTTP_X_PROFILE='secret')))
+            self.assertFalse(should_profile(factory.get('/', HTTP_X_PROFILE='guess')))
+
+    @override_settings(PROFILING_SLOW_REQUEST_MS=0, SLOW_QUERY_LOG_MS=0)
+    def test_records_slow_requests(self):
+        self.assertEqual(self.client.get('/api/products/').status_code, 200)
+
+        silk_request = self.profiled().get()
+        self.assertGreater(silk_request.num_sql_queries, 0)
+        self.assertEqual(silk_request.queries.count(), silk_request.num_sql_queries)
+        self.assertEqual(silk_request.response.status_code, 200)
+
+    @override_settings(PROFILING_SLOW_REQUEST_MS=60000)
+    def test_leaves_fast_requests_alone(self):
+        with mock.patch.object(connections['default'], 'execute_wrapper') as execute_wrapper:
+            self.assertEqual(self.client.get('/api/products/').status_code, 200)
+
+        execute_wrapper.assert_not_called()
+        self.assertFalse(self.profiled().exists())
+
+    def test_production_settings(self):
+        production = load_settings('django_pharmacy.settings_production', DJANGO_SECRET_KEY='secret', CATALOG_CACHE_URL='redis://cache:6379/1', PROFILING='')
+
+        self.assertFalse(production['DEBUG'])
+        self.assertTrue({'silk', 'debug_toolbar', 'django_extensions'}.isdisjoint(production['INSTALLED_APPS']))
+        self.assertNotIn('silk.middleware.SilkyMiddleware', production['MIDDLEWARE'])
+        self.assertNotIn('pharmacy_app.profiling.SlowRequestProfilingMiddleware', production['MIDDLEWARE'])
+        self.assertNotIn('debug_toolbar.middleware.DebugToolbarMiddleware', production['MIDDLEWARE'])
+        self.assertNotIn('profiling', production['DATABASES'])
+        self.assertEqual(production['CACHES']['catalog']['LOCATION'], 'redis://cache:6379/1')
+
+        profiling = load_settings('django_pharmacy.settings_production', DJANGO_SECRET_KEY='secret', CATALOG_CACHE_URL='redis://cache:6379/1', PROFILING='1')
+
+        self.assertIn('silk', profiling['INSTALLED_APPS'])
+        self.assertNotIn('debug_toolbar', profiling['INSTALLED_APPS'])
+        self.assertIn('pharmacy_app.profiling.SlowRequestProfilingMiddleware', profiling['MIDDLEWARE'])
+        self.assertIn('profiling', profiling['DATABASES'])
+        self.assertEqual(profiling['PROFILING_SAMPLE_RATE'], 0.01)
+
+
+class ServerTimingTests(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(Staff.objects.create_user(username="admin", is_staff=True))
+        Product.objects.create(title="Aspirin")
+
+    def test_reports_time_and_query_count(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/products/')
+
+        entries = dict(entry.split(';', 1) for entry in response['Server-Timing'].split(', '))
+
+        self.assertEqual(list(entries), ['db', 'serialize', 'signals', 'total'])
+        self.assertTrue(entries['db'].endswith(f'desc="{len(queries)} queries"'))
+
+    def test_attributes_building_the_payload_to_serialization(self):
+        catalog_cache.get_cache().clear()
+        product = Product.objects.get()
+        to_representation = serializers.ModelSerializer.to_representation
+
+        def slow(serializer, instance):
+            time.sleep(0.02)
+            return to_representation(serializer, instance)
+
+        with mock.patch.object(serializers.ModelSerializer, 'to_representation', autospec=True, side_effect=slow):
+            response = self.client.get(f'/api/products/{product.pk}/')
+
+        entries = dict(entry.split(';', 1) for entry in response['Server-Timing'].split(', '))
+
+        self.assertGreaterEqual(float(entries['serialize'].removeprefix('dur=')), 20)
+
+    @override_settings(SLOW_REQUEST_LOG_MS=0, SLOW_QUERY_LOG_MS=0)
+    def test_logs_slow_requests_and_queries(self):
+        with self.assertLogs('pharmacy_app.timing', 'WARNING') as logs:
+            self.client.get('/api/products/')
+
+        events = [json.loads(record.getMessage()) for record in logs.records]
+        slow_request = [event for event in events if event['event'] == 'slow_request']
+        slow_queries = [event for event in events if event['event'] == 'slow_query']
+
+        self.assertEqual(len(slow_request), 1)
+        self.assertEqual(slow_request[0]['path'], '/api/products/')
+        self.assertEqual(slow_request[0]['queries'], len(slow_queries))
+        self.assertTrue(slow_queries)
+        self.assertTrue(all(event['view'] == slow_request[0]['view'] for event in slow_queries))
+
+    @override_settings(SLOW_REQUEST_LOG_MS=60000, SLOW_QUERY_LOG_MS=60000)
+    def test_quiet_below_the_thresholds(self):
+        with self.assertNoLogs('pharmacy_app.timing', 'WARNING'):
+            self.client.get('/api/products/')
+
+
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        self.admin = Staff.objects.create_user(username="admin", role=Staff.StaffRoleChoices.ADMIN)
+        self.product = Product.objects.create(title="Aspirin", category=Category.objects.create(title="Medicine"))
+        ProductBatch.objects.create(product=self.product, quantity=5, unitPrice=1, retailPrice=10)
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_counts_checkouts(self):
+        sales, failures = self.sample('pharmacy_sales_total'), self.sample('pharmacy_stock_validation_failures_total', stage='validate')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            for quantity in (2, 9):
+                self.client.post('/api/sales/', {
+                    "payment_type": "Cash",
+                    "items": [{"product": self.product.pk, "quantity": quantity, "retailPrice": 10, "status": "Sold"}]
+                }, format='json')
+
+        self.assertEqual(self.sample('pharmacy_sales_total'), sales + 1)
+        self.assertEqual(self.sample('pharmacy_stock_validation_failures_total', stage='validate'), failures + 1)
+
+    def test_exposes_request_metrics(self):
+        self.client.get('/api/products/')
+
+        response = self.client.get('/metrics')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'pharmacy_http_request_duration_seconds_bucket{le="0.005",method="GET",view="api.views.ListCreateProducts"}', response.content)
+        self.assertIn(b'pharmacy_batch_rows_scanned_total', response.content)
+
+
+class BenchmarkCommandTests(TestCase):
+
+    def test_reports_every_scenario(self):
+        with tempfile.NamedTemporaryFile(suffix='.json') as output:
+            call_command(
+                'benchmark', seed_products=10, seed_sales=5, requests=40, concurrency=1, warmup=0,
+                output=output.name, stdout=StringIO()
+            )
+            results = json.load(output)
+
+        self.assertEqual(results['total']['requests'], 40)
+        self.assertEqual(results['total']['errors'], 0)
+        self.assertEqual(set(results['scenarios']), {'checkout', 'browse', 'sale', 'history'})
+        self.assertGreater(results['scenarios']['checkout']['queries_per_request'], 0)
+
+    def test_compares_with_a_run_outside_git(self):
+        options = dict(seed_products=10, seed_sales=5, requests=20, concurrency=1, warmup=0, mix='browse=1')
+
+        with tempfile.NamedTemporaryFile(suffix='.json') as output:
+            with mock.patch.object(benchmark.Command, 'git_commit', return_value=None):
+                call_command('benchmark', output=output.name, stdout=StringIO(), **options)
+
+            stdout = StringIO()
+            call_command('benchmark', compare=output.name, stdout=stdout, **options)
+
+        self.assertIn("vs previous", stdout.getvalue())
+
+
+class PopulateDbTests(TestCase):
+
+    OPTIONS = dict(products=30, sales=200, lines=3, months=3, cashiers=2, until='2025-06-30', seed=7, chunk_size=50, stdout=StringIO())
+
+    def lines(self):
+        return list(SaleProduct.objects.order_by('id').values_list('product__title', 'quantity', 'retailPrice', 'status', 'sale__created_at'))
+
+    def test_loads_consistent_history(self):
+        call_command('populate_db', **self.OPTIONS)
+
+        self.assertEqual(Sale.objects.count(), 200)
+        self.assertGreater(SaleProduct.objects.count(), 200)
+        self.assertTrue(SaleProduct.objects.filter(status=SaleProduct.SaleProductStatusChoices.RETURNED).exists())
+        self.assertEqual(Sale.objects.dates('created_at', 'month').count(), 3)
+        self.assertFalse(SaleProduct.objects.exclude(created_at=F('sale__created_at')).exists())
+
+        # Raises when the rebuilt rollups don't match the lines
+        call_command('rebuild_rollups', verify=True, stdout=StringIO())
+        self.assertEqual(StockLevel.objects.aggregate(total=Sum('quantity'))['total'], ProductBatch.objects.aggregate(total=Sum('quantity'))['total'])
+
+    def test_same_seed_gives_same_data(self):
+        call_command('populate_db', **self.OPTIONS)
+        first = self.lines()
+
+        for model in (SaleProduct, Sale, ProductBatch, Product):
+            model.objects.all().delete()
+
+        call_command('populate_db', **self.OPTIONS)
+
+        self.assertEqual(self.lines(), first)
+
+
+class ProductBarcodeTests(TestCase):
+
+    def setUp(self):
+        catalog_cache.get_cache().clear()
+
+        self.cashier = Staff.objects.create_user(username="cashier", role=Staff.StaffRoleChoices.CASHIER)
+        self.product = Product.objects.create(title="Aspirin", category=Category.objects.create(title="Medicine"))
+        ProductBarcode.objects.create(product=self.product, code="4006381333931")
+        ProductBarcode.objects.create(product=self.product, code="ASP-100")
+
+        ProductBatch.objects.create(product=self.product, quantity=5, unitPrice=6, retailPrice=12)
+        ProductBatch.objects.create(product=self.product, quantity=3, unitPrice=5, retailPrice=10)
+        ProductBatch.objects.create(product=self.product, quantity=0, unitPrice=4, retailPrice=8)
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.cashier)
+
+    def scan(self, code):
+        return self.client.get(f'/api/products/by-barcode/{code}/')
+
+    def test_one_query_cold_none_hot(self):
+        with self.assertNumQueries(1):
+            response = self.scan("ASP-100")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['id'], self.product.pk)
+        self.assertEqual(response.data['category']['title'], "Medicine")
+        self.assertEqual(response.data['prices'], [
+            {'retailPrice': '10.00', 'quantity': '3.00'},
+            {'retailPrice': '12.00', 'quantity': '5.00'},
+        ])
+        self.assertEqual(response.data['quantity'], '8.00')
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.scan("ASP-100").data['prices'], response.data['prices'])
+
+        self.assertEqual(self.scan("4006381333931").data['barcode'], "4006381333931")
+        self.assertEqual(self.scan("unknown").status_code, 404)
+
+    def test_follows_sales_and_barcode_changes(self):
+        self.scan("ASP-100")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            commit_sale(self.cashier, [sold_item(self.product, 3, 10)])
+
+        self.assertEqual(self.scan("ASP-100").data['prices'], [{'retailPrice': '12.00', 'quantity': '5.00'}])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            barcode = ProductBarcode.objects.get(code="ASP-100")
+            barcode.code = "ASP-200"
+            barcode.save()
+
+        self.assertEqual(self.scan("ASP-100").status_code, 404)
+        self.assertEqual(self.scan("ASP-200").data['id'], self.product.pk)
+
+
+class ProductSearchTests(TestCase):
+
+    def setUp(self):
+        self.medicine = Category.objects.create(title="Medicine")
+        self.aspirin = Product.objects.create(title="Aspirin Cardio 100mg", category=self.medicine)
+        Product.objects.create(title="Ibuprofen 200mg", category=self.medicine)
+        Product.objects.create(title="Zinc cream", category=Category.objects.create(title="Dermatology"))
+
+        self.client = APIClient()
+        self.client.force_authenticate(Staff.objects.create_user(username="cashier", role=Staff.StaffRoleChoices.CASHIER))
+
+        search.rebuild()
+
+    def titles(self, query):
+        response = self.client.get('/api/products/search/', {'q': query})
+        return [product['title'] for product in response.data['results']]
+
+    def test_ranks_prefixes_categories_and_typos(self):
+        index = search.ProductIndex([(1, "Aspirin 500mg", None), (2, "Cardio Aspirin", None), (3, "Aspartame", None)])
+
+        self.assertEqual([title for _, title, _ in index.search("asp")], ["Aspartame", "Aspirin 500mg", "Cardio Aspirin"])
+        self.assertEqual([title for _, title, _ in index.search("aspirin")], ["Aspirin 500mg", "Cardio Aspirin"])
+
+        self.assertEqual(self.titles("ibuprfen"), ["Ibuprofen 200mg"])
+        self.assertEqual(self.titles("derma"), ["Zinc cream"])
+        self.assertEqual(self.titles("ASPIRINE card"), ["Aspirin Cardio 100mg"])
+
+    def test_follows_catalog_changes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.create(title="Aspirin Forte", category=self.medicine)
+            self.aspirin.delete()
+            self.medicine.title = "Pain relief"
+            self.medicine.save()
+
+        self.assertEqual(self.titles("aspirin"), ["Aspirin Forte"])
+        self.assertEqual(self.titles("pain"), ["Aspirin Forte", "Ibuprofen 200mg"])
+
+    def test_database_fallback(self):
+        self.assertEqual([title for _, title, *_ in search.search_database("cardio aspirin")], ["Aspirin Cardio 100mg"])
+
+    def test_syncs_other_processes_changes_outside_the_lock(self):
+        # Changes of another process: no signals reach this index, only the catalog generation moves
+        Product.objects.create(title="Zinc tablets", category=self.medicine)
+        Product.objects.filter(pk=self.aspirin.pk)._raw_delete(Product.objects.db)
+        search.record_deletion('product', self.aspirin.pk)
+        catalog_cache.bump_generation('products')
+        search._checked_at = 0
+
+        def lock_is_free():
+            free = []
+
+            def attempt():
+                if search._lock.acquire(blocking=False):
+                    search._lock.release()
+                    free.append(True)
+
+            thread = threading.Thread(target=attempt)
+            thread.start()
+            thread.join()
+            return bool(free)
+
+        held, statements = [], []
+
+        def check_lock(execute, sql, params, many, context):
+            held.append(not lock_is_free())
+            statements.append(sql)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(check_lock):
+            self.assertEqual(self.titles("zinc"), ["Zinc cream", "Zinc tablets"])
+            self.assertEqual(self.titles("aspirin"), [])
+
+        self.assertTrue(held)
+        self.assertNotIn(True, held)
+
+        # Only the changed rows are read, the deletions come from the tombstones
+        self.assertTrue(all(' WHERE ' in sql for sql in statements))
+
+    def test_rebuilds_when_tombstones_expired(self):
+        Product.objects.filter(pk=self.aspirin.pk)._raw_delete(Product.objects.db)
+        search.record_deletion('product', self.aspirin.pk)
+        catalog_cache.get_cache().delete(f"search:deletions:{catalog_cache.get_cache().get('search:deletions')}")
+        search._checked_at = 0
+
+        # Only a full read finds it, its tombstone is gone
+        self.assertEqual(self.titles("aspirin"), [])
+
+    def test_builds_in_the_request_under_tests(self):
+        self.assertFalse(settings.SEARCH_INDEX_WARM)
+
+        with mock.patch.object(search, '_index', None), mock.patch.object(search.threading, 'Thread') as thread:
+            self.assertEqual(self.titles("ibu"), ["Ibuprofen 200mg"])
+            self.assertIsNotNone(search._index)
+
+        thread.assert_not_called()
+
+    @unittest.skipUnless(connection.vendor == 'postgresql', "trigram similarity needs PostgreSQL")
+    def test_database_fallback_on_postgresql(self):
+        search.create_trigram_indexes_on_migrate(apps.get_app_config('pharmacy_app'), using='default')
+
+        self.assertEqual(search.search_database("aspirn cardio")[0][1], "Aspirin Cardio 100mg")
+        self.assertEqual({title for _, title, *_ in search.search_database("dermatology")}, {"Zinc cream"})
+
+    def test_creates_the_trigram_indexes_on_postgresql(self):
+        config = apps.get_app_config('pharmacy_app')
+
+        with mock.patch.object(connection, 'cursor') as cursor:
+            search.create_trigram_indexes_on_migrate(config, using='default')
+            cursor.assert_not_called()
+
+            with mock.patch.object(connection, 'vendor', 'postgresql'):
+                search.create_trigram_indexes_on_migrate(config, using='default')
+
+        statements = [call.args[0] for call in cursor.return_value.__enter__.return_value.execute.call_args_list]
+
+        self.assertEqual(statements, [
+            'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+            'CREATE INDEX IF NOT EXISTS "product_title_trgm_idx" ON "pharmacy_app_product" USING gin ("title" gin_trgm_ops)',
+            'CREATE INDEX IF NOT EXISTS "category_title_trgm_idx" ON "pharmacy_app_category" USING gin ("title" gin_trgm_ops)',
+        ])
+
+
+class FastListTests(TestCase):
+
+    URLS = {
+        views.ListCreateProducts: '/api/products/',
+        views.ListCreateSales: '/api/sales/',
+        views.ListCreateSaleProducts: '/api/sale-products/',
+        views.ListCreateProductBatches: '/api/product-batches/',
+    }
+
+    def setUp(self):
+        catalog_cache.get_cache().clear()
+        self.admin = Staff.objects.create_user(username="admin", role=Staff.StaffRoleChoices.ADMIN)
+        category = Category.objects.create(title="Médicaments")
+        self.products = [
+            Product.objects.create(title=title, category=category, recorder=self.admin)
+            for title in ["Aspirin \u2028 100mg", "Парацетамол", "Ibuprofen \"Forte\""]
+        ]
+        Product.objects.create(title="Zinc cream")
+
+        for product, price in zip(self.products, ['10.5', '3', '7.5']):
+            ProductBatch.objects.create(product=product, quantity=7, unitPrice=Decimal('1.5'), retailPrice=Decimal(price))
+
+        commit_sale(self.admin, [sold_item(self.products[0], 2, '10.5'), sold_item(self.products[1], 1, '3')])
+        commit_sale(self.admin, [sold_item(self.products[2], '0.25', '7.5')])
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def test_renders_the_serializer_bytes(self):
+        for view, url in self.URLS.items():
+            with self.subTest(url=url):
+                fast = self.client.get(url, {'page_size': 2})
+                catalog_cache.get_cache().clear()
+
+                with mock.patch.object(view, 'fast_list', False):
+                    expected = self.client.get(url, {'page_size': 2})
+
+                self.assertEqual(fast.status_code, 200)
+                self.assertEqual(fast.content, expected.content)
+
+    def test_pages_through_the_cursor(self):
+        url, titles = '/api/products/?page_size=1', []
+
+        while url:
+            page = self.client.get(url).json()
+            titles += [product['title'] for product in page['results']]
+            url = page['next']
+
+        self.assertEqual(titles, ["Zinc cream", *reversed([product.title for product in self.products])])
+
+    def test_filters_apply(self):
+        response = self.client.get(f'/api/products/{self.products[2].pk}/sales/')
+
+        self.assertEqual([(line['quantity'], line['retailPrice']) for line in response.json()['results']], [('0.25', '7.50')])
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', "Row locking needs PostgreSQL")
+class ConcurrentCheckoutTests(TransactionTestCase):
+
+    THREADS = 16
+    SALES_PER_THREAD = 25
+
+    def setUp(self):
+        self.cashier = Staff.objects.create_user(username="cashier", role=Staff.StaffRoleChoices.CASHIER)
+        self.product = Product.objects.create(title="Aspirin", category=Category.objects.create(title="Medicine"))
+
+        for _ in range(20):
+            ProductBatch.objects.create(product=self.product, quantity=30, unitPrice=1, retailPrice=10)
+
+    def test_stock_stays_consistent(self):
+        sold = []
+        errors = []
+        start = threading.Barrier(self.THREADS)
+
+        def checkout(seed):
+            rng = random.Random(seed)
+            start.wait()
+
+            try:
+                for _ in range(self.SALES_PER_THREAD):
+                    quantity = rng.randint(1, 4)
+                    try:
+                        commit_sale(self.cashier, [sold_item(self.product, quantity, 10)])
+                        sold.append(quantity)
+                    except InsufficientStockError:
+                        pass
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=checkout, args=(seed,)) for seed in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+
+        remaining = ProductBatch.objects.aggregate(total=Sum('quantity'))['total']
+
+        self.assertEqual(remaining + sum(sold), 600)
+        self.assertFalse(ProductBatch.objects.filter(quantity__lt=0).exists())
+        self.assertEqual(SaleProduct.objects.aggregate(total=Sum('quantity'))['total'], sum(sold))
+        self.assertEqual(StockLevel.objects.get(product=self.product).quantity, remaining)
+
+
+class PartitionTests(TransactionTestCase):
+
+    def test_month_arithmetic(self):
+        month = partitions.month_start(timezone.make_aware(datetime(2025, 11, 17, 15, 30)))
+
+        self.assertEqual(month, timezone.make_aware(datetime(2025, 11, 1)))
+        self.assertEqual(partitions.add_months(month, 2), timezone.make_aware(datetime(2026, 1, 1)))
+        self.assertEqual(partitions.add_months(month, -11), timezone.make_aware(datetime(2024, 12, 1)))
+        self.assertEqual(partitions.partition_name('pharmacy_app_sale', month), 'pharmacy_app_sale_y2025m11')
+
+    def test_checkouts_create_the_coming_months_once_a_month(self):
+        cashier = Staff.objects.create_user(username="cashier", role=Staff.StaffRoleChoices.CASHIER)
+        product = Product.objects.create(title="Aspirin")
+        ProductBatch.objects.create(product=product, quantity=10, unitPrice=1, retailPrice=10)
+
+        with mock.patch.object(partitions, 'is_supported', return_value=True), \
+                mock.patch.object(partitions, 'ensure_partitions') as ensure_partitions, \
+                mock.patch.object(partitions, '_ensured_until', None):
+            commit_sale(cashier, [sold_item(product, 1, 10)])
+            commit_sale(cashier, [sold_item(product, 1, 10)])
+
+            self.assertEqual(ensure_partitions.call_count, 1)
+
+            with mock.patch.object(partitions.timezone, 'now', return_value=timezone.now() + timedelta(days=32)):
+                commit_sale(cashier, [sold_item(product, 1, 10)])
+
+            self.assertEqual(ensure_partitions.call_count, 2)
+
+    @unittest.skipUnless(connection.vendor == 'postgresql', "Partitioning needs PostgreSQL")
+    def test_sales_past_the_horizon_go_to_the_default_partition(self):
+        cashier = Staff.objects.create_user(username="cashier", role=Staff.StaffRoleChoices.CASHIER)
+        product = Product.objects.create(title="Aspirin")
+        ProductBatch.objects.create(product=product, quantity=10, unitPrice=1, retailPrice=10)
+
+        call_command('partition_sales', 'convert', stdout=StringIO())
+
+        # Past SALES_PARTITION_MONTHS_AHEAD, as if nothing created partitions for a while
+        sale = commit_sale(cashier, [sold_item(product, 1, 10)])
+        later = timezone.now() + timedelta(days=200)
+        Sale.objects.filter(pk=sale.pk).update(created_at=later)
+        SaleProduct.objects.filter(sale=sale).update(created_at=later)
+
+        default = partitions.default_partition_name(Sale._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT COUNT(*) FROM {partitions.qn(default)}")
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+            call_command('partition_sales', 'create', ahead=12, stdout=StringIO())
+
+            cursor.execute(f"SELECT COUNT(*) FROM {partitions.qn(default)}")
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+        self.assertEqual(Sale.objects.get(pk=sale.pk).sale_products.get().quantity, 1)
+
+    @unittest.skipUnless(connection.vendor == 'postgresql', "Partitioning needs PostgreSQL")
+    def test_convert_create_and_detach(self):
+        cashier = Staff.objects.create_user(username="cashier", role=Staff.StaffRoleChoices.CASHIER)
+        product = Product.objects.create(title="Aspirin")
+        ProductBatch.objects.create(product=product, quantity=10, unitPrice=1, retailPrice=10)
+
+        old_sale = commit_sale(cashier, [sold_item(product, 1, 10)])
+        two_years_ago = timezone.now() - timedelta(days=800)
+        Sale.objects.filter(pk=old_sale.pk).update(created_at=two_years_ago)
+        SaleProduct.objects.filter(sale=old_sale).update(created_at=two_years_ago)
+
+        call_command('partition_sales', 'convert', stdout=StringIO())
+
+        self.assertTrue(all(partitions.is_partitioned(model) for model in partitions.PARTITIONED))
+        sale = commit_sale(cashier, [sold_item(product, 2, 10)])
+        self.assertEqual(sale.sale_products.get().quantity, 2)
+
+        call_command('partition_sales', 'detach', keep=12, drop=True, stdout=StringIO())
+
+        self.assertEqual(list(Sale.objects.values_list('pk', flat=True)), [sale.pk])
+        self.assertEqual(SaleProduct.objects.count(), 1)
@@ -0,0 +1,223 @@
+import functools
+import json
+import logging
+import re
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.dispatch import receiver
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from pharmacy_app.routers import PROFILING_DB_ALIAS
+
+logger = logging.getLogger(__name__)
+
+
+class RequestTimings:
+    """Where the time of the current request went, in seconds"""
+
+    __slots__ = ('queries', 'db', 'serialize', 'signals', 'slow_queries', '_active')
+
+    def __init__(self):
+        self.queries = 0
+        self.db = self.serialize = self.signals = 0.0
+        self.slow_queries = []  # (sql, duration, finished at)
+        self._active = set()
+
+
+_timings = ContextVar('request_timings', default=None)
+
+
+def get_timings():
+    return _timings.get()
+
+
+@contextmanager
+def measure(name):
+    """Adds the time spent in the block to the current request's `name` timing, once when nested"""
+
+    timings = _timings.get()
+
+    if timings is None or name in timings._active:
+        yield
+        return
+
+    timings._active.add(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        setattr(timings, name, getattr(timings, name) + time.perf_counter() - start)
+        timings._active.discard(name)
+
+
+def measured(name):
+    """Decorator version of measure(), e.g. for signal receivers"""
+
+    def decorator(function):
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with measure(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def timed_receiver(signal, **kwargs):
+    """django.dispatch.receiver() that adds the receiver's run time to the request's signal timing"""
+
+    def decorator(function):
+        # The wrapper has no other reference, so it can't be held weakly
+        receiver(signal, weak=False, **kwargs)(measured('signals')(function))
+        return function
+
+    return decorator
+
+
+class TimedSerializerMixin:
+    """Counts to_representation() as serialization time, a nested serializer's only once"""
+
+    def to_representation(self, instance):
+        with measure('serialize'):
+            return super().to_representation(instance)
+
+
+class TimedJSONRenderer(JSONRenderer):
+    """JSONRenderer counting the encoding as serialization time"""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        with measure('serialize'):
+            return super().render(data, accepted_media_type, renderer_context)
+
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_LISTS = re.compile(r"\((?:\s*(?:%s|\?)\s*,)+\s*(?:%s|\?)\s*\)")
+_ROWS = re.compile(r"(\(\.\.\.\))(?:\s*,\s*\(\.\.\.\))+")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_sql(sql):
+    """Reduces a statement to its shape: literals become ?, IN lists and VALUES rows collapse"""
+
+    sql = _LITERALS.sub('?', sql)
+    sql = _LISTS.sub('(...)', sql)
+    sql = _ROWS.sub(r'\1, ...', sql)
+
+    return _SPACES.sub(' ', sql).strip()
+
+
+def time_query(execute, sql, params, many, context):
+    """Database execute wrapper adding every query to the current request's timings"""
+
+    timings = _timings.get()
+
+    if timings is None:
+        return execute(sql, params, many, context)
+
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        duration = time.perf_counter() - start
+        timings.queries += 1
+        timings.db += duration
+
+        if duration * 1000 >= getattr(settings, 'SLOW_QUERY_LOG_MS', 100):
+            timings.slow_queries.append((sql, duration, timezone.now()))
+
+
+def install_query_timer(sender, connection, **kwargs):
+    """Times the queries of every new connection but the profiling store's (connection_created receiver)"""
+
+    if connection.alias != PROFILING_DB_ALIAS and time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, time_query)
+
+
+class ServerTimingMiddleware:
+    """
+    Reports query count, DB, serialization and signal time per request.
+
+    The numbers go out as a Server-Timing header. Requests slower than
+    SLOW_REQUEST_LOG_MS and queries slower than SLOW_QUERY_LOG_MS are logged
+    as JSON lines with the view name and the normalized SQL. The cost is a
+    couple of perf_counter() calls per query, cheap enough to stay on.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        timings = RequestTimings()
+        token = _timings.set(timings)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _timings.reset(token)
+
+        return self.report(request, response, timings, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+
+        timings = RequestTimings()
+        token = _timings.set(timings)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _timings.reset(token)
+
+        return self.report(request, response, timings, time.perf_counter() - start)
+
+    def report(self, request, response, timings, total):
+
+        response['Server-Timing'] = ", ".join([
+            f'db;dur={timings.db * 1000:.1f};desc="{timings.queries} queries"',
+            f'serialize;dur={timings.serialize * 1000:.1f}',
+            f'signals;dur={timings.signals * 1000:.1f}',
+            f'total;dur={total * 1000:.1f}',
+        ])
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else None
+
+        for sql, duration, _ in timings.slow_queries:
+            logger.warning(json.dumps({
+                'event': 'slow_query',
+                'view': view,
+                'duration_ms': round(duration * 1000, 1),
+                'sql': normalize_sql(sql),
+            }))
+
+        if total * 1000 >= getattr(settings, 'SLOW_REQUEST_LOG_MS', 500):
+            logger.warning(json.dumps({
+                'event': 'slow_request',
+                'view': view,
+                'method': request.method,
+                'path': request.path,
+                'status': response.status_code,
+                'duration_ms': round(total * 1000, 1),
+                'queries': timings.queries,
+                'db_ms': round(timings.db * 1000, 1),
+                'serialize_ms': round(timings.serialize * 1000, 1),
+                'signals_ms': round(timings.signals * 1000, 1),
+            }))
+
+        return response
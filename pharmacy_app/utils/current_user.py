@@ -0,0 +1,32 @@
+from contextvars import ContextVar
+
+# The request being handled. Context variables follow the request across threads and
+# coroutines (asgiref copies them into sync_to_async), unlike threading.local.
+_current_request = ContextVar('current_request', default=None)
+
+
+def bind_request(request):
+    """Makes `request` the current one, returns the token to release it with"""
+
+    return _current_request.set(request)
+
+
+def release_request(token):
+    _current_request.reset(token)
+
+
+def get_current_user():
+    """
+    Returns the authenticated user of the current request, or None.
+
+    The user is read from the request when asked for, so users authenticated
+    later by DRF (JWT) are seen too, not only session users.
+    """
+
+    request = _current_request.get()
+    user = getattr(request, 'user', None)
+
+    if user is None or not user.is_authenticated:
+        return None
+
+    return user
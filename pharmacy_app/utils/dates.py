@@ -0,0 +1,34 @@
+import datetime
+
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+
+def parse_moment(value, end=False):
+    """
+    Parses an ISO date or datetime query parameter into an aware datetime.
+
+    A plain date stands for the start of that day, or with `end` for the start
+    of the next day, so a date range covers the whole of its last day. Raises
+    ValueError for anything else.
+    """
+
+    moment = parse_datetime(value)
+
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(value)
+
+        if end:
+            day += datetime.timedelta(days=1)
+        moment = datetime.datetime.combine(day, datetime.time.min)
+
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+
+    return moment
+
+
+def is_datetime(value):
+    return parse_datetime(value) is not None
@@ -0,0 +1,41 @@
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+class Echo:
+    """File-like object handing back what the csv writer writes, instead of buffering it"""
+
+    def write(self, value):
+        return value
+
+
+def _format(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+def stream_csv(columns, rows):
+    """Yields the CSV header and one CSV line per row"""
+
+    writer = csv.writer(Echo())
+
+    yield writer.writerow(columns)
+
+    for row in rows:
+        yield writer.writerow([_format(value) for value in row])
+
+
+def stream_ndjson(columns, rows):
+    """Yields one JSON object per row, keyed by the column names"""
+
+    encoder = DjangoJSONEncoder()
+
+    for row in rows:
+        yield encoder.encode(dict(zip(columns, (_format(value) for value in row)))) + "\n"
+
+
+EXPORT_FORMATS = {
+    'csv': (stream_csv, 'text/csv'),
+    'ndjson': (stream_ndjson, 'application/x-ndjson'),
+}
@@ -0,0 +1,41 @@
+import json
+from itertools import islice
+
+
+def iter_ndjson(stream):
+    """
+    Yields (index, document, error) for every non-blank line of an NDJSON stream.
+
+    The stream is read line by line, so the body is never held in memory as a
+    whole. Lines that aren't a JSON object are yielded with an error instead
+    of a document.
+    """
+
+    index = 0
+
+    for line in stream:
+        line = line.strip()
+
+        if not line:
+            continue
+
+        try:
+            document = json.loads(line)
+        except ValueError:
+            yield index, None, "Invalid JSON"
+        else:
+            if isinstance(document, dict):
+                yield index, document, None
+            else:
+                yield index, None, "Expected a JSON object"
+
+        index += 1
+
+
+def chunked(iterable, size):
+    """Yields lists of up to `size` items from the iterable"""
+
+    iterator = iter(iterable)
+
+    while chunk := list(islice(iterator, size)):
+        yield chunk
@@ -0,0 +1,20 @@
+import random
+
+from django.conf import settings
+
+
+def should_profile(request):
+    """
+    Decides up front whether Silk profiles a request (SILKY_INTERCEPT_FUNC).
+
+    Requests are profiled when they carry the opt-in header with the
+    configured token, otherwise a PROFILING_SAMPLE_RATE fraction of them is.
+    Kept free of models so that settings.py can import it.
+    """
+
+    token = getattr(settings, 'PROFILING_TOKEN', None)
+
+    if token and request.headers.get('X-Profile') == token:
+        return True
+
+    return random.random() < getattr(settings, 'PROFILING_SAMPLE_RATE', 0)
@@ -1,9 +0,0 @@
-import threading
-
-_thread_locals = threading.local()
-
-def set_current_user(user):
-    _thread_locals.user = user
-
-def get_current_user():
-    return getattr(_thread_locals, 'user', None)
\ No newline at end of file
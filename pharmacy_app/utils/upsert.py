@@ -0,0 +1,81 @@
+from django.db import connections, router
+
+
+def upsert_increment(model, key_fields, value_fields, rows, using=None):
+    """
+    Adds the given deltas to counter rows in a single statement.
+
+    Each row is a tuple of key values followed by delta values. Missing rows
+    are inserted with the delta as their initial value, existing rows are
+    incremented in place with INSERT ... ON CONFLICT DO UPDATE, so there is no
+    read-modify-write race between concurrent writers. Rows are written in key
+    order, so concurrent writers lock them in the same order and can't
+    deadlock. The key fields must be covered by a unique constraint on the
+    model.
+    """
+
+    # Merge duplicate keys, ON CONFLICT can't touch the same row twice
+    merged = {}
+    width = len(key_fields)
+    for row in rows:
+        key, deltas = tuple(row[:width]), row[width:]
+        if key in merged:
+            merged[key] = [a + b for a, b in zip(merged[key], deltas)]
+        else:
+            merged[key] = list(deltas)
+
+    # Rows that cancel out leave the counters as they are
+    merged = {key: deltas for key, deltas in merged.items() if any(deltas)}
+
+    if not merged:
+        return 0
+
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+    quote = connection.ops.quote_name
+
+    keys = [model._meta.get_field(name) for name in key_fields]
+    values = [model._meta.get_field(name) for name in value_fields]
+    fields = keys + values
+
+    table = quote(model._meta.db_table)
+    columns = ", ".join(quote(field.column) for field in fields)
+    conflict = ", ".join(quote(field.column) for field in keys)
+    updates = ", ".join(
+        f"{quote(field.column)} = {table}.{quote(field.column)} + EXCLUDED.{quote(field.column)}"
+        for field in values
+    )
+    placeholders = "(" + ", ".join(["%s"] * len(fields)) + ")"
+
+    params = []
+    for key, deltas in sorted(merged.items(), key=lambda item: item[0]):
+        for field, value in zip(fields, list(key) + deltas):
+            params.append(field.get_db_prep_value(value, connection))
+
+    sql = (
+        f"INSERT INTO {table} ({columns}) VALUES {', '.join([placeholders] * len(merged))} "
+        f"ON CONFLICT ({conflict}) DO UPDATE SET {updates}"
+    )
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.rowcount
+
+
+def lock_for_rebuild(model, using=None):
+    """
+    Blocks the writers of a counter table until the transaction ends (PostgreSQL).
+
+    Meant for rebuilding the table from its source rows: taken before reading
+    them, the rebuild sees every committed change and writers still running
+    add their deltas to the rebuilt rows afterwards. Reads carry on.
+    """
+
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+
+    if connection.vendor != 'postgresql':
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"LOCK TABLE {connection.ops.quote_name(model._meta.db_table)} IN SHARE ROW EXCLUSIVE MODE")